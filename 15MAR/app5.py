@@ -76,13 +76,15 @@ class Document(db.Model):
     filename = db.Column(db.String(200), nullable=False)
     full_text = db.Column(db.Text, nullable=False)  # Tutto il testo estratto
     summary = db.Column(db.Text)  # Riassunto complessivo
-    block_texts = db.Column(db.Text)  # Testo dei blocchi separati (come stringa unica, con separatori)
-    block_summaries = db.Column(db.Text)  # Riassunti blocchi (es. Blocco 1:\nRiassunto...)
+    block_texts = db.Column(db.Text)  # Solo documenti vecchi: ora i blocchi stanno in Block (document_id)
+    block_summaries = db.Column(db.Text)  # Solo documenti vecchi: ora i riassunti stanno in Block
     keywords = db.Column(db.String(500))  # Parole chiave (tutte insieme)
     num_blocks = db.Column(db.Integer)  # Numero di blocchi elaborati
     processing_time = db.Column(db.Float)  # Secondi impiegati
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    blocks = db.relationship('Block', backref='document', lazy=True, order_by='Block.block_index')
+
     def __repr__(self):
         return f"<Document {self.filename} - {self.num_blocks} blocchi>"
 
@@ -93,28 +95,244 @@ class Block(db.Model):
     block_text = db.Column(db.Text, nullable=False)       # Testo del blocco
     block_summary = db.Column(db.Text, nullable=False)    # Riassunto del blocco
     keywords = db.Column(db.String(500))                  # Parole chiave stimate
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), index=True)  # Documento di origine
+    start_offset = db.Column(db.Integer)                  # Posizione del blocco in Document.full_text
+    end_offset = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
         return f"<Block {self.filename} - Blocco {self.block_index}>"
 
+class ImportedFile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    json_name = db.Column(db.String(300), nullable=False, unique=True)  # Nome del JSON in training_data/Telegram
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'))
+    imported_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ImportedFile {self.json_name} -> Document {self.document_id}>"
+
+class SummaryCache(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), nullable=False, unique=True)  # sha256 di testo normalizzato + parametri
+    summary = db.Column(db.Text, nullable=False)
+    input_chars = db.Column(db.Integer)  # Lunghezza del testo riassunto
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Per l'eviction LRU
+
+    def __repr__(self):
+        return f"<SummaryCache {self.cache_key[:12]} - {self.hits} hit>"
+
 
 
 #############PYTORCH
+import gc
+import threading
 import torch
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+MODEL_MEMORY_BUDGET_MB = None  # Es. 6000: oltre questa soglia scarica i modelli usati meno di recente
+MODEL_IDLE_UNLOAD_S = None  # Es. 1800: scarica i modelli inutilizzati da più di N secondi
+
+
+class ModelRegistry:
+    """Carica i modelli al primo utilizzo e tiene traccia di tempi di caricamento e memoria.
+
+    Importare app5 (migrate_db.py, db_manage) non carica più nulla: i pesi
+    vengono letti solo alla prima get() del modello richiesto. Ogni precisione
+    è una variante separata (es. 'mbart' e 'mbart@int8').
+    """
+
+    def __init__(self, memory_budget_mb=None):
+        self.memory_budget_mb = memory_budget_mb
+        self._loaders = {}  # nome -> funzione che crea il modello
+        self._caricati = {}  # nome -> {'obj', 'load_time', 'memory_mb', 'last_used'}
+        self._lock = threading.RLock()
+
+    def register(self, nome, loader):
+        # loader(precision) -> modello pronto sul device
+        self._loaders[nome] = loader
+
+    @staticmethod
+    def chiave(nome, precision='fp32'):
+        return nome if precision == 'fp32' else f"{nome}@{precision}"
+
+    def get(self, nome, precision='fp32'):
+        if precision not in PRECISIONI:
+            logging.warning(f"[MODELLI] Precisione sconosciuta '{precision}', uso fp32")
+            precision = 'fp32'
+        chiave = self.chiave(nome, precision)
+        with self._lock:
+            voce = self._caricati.get(chiave)
+            if voce is None:
+                print(f"[MODELLI] Caricamento {chiave}...")
+                start_time = time.time()
+                obj = self._loaders[nome](precision)
+                voce = self._caricati[chiave] = {
+                    'obj': obj,
+                    'load_time': round(time.time() - start_time, 2),
+                    'memory_mb': _model_memory_mb(obj),
+                    'last_used': time.time(),
+                }
+                print(f"[MODELLI] {chiave} caricato in {voce['load_time']}s ({voce['memory_mb']} MB)")
+                logging.info(f"[MODELLI] {chiave} caricato in {voce['load_time']}s ({voce['memory_mb']} MB)")
+                self._rispetta_budget(chiave)
+            voce['last_used'] = time.time()
+            return voce['obj']
+
+    def unload(self, chiave):
+        with self._lock:
+            voce = self._caricati.pop(chiave, None)
+        if voce is None:
+            return False
+        del voce
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"[MODELLI] {chiave} scaricato")
+        logging.info(f"[MODELLI] {chiave} scaricato")
+        return True
+
+    def unload_idle(self, max_idle_s):
+        adesso = time.time()
+        with self._lock:
+            inattivi = [nome for nome, voce in self._caricati.items() if adesso - voce['last_used'] > max_idle_s]
+        for nome in inattivi:
+            self.unload(nome)
+
+    def _rispetta_budget(self, appena_caricato):
+        if not self.memory_budget_mb:
+            return
+        while sum(v['memory_mb'] for v in self._caricati.values()) > self.memory_budget_mb:
+            altri = [(v['last_used'], nome) for nome, v in self._caricati.items() if nome != appena_caricato]
+            if not altri:
+                break
+            self.unload(min(altri)[1])
+
+    def stats(self):
+        adesso = time.time()
+        with self._lock:
+            stats = {nome: {'loaded': False, 'load_time_s': None, 'memory_mb': 0, 'idle_s': None}
+                     for nome in self._loaders}
+            for chiave, voce in self._caricati.items():
+                stats[chiave] = {
+                    'loaded': True,
+                    'load_time_s': voce['load_time'],
+                    'memory_mb': voce['memory_mb'],
+                    'idle_s': round(adesso - voce['last_used'], 1),
+                }
+            return stats
+
+
+def _model_memory_mb(obj):
+    # Somma i tensori dello state_dict dei moduli torch contenuti (pipeline, modello o tupla modello/tokenizer).
+    # Lo state_dict include i pesi int8 impacchettati dei Linear quantizzati; i pesi condivisi si contano una volta.
+    oggetti = obj if isinstance(obj, tuple) else (obj,)
+    totale = 0
+    visti = set()
+    for o in oggetti:
+        modulo = getattr(o, 'model', o)
+        if not isinstance(modulo, torch.nn.Module):
+            continue
+        for valore in modulo.state_dict().values():
+            for t in (valore if isinstance(valore, tuple) else (valore,)):
+                if torch.is_tensor(t) and t.data_ptr() not in visti:
+                    visti.add(t.data_ptr())
+                    totale += t.numel() * t.element_size()
+    return round(totale / (1024 * 1024), 1)
+
+
+PRECISIONI = ('fp32', 'fp16', 'bf16', 'int8')
+
+
+def _conv1d_a_linear(model):
+    # GPT-2 usa Conv1D (y = x·W + b, W in×out) per attention e MLP: quantize_dynamic riconosce solo nn.Linear
+    from transformers.pytorch_utils import Conv1D
+    for modulo in list(model.modules()):
+        for nome, figlio in list(modulo.named_children()):
+            if isinstance(figlio, Conv1D):
+                linear = torch.nn.Linear(figlio.weight.shape[0], figlio.nf)
+                linear.weight.data = figlio.weight.data.t().contiguous()
+                linear.bias.data = figlio.bias.data
+                setattr(modulo, nome, linear)
+    return model
+
+
+def _quantizza_int8(model):
+    # Quantizzazione dinamica: pesi dei Linear in int8, attivazioni quantizzate al volo.
+    # lm_head resta in fp32: è legato agli embedding (wte/shared) e quantizzarlo romperebbe il legame
+    model = _conv1d_a_linear(model)
+    testa = model.get_output_embeddings() if hasattr(model, 'get_output_embeddings') else None
+    qconfig = torch.ao.quantization.default_dynamic_qconfig
+    da_quantizzare = {nome: qconfig for nome, modulo in model.named_modules()
+                      if isinstance(modulo, torch.nn.Linear) and modulo is not testa}
+    return torch.ao.quantization.quantize_dynamic(model, da_quantizzare, dtype=torch.qint8)
+
+
+def _applica_precisione(model, precision):
+    # Porta il modello sul device nella precisione richiesta, con fallback se il device non la supporta.
+    # La precisione davvero usata resta in model.precisione_effettiva (per benchmark e log)
+    if precision == 'int8' and device.type != 'cpu':
+        logging.warning("[MODELLI] int8 dinamico disponibile solo su CPU, uso fp16")
+        precision = 'fp16'
+    if precision == 'fp16' and device.type != 'cuda':
+        logging.warning("[MODELLI] fp16 non supportato su CPU, uso bf16")
+        precision = 'bf16'
+    if precision == 'bf16' and not (device.type == 'cpu' or torch.cuda.is_bf16_supported()):
+        logging.warning("[MODELLI] bf16 non supportato da questa GPU, uso fp32")
+        precision = 'fp32'
+
+    if precision == 'int8':
+        model = _quantizza_int8(model)
+    elif precision == 'fp16':
+        model = model.to(device, dtype=torch.float16)
+    elif precision == 'bf16':
+        model = model.to(device, dtype=torch.bfloat16)
+    else:
+        model = model.to(device)
+    model.precisione_effettiva = precision
+    return model
+
+
+def _precisione_effettiva(obj, richiesta):
+    # obj come in _model_memory_mb: pipeline, modello o tupla modello/tokenizer
+    for o in (obj if isinstance(obj, tuple) else (obj,)):
+        modulo = getattr(o, 'model', o)
+        if hasattr(modulo, 'precisione_effettiva'):
+            return modulo.precisione_effettiva
+    return richiesta
+
+
 # MODEL TRASFORMER
-tokenizer = AutoTokenizer.from_pretrained("GroNLP/gpt2-medium-italian-embeddings")
-model = AutoModelForCausalLM.from_pretrained("GroNLP/gpt2-medium-italian-embeddings").to(device)
-generator = pipeline("text-generation", model=model, tokenizer=tokenizer, device=0 if device.type == "cuda" else -1)
+def _load_gpt(precision='fp32'):
+    tokenizer = AutoTokenizer.from_pretrained("GroNLP/gpt2-medium-italian-embeddings")
+    model = _applica_precisione(AutoModelForCausalLM.from_pretrained("GroNLP/gpt2-medium-italian-embeddings"), precision)
+    return pipeline("text-generation", model=model, tokenizer=tokenizer, device=0 if device.type == "cuda" else -1)
+
+
+def _load_bert(precision='fp32'):
+    tokenizerBERT = BertTokenizer.from_pretrained('dbmdz/bert-base-italian-uncased')
+    modelBERT = _applica_precisione(BertForSequenceClassification.from_pretrained('dbmdz/bert-base-italian-uncased'), precision)
+    return modelBERT, tokenizerBERT
+
+
+def _load_mbart(precision='fp32'):
+    from transformers import MBartForConditionalGeneration, MBart50TokenizerFast
+    modelMBART = _applica_precisione(MBartForConditionalGeneration.from_pretrained("facebook/mbart-large-50-many-to-many-mmt"), precision)
+    tokenizerMBART = MBart50TokenizerFast.from_pretrained("facebook/mbart-large-50-many-to-many-mmt")
+    return modelMBART, tokenizerMBART
+
+
+models = ModelRegistry(memory_budget_mb=MODEL_MEMORY_BUDGET_MB)
+models.register('gpt', _load_gpt)
+models.register('bert', _load_bert)
+models.register('mbart', _load_mbart)
 
-tokenizerBERT = BertTokenizer.from_pretrained('dbmdz/bert-base-italian-uncased')
-modelBERT = BertForSequenceClassification.from_pretrained('dbmdz/bert-base-italian-uncased').to(device)
 
-from transformers import MBartForConditionalGeneration, MBart50TokenizerFast
-modelMBART = MBartForConditionalGeneration.from_pretrained("facebook/mbart-large-50-many-to-many-mmt").to(device)
-tokenizerMBART = MBart50TokenizerFast.from_pretrained("facebook/mbart-large-50-many-to-many-mmt")
+def generator(*args, precision='fp32', **kwargs):
+    # Pipeline GPT-2 caricata al primo utilizzo, precision da 'gpt_precision' nei config_*.json
+    return models.get('gpt', precision)(*args, **kwargs)
 
 
 
@@ -166,89 +384,252 @@ def save_interaction(user_input, bot_response, feedback, model_used, summary='',
     print(f"Ultima interazione salvata: Input: {interaction.user_input}, Output: {interaction.bot_response}, Feedback: {interaction.feedback}, Model Used: {interaction.model_used}, Config Details: {interaction.config_details}")
 
 
-def extract_text_from_pdf_blocchi(pdf_path, pages_per_block=20):
-    reader = PdfReader(pdf_path)
-    total_pages = len(reader.pages)
-    blocchi = []
+############## ESTRAZIONE PDF (pagine in streaming, process pool, cache per pagina)
 
-    for start in range(0, total_pages, pages_per_block):
-        end = min(start + pages_per_block, total_pages)
-        testo_blocco = ''
-        for page in reader.pages[start:end]:
-            testo = page.extract_text()
-            if testo:
-                testo_blocco += testo + ' '
-        if testo_blocco.strip():
-            blocchi.append(testo_blocco.strip())
+import hashlib
+import multiprocessing
+import concurrent.futures
+from collections import deque
+import lavori_pool
 
-    return blocchi
+PDF_TEXT_CACHE_DIR = os.path.join('training_data', 'pdf_cache')
+PDF_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # Processi per l'estrazione del testo
+PDF_PAGES_PER_TASK = 10  # Pagine estratte da ogni task del pool
 
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
 
 
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
 
-def fetch_wiki_summaries(topic):
-    search_url = f"https://it.wikipedia.org/w/index.php?search={topic}"
-    response = requests.get(search_url)
-    print("Status Code:", response.status_code)  # Print the status code of the response
 
-    if response.status_code != 200:
-        return "Contenuto non trovato o errore nella richiesta."
+def _get_pdf_pool():
+    # Pool persistente; 'spawn' perché il processo ha già thread attivi (bot, inferenza).
+    # I task partono con lavori_pool.submit: i processi importano solo lavori_pool, non app5
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pdf_pool
 
-    # Print the first 500 characters of the response content to get an idea of what was fetched
-    print("Response Content (snippet):", response.text[:500] + '...')
 
-    soup = BeautifulSoup(response.content, 'html.parser')
-    summaries = []
+def _pagine_in_cache(cache_dir, start, end):
+    pagine = []
+    for i in range(start, end):
+        try:
+            with open(os.path.join(cache_dir, f"{i:05d}.txt"), 'r', encoding='utf-8') as f:
+                pagine.append(f.read())
+        except FileNotFoundError:
+            return None
+    return pagine
+
+
+def _salva_pagine_in_cache(cache_dir, start, pagine):
+    os.makedirs(cache_dir, exist_ok=True)
+    for i, testo in enumerate(pagine, start):
+        tmp_path = os.path.join(cache_dir, f"{i:05d}.txt.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(testo)
+        os.replace(tmp_path, os.path.join(cache_dir, f"{i:05d}.txt"))
+
+
+def iter_pdf_pages(pdf_path, workers=None):
+    """Genera (indice_pagina, testo) in ordine.
+
+    Le pagine già estratte per lo stesso file (sha256 del contenuto) si leggono
+    da PDF_TEXT_CACHE_DIR; le altre vengono estratte a gruppi di
+    PDF_PAGES_PER_TASK nel process pool, con al massimo 2 * workers gruppi in
+    volo per non tenere in memoria l'intero libro.
+    """
+    workers = workers or PDF_WORKERS
+    cache_dir = os.path.join(PDF_TEXT_CACHE_DIR, _hash_file(pdf_path))
+    num_pagine = len(PdfReader(pdf_path).pages)
+    gruppi = [(start, min(start + PDF_PAGES_PER_TASK, num_pagine)) for start in range(0, num_pagine, PDF_PAGES_PER_TASK)]
+
+    pool = _get_pdf_pool() if workers > 1 and len(gruppi) > 1 else None
+    in_volo = deque()
+    prossimo = 0
+
+    while prossimo < len(gruppi) or in_volo:
+        # Riempie la finestra: i gruppi in cache non occupano il pool
+        while prossimo < len(gruppi) and len(in_volo) < 2 * workers:
+            start, end = gruppi[prossimo]
+            pagine = _pagine_in_cache(cache_dir, start, end)
+            if pagine is not None:
+                in_volo.append((start, end, pagine))
+            elif pool is not None:
+                in_volo.append((start, end, lavori_pool.submit(pool, lavori_pool.estrai_pagine, pdf_path, start, end)))
+            else:
+                in_volo.append((start, end, None))
+            prossimo += 1
 
-    # Find all paragraphs in the search page
-    for p in soup.find_all('p', limit=5):  # Limit to 5 to prevent too many results
-        text = p.get_text()
-        if text:
-            # Limit the text to 90 words for guidelines respect
-            shortened_text = ' '.join(text.split()[:90]) + '...'
-            summaries.append(shortened_text)
+        start, end, risultato = in_volo.popleft()
+        if isinstance(risultato, list):
+            pagine = risultato
+        else:
+            try:
+                pagine = risultato.result() if risultato is not None else lavori_pool.estrai_pagine(pdf_path, start, end)
+            except concurrent.futures.BrokenExecutor:
+                logging.error("[PDF] Process pool interrotto, estrazione nel processo corrente")
+                pagine = lavori_pool.estrai_pagine(pdf_path, start, end)
+            _salva_pagine_in_cache(cache_dir, start, pagine)
+
+        for i, testo in enumerate(pagine, start):
+            yield i, testo
+
+
+def iter_text_from_pdf_blocchi(pdf_path, pages_per_block=20):
+    # Raggruppa le pagine in blocchi e restituisce un blocco alla volta
+    parti = []
+    for i, testo in iter_pdf_pages(pdf_path):
+        if testo:
+            parti.append(testo)
+        if (i + 1) % pages_per_block == 0:
+            testo_blocco = ' '.join(parti).strip()
+            parti = []
+            if testo_blocco:
+                yield testo_blocco
+    testo_blocco = ' '.join(parti).strip()
+    if testo_blocco:
+        yield testo_blocco
 
-    return summaries
 
-############## CODA DI ELABORAZIONE
+def extract_text_from_pdf_blocchi(pdf_path, pages_per_block=20):
+    return list(iter_text_from_pdf_blocchi(pdf_path, pages_per_block))
 
-import queue
-import threading
 
-data_to_process=[]
+def extract_text_from_pdf(pdf_path):
+    # Testo completo (usato da /extract-text e /upload-pdf), senza concatenazioni ripetute
+    return ' '.join(testo for _, testo in iter_pdf_pages(pdf_path) if testo)
 
-def process_data(item):
-    return print('Queue +1')
 
+############## CODA DI ELABORAZIONE
+
+import queue
+import threading
+import concurrent.futures
+from collections import deque
 
-def worker(queue):
-    while True:
-        item = queue.get()
-        if item is None:
-            break
-        process_data(item)  # Sostituisci questa funzione con il tuo processo
-        queue.task_done()
+TELEGRAM_IO_WORKERS = 4  # Thread che gestiscono i messaggi (download, DB, invio risposte)
+TELEGRAM_MAX_PENDING = 50  # Messaggi accettati in coda prima di rispondere "occupato"
 
-# Crea una coda e un thread pool
-q = queue.Queue()
-threads = []
-for i in range(4):  # Numero di thread
-    t = threading.Thread(target=worker, args=(q,))
-    t.start()
-    threads.append(t)
 
-# Aggiungi compiti alla coda
-for item in data_to_process:
-    q.put(item)
+class InferenceWorker:
+    """Thread dedicato a un modello: le richieste passano da una coda e girano una alla volta."""
 
-# Blocca fino a quando tutti i compiti nella coda sono stati presi in carico
-q.join()
+    def __init__(self, nome):
+        self.nome = nome
+        self.coda = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name=f"inferenza-{nome}", daemon=True)
+        self.thread.start()
 
-# Ferma i worker
-for i in range(4):
-    q.put(None)
-for t in threads:
-    t.join()
+    def _loop(self):
+        while True:
+            fn, args, kwargs, future = self.coda.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            self.coda.task_done()
+
+    def esegui(self, fn, *args, **kwargs):
+        # Chiamata annidata dallo stesso thread: esegue subito per non andare in deadlock
+        if threading.current_thread() is self.thread:
+            return fn(*args, **kwargs)
+        future = concurrent.futures.Future()
+        self.coda.put((fn, args, kwargs, future))
+        return future.result()
+
+
+inference_workers = {}
+_inference_workers_lock = threading.Lock()
+
+
+def esegui_su_modello(nome, fn, *args, **kwargs):
+    # Crea il worker del modello al primo utilizzo (nessun thread all'import)
+    with _inference_workers_lock:
+        worker = inference_workers.get(nome)
+        if worker is None:
+            worker = inference_workers[nome] = InferenceWorker(nome)
+    return worker.esegui(fn, *args, **kwargs)
+
+
+class TelegramJobQueue:
+    """Coda limitata di messaggi con pool di worker I/O.
+
+    I messaggi della stessa chat vengono eseguiti in ordine, uno alla volta:
+    finché un messaggio è in lavorazione i successivi aspettano in per_chat
+    e non occupano altri worker.
+    """
+
+    def __init__(self, handler, num_workers=TELEGRAM_IO_WORKERS, max_pendenti=TELEGRAM_MAX_PENDING):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_pendenti = max_pendenti
+        self.coda = queue.Queue()  # Messaggi pronti, al massimo uno per chat
+        self.per_chat = {}  # chat_id -> deque dei messaggi in attesa dietro quello in corso
+        self.pendenti = 0
+        self.in_corso = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._worker, name=f"telegram-io-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, chat_id, msg):
+        """Ritorna False se la coda è piena (backpressure)."""
+        with self._lock:
+            if self.pendenti >= self.max_pendenti:
+                return False
+            self.pendenti += 1
+            if chat_id in self.per_chat:
+                self.per_chat[chat_id].append(msg)
+                return True
+            self.per_chat[chat_id] = deque()
+        self.coda.put((chat_id, msg))
+        return True
+
+    def _worker(self):
+        while True:
+            chat_id, msg = self.coda.get()
+            with self._lock:
+                self.in_corso += 1
+            try:
+                self.handler(msg)
+            except Exception as e:
+                logging.error(f"[JOB] Errore nel messaggio della chat {chat_id}: {e}")
+                print(f"[ERRORE] Job chat {chat_id}: {e}")
+            finally:
+                with self._lock:
+                    self.in_corso -= 1
+                    self.pendenti -= 1
+                    in_attesa = self.per_chat[chat_id]
+                    prossimo = in_attesa.popleft() if in_attesa else None
+                    if prossimo is None:
+                        del self.per_chat[chat_id]
+                if prossimo is not None:
+                    self.coda.put((chat_id, prossimo))
+
+    def stato(self):
+        with self._lock:
+            return {
+                'pendenti': self.pendenti,
+                'in_corso': self.in_corso,
+                'chat_attive': len(self.per_chat),
+                'max_pendenti': self.max_pendenti,
+                'workers': self.num_workers,
+                'modelli': {nome: w.coda.qsize() for nome, w in inference_workers.items()},
+            }
 
 
 
@@ -267,7 +648,8 @@ def index():
             response = generator(user_input, truncation=config['truncation'], max_length=config['max_length'],
                                  temperature=config['temperature'], top_p=0.9,
                                  num_return_sequences=config['num_return_sequences'],
-                                 max_new_tokens=config.get('max_new_token', 50))[0]['generated_text']
+                                 max_new_tokens=config.get('max_new_token', 50),
+                                 precision=config.get('gpt_precision', 'fp32'))[0]['generated_text']
             save_interaction(user_input, response)
             return render_template('index.html', output=response, user_input=user_input, generation_time=time.time() - start_time)
         except Exception as e:
@@ -317,7 +699,8 @@ def extract_text():
             response = generator(extracted_text, truncation=config['truncation'], max_length=config['max_length'],
                                  temperature=config['temperature'], top_p=0.9,
                                  num_return_sequences=config['num_return_sequences'],
-                                 max_new_tokens=config.get('max_new_token', 50))[0]['generated_text']
+                                 max_new_tokens=config.get('max_new_token', 50),
+                                 precision=config.get('gpt_precision', 'fp32'))[0]['generated_text']
 
             return render_template('index.html', output=response, user_input=extracted_text,
                                    generation_time=0)  # generation_time può essere omesso o calcolato se necessario
@@ -381,13 +764,119 @@ def military_info():
 
 
 
+############## WIKIPEDIA (sessione condivisa, cache su disco, fetch concorrenti)
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+WIKI_SEARCH_URL = "https://it.wikipedia.org/w/index.php"
+WIKI_CACHE_DIR = os.path.join('training_data', 'wiki_cache')
+WIKI_CACHE_TTL_S = 24 * 3600  # Entro questo tempo la pagina in cache si usa senza chiedere a Wikipedia
+WIKI_TIMEOUT_S = 10
+WIKI_MAX_WORKERS = 4  # Richieste parallele per le ricerche con più parole chiave
+WIKI_FIXTURE_DIR = os.environ.get('WIKI_FIXTURE_DIR')  # Se impostata legge <dir>/<parola_chiave>.html, senza rete
+
+
+class WikiFetcher:
+    """Scarica le pagine di ricerca di Wikipedia con una requests.Session condivisa.
+
+    Le risposte sono salvate in WIKI_CACHE_DIR con ETag/Last-Modified: scaduto
+    il TTL la pagina viene rivalidata e un 304 riusa la copia locale. Se la
+    rete non risponde si usa la copia in cache anche se vecchia.
+    """
+
+    def __init__(self, cache_dir=WIKI_CACHE_DIR, ttl_s=WIKI_CACHE_TTL_S, timeout_s=WIKI_TIMEOUT_S,
+                 max_workers=WIKI_MAX_WORKERS, fixture_dir=WIKI_FIXTURE_DIR):
+        self.cache_dir = cache_dir
+        self.ttl_s = ttl_s
+        self.timeout_s = timeout_s
+        self.max_workers = max_workers
+        self.fixture_dir = fixture_dir
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=2))
+        self.session.headers['User-Agent'] = 'IntelligenzaArtificialeITA/1.0 (bot Telegram, uso non commerciale)'
+
+    @staticmethod
+    def _slug(keyword):
+        return ''.join(c if c.isalnum() else '_' for c in keyword.strip().lower())
+
+    def _cache_path(self, keyword):
+        return os.path.join(self.cache_dir, hashlib.sha256(keyword.strip().encode('utf-8')).hexdigest() + '.json')
+
+    def _leggi_cache(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _scrivi_cache(self, path, voce):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(voce, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def fetch_html(self, keyword):
+        if self.fixture_dir:
+            fixture_path = os.path.join(self.fixture_dir, f"{self._slug(keyword)}.html")
+            if not os.path.exists(fixture_path):
+                return None
+            with open(fixture_path, 'r', encoding='utf-8') as f:
+                return f.read()
+
+        path = self._cache_path(keyword)
+        cached = self._leggi_cache(path)
+        if cached and time.time() - cached['fetched_at'] < self.ttl_s:
+            return cached['content']
+
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            response = self.session.get(WIKI_SEARCH_URL, params={'search': keyword}, headers=headers, timeout=self.timeout_s)
+        except requests.RequestException as e:
+            logging.error(f"[Wikipedia] Errore di rete per '{keyword}': {e}")
+            return cached['content'] if cached else None
+
+        if response.status_code == 304 and cached:
+            cached['fetched_at'] = time.time()
+            self._scrivi_cache(path, cached)
+            return cached['content']
+        if response.status_code != 200:
+            print(f"[Wikipedia] Status Code {response.status_code} per '{keyword}'")
+            return cached['content'] if cached else None
+
+        self._scrivi_cache(path, {
+            'keyword': keyword,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+            'content': response.text,
+        })
+        return response.text
+
+    def map(self, fn, keywords):
+        # Applica fn alle parole chiave in parallelo mantenendo l'ordine
+        if len(keywords) <= 1:
+            return [fn(k) for k in keywords]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(keywords))) as executor:
+            return list(executor.map(fn, keywords))
+
+
+wiki_fetcher = WikiFetcher()
+
+
 def fetch_wiki_summaries(keyword):
-    search_url = f"https://it.wikipedia.org/w/index.php?search={keyword}"
-    response = requests.get(search_url)
-    if response.status_code != 200:
+    html = wiki_fetcher.fetch_html(keyword)
+    if html is None:
         return None
 
-    soup = BeautifulSoup(response.content, 'html.parser')
+    soup = BeautifulSoup(html, 'html.parser')
     summaries = []
     for p in soup.find_all('p', limit=5):  # Aumenta il limite se necessario
         text = p.get_text()
@@ -398,37 +887,238 @@ def fetch_wiki_summaries(keyword):
     return full_text[:1024]  # Limita il testo a 1024 caratteri per MBART
 
 
-def summarize_text(text, max_tokens=1024, max_summary_tokens=512):
-    print("[MBART] Avvio riassunto...")
+def fetch_wiki_summaries_many(keywords):
+    return wiki_fetcher.map(fetch_wiki_summaries, keywords)
+
+
+############## CACHE RIASSUNTI
+
+import hashlib
+import unicodedata
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+SUMMARY_CACHE_MAX_ENTRIES = 5000  # Oltre questo numero si eliminano i riassunti usati meno di recente
+
+# Parametri fissi di generate per MBART, entrano anche nella chiave della cache
+MBART_GEN_PARAMS = {
+    'num_beams': 5,
+    'length_penalty': 1.0,
+    'min_length': 100,
+    'no_repeat_ngram_size': 3,
+    'early_stopping': True,
+}
+
+
+class SummaryCacheStore:
+    """Cache persistente dei riassunti MBART nella tabella SummaryCache.
+
+    Ogni metodo apre il proprio app context, così funziona anche dal thread
+    di inferenza e non interferisce con la sessione della richiesta.
+    """
+
+    def __init__(self, max_entries=SUMMARY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._tabella_pronta = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def chiave(text, **params):
+        normalizzato = ' '.join(unicodedata.normalize('NFC', text).split())
+        payload = json.dumps(params, sort_keys=True) + '\n' + normalizzato
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
+    def _prepara(self):
+        # Il bot Telegram non passa da db.create_all(): crea la tabella se manca
+        if not self._tabella_pronta:
+            SummaryCache.__table__.create(db.engine, checkfirst=True)
+            self._tabella_pronta = True
+
+    def get_many(self, chiavi):
+        """Ritorna {chiave: riassunto} per le chiavi già in cache e aggiorna hits/last_used_at."""
+        trovati = {}
+        try:
+            with app.app_context():
+                self._prepara()
+                righe = SummaryCache.query.filter(SummaryCache.cache_key.in_(set(chiavi))).all()
+                adesso = datetime.utcnow()
+                for riga in righe:
+                    riga.hits = (riga.hits or 0) + 1
+                    riga.last_used_at = adesso
+                    trovati[riga.cache_key] = riga.summary
+                if righe:
+                    db.session.commit()
+        except Exception as e:
+            logging.error(f"[CACHE] Lettura cache riassunti fallita: {e}")
+
+        with self._lock:
+            presenti = sum(1 for k in chiavi if k in trovati)
+            self.hits += presenti
+            self.misses += len(chiavi) - presenti
+        return trovati
+
+    def put_many(self, voci):
+        """voci: lista di (chiave, riassunto, input_chars)."""
+        if not voci:
+            return
+        try:
+            with app.app_context():
+                self._prepara()
+                adesso = datetime.utcnow()
+                righe = [{'cache_key': k, 'summary': r, 'input_chars': n, 'hits': 0,
+                          'created_at': adesso, 'last_used_at': adesso} for k, r, n in voci]
+                # Un altro processo può aver già salvato la stessa chiave
+                db.session.execute(sqlite_insert(SummaryCache).values(righe).on_conflict_do_nothing())
+
+                totale = db.session.query(db.func.count(SummaryCache.id)).scalar()
+                if totale > self.max_entries:
+                    vecchi = db.session.query(SummaryCache.id) \
+                        .order_by(SummaryCache.last_used_at.asc()) \
+                        .limit(totale - self.max_entries).subquery()
+                    SummaryCache.query.filter(SummaryCache.id.in_(db.select(vecchi.c.id))) \
+                        .delete(synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            logging.error(f"[CACHE] Scrittura cache riassunti fallita: {e}")
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        voci = None
+        try:
+            with app.app_context():
+                self._prepara()
+                voci = db.session.query(db.func.count(SummaryCache.id)).scalar()
+        except Exception as e:
+            logging.error(f"[CACHE] Statistiche cache non disponibili: {e}")
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            'entries': voci,
+            'max_entries': self.max_entries,
+        }
+
+
+summary_cache = SummaryCacheStore()
+
+
+def summarize_texts(texts, max_tokens=1024, max_summary_tokens=512, precision=None, use_cache=True):
+    # Riassume più testi con una sola chiamata generate (batch con padding), saltando quelli già in cache
+    if precision is None:
+        precision = (load_config('medium') or {}).get('mbart_precision', 'fp32')
+
+    parametri = dict(MBART_GEN_PARAMS, max_tokens=max_tokens, max_summary_tokens=max_summary_tokens, precision=precision)
+    chiavi = [summary_cache.chiave(t, **parametri) for t in texts]
+    riassunti = summary_cache.get_many(chiavi) if use_cache else {}
+    mancanti = [i for i, k in enumerate(chiavi) if k not in riassunti]
+    if not mancanti:
+        print(f"[CACHE] {len(texts)} riassunti dalla cache")
+        return [riassunti[k] for k in chiavi]
+
+    modelMBART, tokenizerMBART = models.get('mbart', precision)
     tokenizerMBART.src_lang = "it_IT"
 
     # Tokenizza input interamente e tronca in token, non caratteri
     inputs = tokenizerMBART(
-        text,
+        [texts[i] for i in mancanti],
         return_tensors="pt",
         padding=True,
         truncation=True,
         max_length=max_tokens
     ).to(device)
 
-    # Genera il riassunto con MBART
+    # Genera i riassunti con MBART, la attention_mask esclude il padding
     summary_ids = modelMBART.generate(
         inputs['input_ids'],
+        attention_mask=inputs['attention_mask'],
         forced_bos_token_id=tokenizerMBART.lang_code_to_id["it_IT"],
-        num_beams=5,
-        length_penalty=1.0,
         max_length=max_summary_tokens,
-        min_length=100,
-        no_repeat_ngram_size=3,
-        early_stopping=True
+        **MBART_GEN_PARAMS
     )
 
-    summary = tokenizerMBART.decode(summary_ids[0], skip_special_tokens=True)
+    nuovi = tokenizerMBART.batch_decode(summary_ids, skip_special_tokens=True)
+    if use_cache:
+        summary_cache.put_many([(chiavi[i], r, len(texts[i])) for i, r in zip(mancanti, nuovi)])
+    for i, r in zip(mancanti, nuovi):
+        riassunti[chiavi[i]] = r
+    return [riassunti[k] for k in chiavi]
+
+
+def summarize_text(text, max_tokens=1024, max_summary_tokens=512):
+    print("[MBART] Avvio riassunto...")
+    summary = summarize_texts([text], max_tokens=max_tokens, max_summary_tokens=max_summary_tokens)[0]
     print(f"[MBART] Riassunto generato ({len(summary)} caratteri): {summary[:200]}{'...' if len(summary) > 200 else ''}")
     return summary
 
 
+############## PIPELINE RIASSUNTI PDF (estrazione e MBART in parallelo)
+
+MBART_BATCH_SIZE = 4  # Blocchi per chiamata generate, da ridurre se la GPU va in OOM
+PRODUTTORE_PUT_TIMEOUT_S = 0.5  # Ogni quanto il produttore ricontrolla se il consumatore si è fermato
+
+
+def riassumi_pdf_a_blocchi(pdf_path, pages_per_block=20, batch_size=MBART_BATCH_SIZE, on_progress=None):
+    """Produttore/consumatore: un thread estrae i blocchi dal PDF mentre MBART
+    riassume il batch precedente. on_progress(n_blocco, riassunto) viene
+    chiamato per ogni blocco completato. Ritorna (blocchi, riassunti).
+    Se il consumatore si ferma per un errore, stop sblocca il produttore fermo sulla coda piena."""
+    coda = queue.Queue(maxsize=batch_size * 2)
+    FINE = object()
+    errori = []
+    stop = threading.Event()
+
+    def metti(item):
+        # put con timeout: False se il consumatore non legge più
+        while not stop.is_set():
+            try:
+                coda.put(item, timeout=PRODUTTORE_PUT_TIMEOUT_S)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produttore():
+        try:
+            for blocco in iter_text_from_pdf_blocchi(pdf_path, pages_per_block):
+                if not metti(blocco):
+                    return
+        except Exception as e:
+            errori.append(e)
+        finally:
+            metti(FINE)
+
+    threading.Thread(target=produttore, daemon=True).start()
+
+    blocchi, riassunti = [], []
+    finito = False
+    try:
+        while not finito:
+            batch = []
+            while len(batch) < batch_size:
+                item = coda.get()
+                if item is FINE:
+                    finito = True
+                    break
+                batch.append(item)
+            if not batch:
+                break
+
+            print(f"[MBART] Batch di {len(batch)} blocchi ({len(blocchi) + 1}-{len(blocchi) + len(batch)})...")
+            for blocco, riassunto in zip(batch, esegui_su_modello('mbart', summarize_texts, batch)):
+                blocchi.append(blocco)
+                riassunti.append(riassunto)
+                if on_progress:
+                    on_progress(len(blocchi), riassunto)
+    finally:
+        stop.set()
+
+    if errori:
+        raise errori[0]
+    return blocchi, riassunti
+
+
 @app.route('/analyze-wikipedia', methods=['GET', 'POST'])
 def analyze_wikipedia():
     if request.method == 'POST':
@@ -464,13 +1154,14 @@ def analyze_wikipedia():
 @app.route('/queue-analysis', methods=['GET', 'POST'])
 def queue_analysis():
     if request.method == 'POST':
-        keywords = request.form.get('keywords', '').split(',')
+        keywords = [k.strip() for k in request.form.get('keywords', '').split(',') if k.strip()]
+
+        # Scarica tutte le parole chiave in parallelo, poi riassume a batch
+        trovati = [(k, c) for k, c in zip(keywords, fetch_wiki_summaries_many(keywords)) if c]
         summaries = []
-        for keyword in keywords:
-            keyword = keyword.strip()
-            content = fetch_wiki_summaries(keyword)
-            if content:
-                summary = summarize_text(content)
+        for i in range(0, len(trovati), MBART_BATCH_SIZE):
+            batch = trovati[i:i + MBART_BATCH_SIZE]
+            for (keyword, content), summary in zip(batch, summarize_texts([c for _, c in batch])):
                 summaries.append({'keyword': keyword, 'content': content, 'summary': summary})
         session['summaries'] = summaries
         return redirect(url_for('feedback_collect'))
@@ -542,6 +1233,18 @@ def upload_pdf():
                            )
 
 
+@app.route('/models')
+def models_status():
+    # Modelli caricati, tempi di caricamento e memoria occupata
+    return jsonify(models.stats())
+
+
+@app.route('/summary-cache')
+def summary_cache_status():
+    # Hit/miss della cache riassunti MBART
+    return jsonify(summary_cache.stats())
+
+
 @app.route('/documenti')
 def documenti():
     docs = Document.query.order_by(Document.created_at.desc()).all()
@@ -566,20 +1269,170 @@ import logging
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
+
+############## INDICE TF-IDF BLOCCHI (persistente su disco)
+
+import pickle
+import numpy as np
+from scipy import sparse
+
+BLOCK_INDEX_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'DATA', 'block_index.pkl')
+
+
+class BlockIndex:
+    """Indice TF-IDF dei riassunti dei Block, salvato accanto a database.db.
+
+    Il fit del vettorizzatore si fa una volta sola; i blocchi nuovi vengono
+    aggiunti con transform() e la ricerca legge solo le posting list dei
+    termini presenti nella domanda.
+    """
+
+    def __init__(self, path=BLOCK_INDEX_PATH, refit_ratio=2.0):
+        self.path = path
+        self.refit_ratio = refit_ratio  # Rifà il fit quando il corpus supera fitted_rows * refit_ratio
+        self.vectorizer = None
+        self.matrix = None  # CSR, una riga per blocco
+        self.block_ids = []  # Block.id per ogni riga della matrice
+        self.max_id = 0
+        self.fitted_rows = 0
+        self._csc = None  # Copia per colonne (posting list), ricostruita dopo ogni aggiunta
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                stato = pickle.load(f)
+            self.vectorizer = stato['vectorizer']
+            self.matrix = stato['matrix']
+            self.block_ids = stato['block_ids']
+            self.max_id = stato['max_id']
+            self.fitted_rows = stato['fitted_rows']
+            self._csc = None
+            print(f"[INDEX] Indice caricato: {len(self.block_ids)} blocchi")
+            return True
+        except Exception as e:
+            logging.error(f"[INDEX] Indice illeggibile, verrà ricostruito: {e}")
+            self.vectorizer = None
+            return False
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Nome unico per processo e thread: bot e db_manage possono salvare insieme
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'vectorizer': self.vectorizer,
+                'matrix': self.matrix,
+                'block_ids': self.block_ids,
+                'max_id': self.max_id,
+                'fitted_rows': self.fitted_rows,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)  # Scrittura atomica, niente indice a metà
+
+    def build(self):
+        """Fit completo su tutti i Block (legge solo id e riassunto)."""
+        with self._lock:
+            righe = db.session.query(Block.id, Block.block_summary).order_by(Block.id).all()
+            self._csc = None
+            self._loaded = True
+            if not righe:
+                self.vectorizer, self.matrix, self.block_ids, self.max_id, self.fitted_rows = None, None, [], 0, 0
+                return
+            vectorizer = TfidfVectorizer()
+            try:
+                matrix = vectorizer.fit_transform([r.block_summary or '' for r in righe])
+            except ValueError:
+                # Vocabolario vuoto (riassunti vuoti): niente da indicizzare
+                self.vectorizer, self.matrix, self.block_ids, self.max_id, self.fitted_rows = None, None, [], 0, 0
+                return
+            self.vectorizer = vectorizer
+            self.matrix = matrix.tocsr()
+            self.block_ids = [r.id for r in righe]
+            self.max_id = self.block_ids[-1]
+            self.fitted_rows = len(self.block_ids)
+            self.save()
+            print(f"[INDEX] Indice ricostruito: {self.fitted_rows} blocchi, {len(vectorizer.vocabulary_)} termini")
+
+    def add_blocks(self, blocchi):
+        """Aggiunge blocchi appena salvati senza rifare il fit (salvo crescita oltre refit_ratio)."""
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            blocchi = [b for b in blocchi if b.id > self.max_id]
+            if not blocchi:
+                return
+            totale = len(self.block_ids) + len(blocchi)
+            if self.vectorizer is None or totale > self.fitted_rows * self.refit_ratio:
+                self.build()
+                return
+            nuove_righe = self.vectorizer.transform([b.block_summary or '' for b in blocchi])
+            self.matrix = sparse.vstack([self.matrix, nuove_righe], format='csr')
+            self.block_ids.extend(b.id for b in blocchi)
+            self.max_id = max(self.block_ids)
+            self._csc = None
+            self.save()
+            print(f"[INDEX] Aggiunti {len(blocchi)} blocchi all'indice (totale {len(self.block_ids)})")
+
+    def sync(self):
+        """Allinea l'indice ai Block inseriti da altri percorsi (query su PK, costo costante)."""
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            max_db = db.session.query(db.func.max(Block.id)).scalar() or 0
+            if max_db <= self.max_id:
+                return
+            if self.vectorizer is None:
+                self.build()
+            else:
+                self.add_blocks(Block.query.filter(Block.id > self.max_id).order_by(Block.id).all())
+
+    def search(self, prompt, top_k=3):
+        """Ritorna [(block_id, score)] ordinati per similarità coseno decrescente."""
+        with self._lock:
+            self.sync()
+            if self.vectorizer is None:
+                return []
+            if self._csc is None:
+                self._csc = self.matrix.tocsc()
+            csc = self._csc
+
+            query = self.vectorizer.transform([prompt])
+            righe, pesi = [], []
+            for col, peso in zip(query.indices, query.data):
+                start, end = csc.indptr[col], csc.indptr[col + 1]
+                righe.append(csc.indices[start:end])
+                pesi.append(csc.data[start:end] * peso)
+            if not righe:
+                return []
+
+            righe = np.concatenate(righe)
+            if righe.size == 0:
+                return []
+            candidati, posizioni = np.unique(righe, return_inverse=True)
+            punteggi = np.bincount(posizioni, weights=np.concatenate(pesi))
+
+            k = min(top_k, len(candidati))
+            migliori = np.argpartition(-punteggi, k - 1)[:k]
+            migliori = migliori[np.argsort(-punteggi[migliori])]
+            return [(self.block_ids[candidati[i]], float(punteggi[i])) for i in migliori]
+
+
+block_index = BlockIndex()
+
+
 def cerca_blocchi_rilevanti(prompt, top_k=3):
     with app.app_context():
-        blocchi = Block.query.all()
-        if not blocchi:
+        risultati = block_index.search(prompt, top_k=top_k)
+        if not risultati:
             return []
 
-        testi_blocchi = [b.block_summary for b in blocchi]
-        vectorizer = TfidfVectorizer()
-        tfidf = vectorizer.fit_transform([prompt] + testi_blocchi)
-
-        sim = cosine_similarity(tfidf[0:1], tfidf[1:])[0]
-        migliori = sim.argsort()[-top_k:][::-1]
-
-        return [blocchi[i] for i in migliori]
+        ids = [block_id for block_id, _ in risultati]
+        trovati = {b.id: b for b in Block.query.filter(Block.id.in_(ids)).all()}
+        return [trovati[i] for i in ids if i in trovati]
 
 
 
@@ -605,7 +1458,8 @@ def genera_con_blocchi(prompt, top_k=3, max_words_context=500):
             temperature=config.get('temperature', 0.7),
             top_p=config.get('top_p', 0.9),
             num_return_sequences=1,
-            max_new_tokens=config.get('max_new_token', 50)
+            max_new_tokens=config.get('max_new_token', 50),
+            precision=config.get('gpt_precision', 'fp32')
         )[0]['generated_text']
 
         torch.cuda.empty_cache()
@@ -621,6 +1475,7 @@ class TelegramBot:
         self.token = None
         self.registered_users = {}
         self.user_modes = {}  # user_id: "gpt" o "wikipedia"
+        self.jobs = TelegramJobQueue(self.handle_message)
 
         # Configura logging su file
         logging.basicConfig(
@@ -672,6 +1527,7 @@ class TelegramBot:
                                      "/wikipedia - Attiva modalità Wikipedia\n"
                                      "/testo_libero - Attiva Testo Libero \n"
                                      "/analisi_pdf_enciclopedia - Analisi PDF Input e Risposte Intelligenti(in progress)\n "
+                                     "/status - Stato della coda di elaborazione\n"
                                      "/help - Mostra questo messaggio"
                                      )
                 print("[COMANDO] Start gestito, utente registrato.")
@@ -703,10 +1559,11 @@ class TelegramBot:
                     print("[GPT] Avvio generazione classica...")
                     config = load_config("medium")
                     start_time = time.time()
-                    response = generator(text, truncation=config['truncation'], max_length=config['max_length'],
-                                         temperature=config['temperature'], top_p=0.9,
-                                         num_return_sequences=config['num_return_sequences'],
-                                         max_new_tokens=config.get('max_new_token', 50))[0]['generated_text']
+                    response = esegui_su_modello('gpt', generator, text, truncation=config['truncation'], max_length=config['max_length'],
+                                                 temperature=config['temperature'], top_p=0.9,
+                                                 num_return_sequences=config['num_return_sequences'],
+                                                 max_new_tokens=config.get('max_new_token', 50),
+                                                 precision=config.get('gpt_precision', 'fp32'))[0]['generated_text']
                     generation_time = time.time() - start_time
                     print(f"[GPT] Testo generato: {response}")
                     self.bot.sendMessage(chat_id, response)
@@ -725,7 +1582,7 @@ class TelegramBot:
 
                     start_time = time.time()
                     try:
-                        response, contesto = genera_con_blocchi(text)
+                        response, contesto = esegui_su_modello('gpt', genera_con_blocchi, text)
                         generation_time = time.time() - start_time
 
 
@@ -764,7 +1621,7 @@ class TelegramBot:
                         self.bot.sendMessage(chat_id, f"📄 Contenuto Wikipedia:\n\n{content}")
                         self.bot.sendMessage("@IntelligenzaArtificialeITA", f"[Wikipedia] Contenuto Wikipedia: {content}")
 
-                        summary = summarize_text(content)
+                        summary = esegui_su_modello('mbart', summarize_text, content)
                         print(f"[Wikipedia] Contenuto AI: {summary}")
                         self.bot.sendMessage(chat_id, f"[Wikipedia] Contenuto AI: {summary}")
                         self.save_interaction(user_input=content, bot_response=summary, feedback="from_telegram", model_used="MBart", summary=summary)
@@ -775,7 +1632,7 @@ class TelegramBot:
                 elif mode == "testo_libero":
                     print("[MBART] Modalità Testo libero attiva...scrivi o incolla qel che vuoi.(max 1024 caratteri), 35 meglio XD")
                     content = text
-                    summary = summarize_text(content)
+                    summary = esegui_su_modello('mbart', summarize_text, content)
                     print(f"[MBART] Riassunto: {summary}")
                     self.bot.sendMessage(chat_id, f"🧾 Riassunto:\n\n{summary}")
                     self.save_interaction(user_input=content, bot_response=summary, feedback="from_telegram",
@@ -811,30 +1668,37 @@ class TelegramBot:
                 with open(local_path, 'wb') as f:
                     f.write(requests.get(file_url).content)
                 print(f"[PDF] File salvato in {local_path}")
+            except Exception as e:
+                self.bot.sendMessage(chat_id, f"❌ Errore durante il download:\n{str(e)}")
+                self.bot.sendMessage(chat_id, "/start - Riavvia il bot\n")
+                return
+
+            # Siamo già su un worker della coda: il polling continua a ricevere messaggi
+            self.analizza_pdf(chat_id, local_path, file_name)
+
 
+    def analizza_pdf(self, chat_id, local_path, file_name):
+        with app.app_context():
+            try:
                 start_time = time.time()
 
-                blocchi = extract_text_from_pdf_blocchi(local_path)
+                num_pagine = len(PdfReader(local_path).pages)
+                self.bot.sendMessage(chat_id, f"📚 PDF di {num_pagine} pagine (~{-(-num_pagine // 20)} blocchi da 20 pagine). Inizio analisi...")
+
+                def progresso(n_blocco, riassunto):
+                    self.bot.sendMessage(chat_id, f"🧠 Blocco {n_blocco} analizzato ({len(riassunto)} caratteri)")
+
+                blocchi, riassunti = riassumi_pdf_a_blocchi(local_path, on_progress=progresso)
                 if not blocchi:
                     self.bot.sendMessage(chat_id, "⚠️ Il PDF non contiene testo estraibile.")
                     return
 
-                self.bot.sendMessage(chat_id, f"📚 Trovati {len(blocchi)} blocchi da 20 pagine. Inizio analisi...")
-
-                riassunti_blocchi = []
-                for i, blocco in enumerate(blocchi):
-                    self.bot.sendMessage(chat_id, f"🧠 Analisi blocco {i + 1}/{len(blocchi)}...")
-                    riassunto = summarize_text(blocco)
-                    riassunti_blocchi.append(f"[Blocco {i + 1}]\n{riassunto}")
+                riassunti_blocchi = [f"[Blocco {i + 1}]\n{riassunto}" for i, riassunto in enumerate(riassunti)]
 
                 final_summary = "\n\n".join(riassunti_blocchi)
                 full_text = ' '.join(blocchi)
                 keywords = ', '.join(sorted(set(w for w in full_text.lower().split() if len(w) > 5))[:10])
 
-                # Blocchi salvati come testo unico
-                block_texts = "\n\n".join([f"[Blocco {i + 1}]\n{blocchi[i]}" for i in range(len(blocchi))])
-                block_summaries = "\n\n".join(riassunti_blocchi)
-
                 elapsed = round(time.time() - start_time, 2)
 
                 # ✅ Salvataggio nel DB
@@ -842,8 +1706,6 @@ class TelegramBot:
                     filename=file_name,
                     full_text=full_text,
                     summary=final_summary,
-                    block_texts=block_texts,
-                    block_summaries=block_summaries,
                     keywords=keywords,
                     num_blocks=len(blocchi),
                     processing_time=elapsed
@@ -864,8 +1726,10 @@ class TelegramBot:
                     "processing_time": elapsed,
                     "keywords": keywords,
                     "num_blocks": len(blocchi),
-                    "block_texts": block_texts,
-                    "block_summaries": block_summaries,
+                    "blocks": [
+                        {"block_index": i + 1, "block_text": blocco, "block_summary": riassunto}
+                        for i, (blocco, riassunto) in enumerate(zip(blocchi, riassunti))
+                    ],
                     "full_text": full_text,
                     "final_summary": final_summary
                 }
@@ -892,6 +1756,32 @@ class TelegramBot:
                 self.bot.sendMessage(chat_id, "/start - Riavvia il bot\n")
 
 
+    def accoda(self, msg):
+        chat_id = msg['chat']['id']
+        # /status risponde subito dal thread di polling, senza aspettare la coda della chat
+        if msg.get('text', '').strip().lower() == '/status':
+            self.invia_stato(chat_id)
+            return
+        if not self.jobs.submit(chat_id, msg):
+            logging.warning(f"[JOB] Coda piena, messaggio della chat {chat_id} rifiutato")
+            self.bot.sendMessage(chat_id, "⏳ Sono pieno di richieste, riprova tra qualche minuto.")
+
+    def invia_stato(self, chat_id):
+        stato = self.jobs.stato()
+        cache = summary_cache.stats()
+        modelli = "\n".join(
+            f"  - {nome}: {stato['modelli'].get(nome.split('@')[0], 0)} in coda, "
+            + (f"caricato ({info['memory_mb']} MB, {info['load_time_s']}s)" if info['loaded'] else "non caricato")
+            for nome, info in models.stats().items()
+        )
+        self.bot.sendMessage(chat_id,
+                             f"📊 Stato coda\n"
+                             f"In attesa/in corso: {stato['pendenti']}/{stato['max_pendenti']}\n"
+                             f"In elaborazione: {stato['in_corso']} su {stato['workers']} worker\n"
+                             f"Chat attive: {stato['chat_attive']}\n"
+                             f"Cache riassunti: {cache['hits']} hit / {cache['misses']} miss\n"
+                             f"Modelli:\n{modelli}")
+
     def run_loop(self):
         def loop():
             print("[LOOP] Avvio polling diretto blindato...")
@@ -904,7 +1794,7 @@ class TelegramBot:
 
                         if 'message' in update or 'channel_post' in update:
                             msg = update.get('message') or update.get('channel_post')
-                            self.handle_message(msg)
+                            self.accoda(msg)
 
                         elif 'my_chat_member' in update:
                             print("[INFO] Ignorato my_chat_member (cambio ruolo bot)")
@@ -922,11 +1812,14 @@ class TelegramBot:
     def run(self, token):
         self.token = token
         self.bot = telepot.Bot(token)
+        self.jobs.start()
         self.run_loop()
         print("🤖 Bot in ascolto (modalità polling manuale)...")
         logging.info("Bot Telegram avviato e in ascolto...")
         while True:
             time.sleep(5)
+            if MODEL_IDLE_UNLOAD_S:
+                models.unload_idle(MODEL_IDLE_UNLOAD_S)
 
 
 ###DB MAGAGE db_manage()
@@ -936,6 +1829,61 @@ import shutil
 from datetime import datetime
 
 
+def aggiorna_schema():
+    """create_all() non modifica tabelle esistenti: aggiunge le colonne nuove di Block e collega i blocchi vecchi."""
+    db.create_all()
+    colonne = {riga[1] for riga in db.session.execute(db.text("PRAGMA table_info(block)"))}
+    for nome, tipo in (('document_id', 'INTEGER REFERENCES document(id)'),
+                       ('start_offset', 'INTEGER'),
+                       ('end_offset', 'INTEGER')):
+        if nome not in colonne:
+            db.session.execute(db.text(f"ALTER TABLE block ADD COLUMN {nome} {tipo}"))
+            print(f"[DB] Aggiunta colonna block.{nome}")
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_block_document_id ON block (document_id)"))
+
+    # Blocchi importati prima della FK: stesso filename del documento
+    db.session.execute(db.text(
+        "UPDATE block SET document_id = "
+        "(SELECT MAX(document.id) FROM document WHERE document.filename = block.filename) "
+        "WHERE document_id IS NULL"
+    ))
+    db.session.commit()
+
+
+def db_normalize():
+    """Svuota block_texts/block_summaries dei documenti che hanno già i Block collegati e compatta il DB."""
+    aggiorna_schema()
+    risultato = db.session.execute(db.text(
+        "UPDATE document SET block_texts = NULL, block_summaries = NULL "
+        "WHERE (block_texts IS NOT NULL OR block_summaries IS NOT NULL) "
+        "AND id IN (SELECT DISTINCT document_id FROM block WHERE document_id IS NOT NULL)"
+    ))
+    db.session.commit()
+    print(f"[DB] Testi concatenati rimossi da {risultato.rowcount} documenti")
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(db.text("VACUUM"))
+    print("[DB] VACUUM completato")
+
+
+def scrivi_documento(documento, righe, json_name=None, commit=True):
+    """Document e tutti i suoi Block in un'unica transazione (executemany per i blocchi).
+    Con json_name registra anche il file in ImportedFile, nella stessa transazione."""
+    adesso = datetime.utcnow()
+    doc = Document(created_at=adesso, **documento)
+    db.session.add(doc)
+    db.session.flush()  # Serve l'id per la FK dei blocchi
+
+    for riga in righe:
+        riga['document_id'] = doc.id
+        riga['created_at'] = adesso
+    db.session.bulk_insert_mappings(Block, righe)
+    if json_name:
+        db.session.add(ImportedFile(json_name=json_name, document_id=doc.id, imported_at=adesso))
+    if commit:
+        db.session.commit()
+    return doc
+
+
 def db_manage_import_json():
     base_path = os.path.join("training_data", "Telegram")
     ok_path = os.path.join(base_path, "OK")
@@ -962,55 +1910,219 @@ def db_manage_import_json():
         for file in json_files:
             json_path = os.path.join(base_path, file)
             try:
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                doc = Document(
-                    filename=data.get("filename", file),
-                    full_text=data.get("full_text", ""),
-                    summary=data.get("final_summary", ""),
-                    block_texts=data.get("block_texts", ""),
-                    block_summaries=data.get("block_summaries", ""),
-                    keywords=data.get("keywords", ""),
-                    num_blocks=data.get("num_blocks", 0),
-                    processing_time=data.get("processing_time", 0.0),
-                    created_at=datetime.utcnow()
-                )
-                db.session.add(doc)
-                db.session.commit()
-
-                blocchi_testo = data.get("block_texts", "")
-                blocchi_riassunto = data.get("block_summaries", "")
-                filename = data.get("filename", file)
-                keywords = data.get("keywords", "")
-
-                # parsing blocchi da stringa
-                blocchi_testo_split = blocchi_testo.split("[Blocco ")[1:]
-                blocchi_riassunto_split = blocchi_riassunto.split("[Blocco ")[1:]
-
-                for i in range(len(blocchi_testo_split)):
-                    testo_raw = blocchi_testo_split[i].split("\n", 1)[-1].strip()
-                    summary_raw = blocchi_riassunto_split[i].split("\n", 1)[-1].strip() if i < len(blocchi_riassunto_split) else ""
-
-                    blocco = Block(
-                        filename=filename,
-                        block_index=i + 1,
-                        block_text=testo_raw,
-                        block_summary=summary_raw,
-                        keywords=keywords,
-                        created_at=datetime.utcnow()
-                    )
-                    db.session.add(blocco)
-
-                db.session.commit()
+                documento, righe = lavori_pool.prepara_documento_json(json_path)
+                scrivi_documento(documento, righe, json_name=file)
 
                 # Sposta nella cartella OK
                 shutil.move(json_path, os.path.join(ok_path, os.path.basename(json_path)))
-                print(f"✅ Importato e spostato: {file}")
+                print(f"✅ Importato e spostato: {file} ({len(righe)} blocchi)")
 
             except Exception as e:
+                db.session.rollback()
                 print(f"❌ Errore nel file {file}: {str(e)}")
 
+        # Aggiorna l'indice TF-IDF con i blocchi nuovi
+        block_index.sync()
+
+
+IMPORT_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # Processi che leggono e preparano i JSON
+IMPORT_BATCH_FILES = 50  # File scritti per transazione
+IMPORT_IN_FLIGHT_PER_WORKER = 2  # File in lettura/attesa per processo: la memoria non cresce col numero di file
+
+
+def _pragma_import(dbapi_connection, connection_record):
+    # Su ogni connessione del pool, non solo su quella della sessione corrente
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")  # Con WAL basta e riduce gli fsync
+    cursor.close()
+
+
+def _scrivi_lotto(lotto, ok_path):
+    """Scrive un lotto di file in una transazione; se fallisce riprova file per file. Ritorna i file riusciti."""
+    try:
+        for json_path, documento, righe in lotto:
+            scrivi_documento(documento, righe, json_name=os.path.basename(json_path), commit=False)
+        db.session.commit()
+        riusciti = lotto
+    except Exception as e:
+        db.session.rollback()
+        print(f"[IMPORT] Lotto fallito ({e}), riprovo un file alla volta")
+        riusciti = []
+        for json_path, documento, righe in lotto:
+            try:
+                scrivi_documento(documento, righe, json_name=os.path.basename(json_path))
+                riusciti.append((json_path, documento, righe))
+            except Exception as e:
+                db.session.rollback()
+                print(f"❌ Errore nel file {os.path.basename(json_path)}: {e}")
+
+    # Spostati solo dopo il commit: se il processo muore qui, al riavvio ImportedFile li riconosce
+    for json_path, _, _ in riusciti:
+        shutil.move(json_path, os.path.join(ok_path, os.path.basename(json_path)))
+    return riusciti
+
+
+def db_import_bulk(workers=None, batch_files=None):
+    """Import non interattivo di tutti i JSON in training_data/Telegram.
+    I file vengono letti in un pool di processi, scritti da un solo writer a lotti e in WAL;
+    i file già registrati in ImportedFile (crash dopo il commit) vengono solo spostati in OK."""
+    workers = workers or IMPORT_WORKERS
+    batch_files = batch_files or IMPORT_BATCH_FILES
+    base_path = os.path.join("training_data", "Telegram")
+    ok_path = os.path.join(base_path, "OK")
+    os.makedirs(ok_path, exist_ok=True)
+
+    json_files = sorted(f for f in os.listdir(base_path) if f.endswith(".json"))
+    gia_importati = {nome for (nome,) in db.session.query(ImportedFile.json_name)}
+    for file in json_files:
+        if file in gia_importati:
+            shutil.move(os.path.join(base_path, file), os.path.join(ok_path, file))
+            print(f"[IMPORT] {file} già nel DB, spostato in OK")
+    da_importare = [os.path.join(base_path, f) for f in json_files if f not in gia_importati]
+
+    print(f"[IMPORT] {len(da_importare)} file da importare ({workers} processi, lotti da {batch_files})")
+    if not da_importare:
+        return
+
+    # WAL resta attivo sul file del DB; le connessioni già nel pool vengono riaperte con i PRAGMA
+    db.session.remove()
+    db.event.listen(db.engine, 'connect', _pragma_import)
+    db.engine.dispose()
+
+    inizio = time.time()
+    n_file = n_blocchi = n_errori = 0
+    lotto = []
+
+    def svuota_lotto():
+        nonlocal n_file, n_blocchi
+        riusciti = _scrivi_lotto(lotto, ok_path)
+        n_file += len(riusciti)
+        n_blocchi += sum(len(righe) for _, _, righe in riusciti)
+        lotto.clear()
+        elapsed = max(time.time() - inizio, 1e-6)
+        print(f"[IMPORT] {n_file}/{len(da_importare)} file, {n_blocchi} blocchi "
+              f"({n_file / elapsed:.1f} file/s, {n_blocchi / elapsed:.1f} blocchi/s)")
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # Finestra limitata di file inviati al pool: un nuovo file parte solo quando uno è stato
+            # consumato, così i risultati non si accumulano se il writer è più lento dei lettori
+            da_inviare = iter(da_importare)
+            in_corso = deque()
+            for json_path in da_inviare:
+                in_corso.append(lavori_pool.submit(pool, lavori_pool.prepara_per_import, json_path))
+                if len(in_corso) >= workers * IMPORT_IN_FLIGHT_PER_WORKER:
+                    break
+            while in_corso:
+                json_path, documento, righe, errore = in_corso.popleft().result()
+                prossimo = next(da_inviare, None)
+                if prossimo is not None:
+                    in_corso.append(lavori_pool.submit(pool, lavori_pool.prepara_per_import, prossimo))
+                if errore:
+                    n_errori += 1
+                    print(f"❌ Errore nel file {os.path.basename(json_path)}: {errore}")
+                    continue
+                lotto.append((json_path, documento, righe))
+                if len(lotto) >= batch_files:
+                    svuota_lotto()
+        if lotto:
+            svuota_lotto()
+    finally:
+        db.event.remove(db.engine, 'connect', _pragma_import)
+
+    elapsed = max(time.time() - inizio, 1e-6)
+    print(f"✅ Import completato in {elapsed:.1f}s: {n_file} file, {n_blocchi} blocchi, {n_errori} errori "
+          f"({n_file / elapsed:.1f} file/s, {n_blocchi / elapsed:.1f} blocchi/s)")
+
+    # Aggiorna l'indice TF-IDF con i blocchi nuovi
+    block_index.sync()
+
+
+
+
+###BENCHMARK PRECISIONI benchmark_precision
+
+BENCHMARK_TESTI = [
+    "La Repubblica di Venezia fu per oltre mille anni una delle principali potenze commerciali del Mediterraneo. "
+    "Il suo governo era guidato dal Doge, eletto a vita, e da un complesso sistema di consigli che limitava il potere "
+    "delle singole famiglie. La flotta veneziana controllava le rotte verso Costantinopoli e il Levante, e l'Arsenale "
+    "era in grado di costruire una galea in un solo giorno.",
+    "La fotosintesi clorofilliana è il processo con cui le piante, le alghe e alcuni batteri convertono l'energia "
+    "luminosa in energia chimica. Nelle foglie l'anidride carbonica e l'acqua vengono trasformate in glucosio e "
+    "ossigeno grazie alla clorofilla, che assorbe soprattutto la luce rossa e blu.",
+    "Il motore a combustione interna trasforma l'energia chimica del carburante in lavoro meccanico. Nel ciclo a "
+    "quattro tempi si susseguono aspirazione, compressione, scoppio e scarico; la posizione del pistone è legata "
+    "all'albero motore tramite la biella, e la distribuzione regola l'apertura delle valvole.",
+]
+
+
+def _rouge_l_f1(candidato, riferimento):
+    # ROUGE-L sulle parole: F1 della sottosequenza comune più lunga
+    a, b = candidato.lower().split(), riferimento.lower().split()
+    if not a or not b:
+        return 0.0
+    precedente = [0] * (len(b) + 1)
+    for parola in a:
+        corrente = [0]
+        for j, altra in enumerate(b):
+            corrente.append(precedente[j] + 1 if parola == altra else max(precedente[j + 1], corrente[j]))
+        precedente = corrente
+    lcs = precedente[-1]
+    if lcs == 0:
+        return 0.0
+    precisione, richiamo = lcs / len(a), lcs / len(b)
+    return 2 * precisione * richiamo / (precisione + richiamo)
+
+
+def benchmark_precisioni(precisioni=('fp16', 'bf16', 'int8')):
+    """Latenza e qualità (ROUGE-L rispetto all'uscita fp32) su BENCHMARK_TESTI.
+
+    GPT usa decoding greedy per avere uscite confrontabili tra precisioni.
+    """
+    compiti = {
+        'mbart': lambda testo, precision: summarize_texts([testo], precision=precision, use_cache=False)[0],
+        'gpt': lambda testo, precision: generator(testo, do_sample=False, max_new_tokens=60,
+                                                  precision=precision)[0]['generated_text'][len(testo):],
+    }
+    risultati = []
+    for nome, compito in compiti.items():
+        riferimenti, latenze_fp32 = [], []
+        for precision in ('fp32',) + tuple(precisioni):
+            caricato = models.get(nome, precision)  # Il caricamento non entra nella latenza
+            effettiva = _precisione_effettiva(caricato, precision)
+            latenze, punteggi = [], []
+            for i, testo in enumerate(BENCHMARK_TESTI):
+                start_time = time.time()
+                uscita = compito(testo, precision)
+                latenze.append(time.time() - start_time)
+                if precision == 'fp32':
+                    riferimenti.append(uscita)
+                punteggi.append(_rouge_l_f1(uscita, riferimenti[i]))
+            if precision == 'fp32':
+                latenze_fp32 = latenze
+            media = sum(latenze) / len(latenze)
+            media_fp32 = sum(latenze_fp32) / len(latenze_fp32)
+            risultati.append({
+                'modello': nome,
+                'precision': precision,
+                'precision_effettiva': effettiva,  # Diversa se il device ha fatto fallback (es. fp16 -> bf16 su CPU)
+                'latenza_media_s': round(media, 3),
+                'speedup_vs_fp32': round(media_fp32 / media, 2) if media else None,
+                'rouge_l_vs_fp32': round(sum(punteggi) / len(punteggi), 3),
+                'memory_mb': models.stats()[models.chiave(nome, precision)]['memory_mb'],
+            })
+            if precision != 'fp32':
+                models.unload(models.chiave(nome, precision))
+        models.unload(nome)
+
+    print(f"\n{'modello':<8}{'precision':<11}{'effettiva':<11}{'latenza (s)':>12}{'speedup':>9}{'ROUGE-L':>9}{'MB':>9}")
+    for r in risultati:
+        print(f"{r['modello']:<8}{r['precision']:<11}{r['precision_effettiva']:<11}{r['latenza_media_s']:>12}"
+              f"{r['speedup_vs_fp32']:>9}{r['rouge_l_vs_fp32']:>9}{r['memory_mb']:>9}")
+    return risultati
+
 
 
 
@@ -1022,6 +2134,11 @@ if __name__ == '__main__':
 
     mode = sys.argv[1].lower()
 
+    # In tutti i modi, flask e telegram compresi: su un DB esistente Block.query (ricerca, BlockIndex)
+    # legge document_id/start_offset/end_offset e fallirebbe con "no such column"
+    with app.app_context():
+        aggiorna_schema()
+
     if mode == "flask":
         run_flask()
 
@@ -1033,9 +2150,25 @@ if __name__ == '__main__':
 
     elif mode == "db_manage":
         with app.app_context():
-            db.create_all()  # <-- crea tabelle se non esistono
             db_manage_import_json()
 
+    elif mode == "db_import":
+        # Es. python app5.py db_import 8 100  (processi, file per transazione)
+        with app.app_context():
+            db_import_bulk(*(int(a) for a in sys.argv[2:4]))
+
+    elif mode == "db_normalize":
+        with app.app_context():
+            db_normalize()
+
+    elif mode == "benchmark_precision":
+        # Es. python app5.py benchmark_precision int8 bf16
+        benchmark_precisioni(tuple(sys.argv[2:]) or ('fp16', 'bf16', 'int8'))
+
+    elif mode == "db_reindex":
+        with app.app_context():
+            block_index.build()  # Ricostruisce da zero DATA/block_index.pkl
+
 
     else:
         print("❌ Argomento non valido. Usa 'flask' o 'telegram'.")
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""Funzioni eseguite nei processi dei pool di app5 (pagine dei PDF, JSON da importare).
+
+Con il contesto 'spawn' ogni processo nuovo importa il __main__ del padre: con app5 vuol dire
+torch, transformers, sklearn, Flask e telepot, centinaia di MB e qualche secondo per processo.
+Questo modulo importa solo quello che serve al lavoro, e submit() fa partire i processi
+con lui come __main__.
+"""
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+from pypdf import PdfReader
+
+_main_lock = threading.Lock()
+
+
+@contextmanager
+def _main_leggero():
+    # I processi 'spawn' nascono dentro pool.submit e reimportano sys.modules['__main__']:
+    # per quel momento il main è questo modulo (lock: più thread possono fare submit insieme)
+    with _main_lock:
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = sys.modules[__name__]
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main
+
+
+def submit(pool, fn, *args):
+    """pool.submit(fn, *args), ma un processo avviato qui non importa app5"""
+    with _main_leggero():
+        return pool.submit(fn, *args)
+
+
+def estrai_pagine(pdf_path, start, end):
+    # Ogni processo apre il PDF per conto suo
+    reader = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text() or '' for i in range(start, end)]
+
+
+def _blocchi_formato_vecchio(data):
+    # JSON esportati prima dei "blocks": testi e riassunti concatenati con separatori [Blocco N]
+    blocchi_testo_split = data.get("block_texts", "").split("[Blocco ")[1:]
+    blocchi_riassunto_split = data.get("block_summaries", "").split("[Blocco ")[1:]
+    blocchi = []
+    for i in range(len(blocchi_testo_split)):
+        testo_raw = blocchi_testo_split[i].split("\n", 1)[-1].strip()
+        summary_raw = blocchi_riassunto_split[i].split("\n", 1)[-1].strip() if i < len(blocchi_riassunto_split) else ""
+        blocchi.append((testo_raw, summary_raw))
+    return blocchi
+
+
+def prepara_documento_json(json_path):
+    """Converte un JSON esportato dal bot in (campi Document, righe Block). Non tocca il DB."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    filename = data.get("filename", os.path.basename(json_path))
+    keywords = data.get("keywords", "")
+    full_text = data.get("full_text", "")
+
+    if "blocks" in data:
+        blocchi = [(b.get("block_text", ""), b.get("block_summary", "")) for b in data["blocks"]]
+    else:
+        blocchi = _blocchi_formato_vecchio(data)
+
+    righe = []
+    posizione = 0
+    for i, (testo, riassunto) in enumerate(blocchi):
+        # I blocchi compaiono in ordine dentro full_text: la ricerca riparte dalla fine del precedente
+        start = full_text.find(testo, posizione) if testo else -1
+        if start >= 0:
+            end = start + len(testo)
+            posizione = end
+        else:
+            start = end = None
+        righe.append({
+            'filename': filename,
+            'block_index': i + 1,
+            'block_text': testo,
+            'block_summary': riassunto,
+            'keywords': keywords,
+            'start_offset': start,
+            'end_offset': end,
+        })
+
+    documento = {
+        'filename': filename,
+        'full_text': full_text,
+        'summary': data.get("final_summary", ""),
+        'keywords': keywords,
+        'num_blocks': data.get("num_blocks", len(righe)),
+        'processing_time': data.get("processing_time", 0.0),
+    }
+    return documento, righe
+
+
+def prepara_per_import(json_path):
+    # Gira nei processi del pool: l'errore torna come valore così un file rotto non ferma gli altri
+    try:
+        documento, righe = prepara_documento_json(json_path)
+        return json_path, documento, righe, None
+    except Exception as e:
+        return json_path, None, None, f"{type(e).__name__}: {e}"
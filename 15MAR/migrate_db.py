@@ -1,6 +1,6 @@
-from app5 import app, db
+from app5 import app, db, aggiorna_schema
 
 with app.app_context():
-    db.create_all()
+    aggiorna_schema()
     print("✅ Database creato o aggiornato con successo.")
     print("✅ APP5.")
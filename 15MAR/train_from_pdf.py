@@ -11,14 +11,16 @@ OUTPUT_DIR = "model_finetuned"
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def extract_text_from_pdf(pdf_path):
+def iter_pages_text(pdf_path):
     reader = PdfReader(pdf_path)
-    text = ''
     for page in reader.pages:
         page_text = page.extract_text()
         if page_text:
-            text += page_text + ' '
-    return text
+            yield page_text
+
+
+def extract_text_from_pdf(pdf_path):
+    return ' '.join(iter_pages_text(pdf_path))
 
 
 def load_all_texts_from_pdfs(directory):
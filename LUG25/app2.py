@@ -1,15 +1,31 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, \
+    stream_with_context, g, has_app_context
 import json
 import os
+import re
+import base64
+import socket
 import hashlib
 import uuid
+import sys
 import time
+import random
+import secrets
+import shutil
+import tempfile
 import threading
 import queue
+import atexit
+from collections import namedtuple, deque, Counter
+from contextlib import contextmanager
+from io import BytesIO
 import jwt
 from datetime import datetime, timedelta
 from decimal import Decimal
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, create_engine
+from markupsafe import escape
 from flask_login import LoginManager, login_user, logout_user, login_required, UserMixin, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
@@ -46,6 +62,90 @@ login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
 
+# =============================================================================
+# QUERY BUDGET (rilevatore N+1)
+# =============================================================================
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def _statement_shape(statement):
+    """Forma della query: spazi compattati e liste IN (?, ?, ...) ridotte, così i lazy load per riga si raggruppano"""
+    shape = ' '.join(statement.split())
+    return re.sub(r'\(\?(?:, \?)+\)', '(?...)', shape)
+
+
+class QueryCounter:
+    """Conta le query SQL eseguite dentro il blocco with dal thread che lo apre
+    (il test client esegue la richiesta nello stesso thread; i flush in background non contano).
+
+        with QueryCounter('GET /projects', budget=6) as counter:
+            client.get('/projects')
+
+    All'uscita solleva QueryBudgetExceeded se le query superano budget o se una
+    stessa forma si ripete più di max_repeats volte; il messaggio è report()."""
+
+    def __init__(self, label='', budget=None, max_repeats=None):
+        self.label = label
+        self.budget = budget
+        self.max_repeats = max_repeats
+        self.statements = []
+        self.thread_id = None
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread_id:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        db.event.listen(Engine, 'after_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        db.event.remove(Engine, 'after_cursor_execute', self._record)
+        if exc_type is None and not self.within_budget():
+            raise QueryBudgetExceeded(self.report())
+        return False
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def repeated(self):
+        """[(forma, volte)] delle query eseguite più di una volta, le più ripetute prima"""
+        return [(shape, times) for shape, times in Counter(map(_statement_shape, self.statements)).most_common()
+                if times > 1]
+
+    def within_budget(self):
+        if self.budget is not None and self.count > self.budget:
+            return False
+        repeated = self.repeated()
+        return self.max_repeats is None or not repeated or repeated[0][1] <= self.max_repeats
+
+    def report(self):
+        budget = f" (budget {self.budget})" if self.budget is not None else ''
+        lines = [f"{self.label}: {self.count} query{budget}"]
+        for shape, times in self.repeated():
+            lines.append(f"  {times}x  {shape[:200]}")
+        return '\n'.join(lines)
+
+
+def query_budget(max_queries, max_repeats=None, method=None):
+    """Dichiara quante query può fare una route (o funzione); lo verifica check_query_budgets().
+    Con method vale solo per quel metodo (il POST di una route GET/POST), senza per tutti.
+    Va bene sopra o sotto @login_required: wraps copia l'attributo."""
+    def decorator(f):
+        f.query_budget = {**getattr(f, 'query_budget', {}), method: (max_queries, max_repeats)}
+        return f
+    return decorator
+
+
+def _budget_for(view, method):
+    budgets = getattr(view, 'query_budget', {})
+    return budgets.get(method, budgets.get(None))
+
+
 # =============================================================================
 # DATABASE MODELS
 # =============================================================================
@@ -108,15 +208,26 @@ class SharedKnowledge(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_approved = db.Column(db.Boolean, default=False)  # Manager approval
 
+    @staticmethod
+    def tokenize(text):
+        """Parole usate per il matching (stessa regola di similarity_score)"""
+        return set(text.lower().split())
+
     def similarity_score(self, query):
         """Calcolo similarità semplice (per matching veloce)"""
-        q_words = set(query.lower().split())
-        k_words = set(self.question.lower().split())
+        q_words = SharedKnowledge.tokenize(query)
+        k_words = SharedKnowledge.tokenize(self.question)
         if not q_words or not k_words:
             return 0
         return len(q_words & k_words) / len(q_words | k_words)
 
 class Transaction(db.Model):
+    # Storico wallet: paginazione keyset su (timestamp, id) per wallet in entrata e in uscita
+    __table_args__ = (
+        db.Index('ix_transaction_to_wallet_timestamp', 'to_wallet', 'timestamp', 'id'),
+        db.Index('ix_transaction_from_wallet_timestamp', 'from_wallet', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     tx_hash = db.Column(db.String(64), unique=True, nullable=False)
     from_wallet = db.Column(db.String(200), nullable=True)
@@ -140,6 +251,34 @@ class MiningSession(db.Model):
     started_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class BlockchainStats(db.Model):
+    """Riga unica (id=1) con i totali di /api/stats/blockchain, aggiornata nella stessa transazione delle scritture"""
+    id = db.Column(db.Integer, primary_key=True)
+    total_users = db.Column(db.Integer, nullable=False, default=0)
+    total_transactions = db.Column(db.Integer, nullable=False, default=0)
+    total_supply_distributed = db.Column(db.Float, nullable=False, default=0.0)
+    active_miners = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ChainState(db.Model):
+    """Riga unica (id=1) con lo stato della chain condiviso da tutti i worker gunicorn (e host sullo stesso DB)"""
+    id = db.Column(db.Integer, primary_key=True)
+    block_height = db.Column(db.Integer, nullable=False)
+    pool_active = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class PoolGpu(db.Model):
+    """Registro GPU del mining pool: una riga per GPU, last_seen rinnovato a ogni connect_gpu"""
+    id = db.Column(db.Integer, primary_key=True)
+    gpu_id = db.Column(db.String(100), unique=True, nullable=False)
+    hashrate = db.Column(db.Float, nullable=False, default=0.0)
+    status = db.Column(db.String(20), default='mining')
+    worker = db.Column(db.String(100))  # host:pid che l'ha registrata
+    connected_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
 class Block(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     block_height = db.Column(db.Integer, unique=True, nullable=False)
@@ -219,47 +358,253 @@ class FileShare(db.Model):
 # BLOCKCHAIN SYSTEM
 # =============================================================================
 
+GENESIS_BLOCK_HEIGHT = 1337
+POOL_GPU_TIMEOUT_SECONDS = 120  # GPU senza heartbeat da più di così non contano nel pool
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def ensure_chain_state():
+    """Crea la riga ChainState se manca (più worker all'avvio: vince il primo, gli altri la trovano)"""
+    db.session.execute(sqlite_insert(ChainState.__table__).values(
+        id=1, block_height=GENESIS_BLOCK_HEIGHT, pool_active=False, updated_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=['id']))
+    db.session.commit()
+
+
 class RTX3060MiningPool:
-    """Simulatore mining pool RTX 3060 con websocket (per ora disattivato)"""
+    """Simulatore mining pool RTX 3060 con websocket (per ora disattivato).
+
+    Stato attivo/spento e GPU connesse stanno nel DB (ChainState, PoolGpu):
+    ogni worker legge gli stessi valori e il toggle vale per tutti."""
 
     def __init__(self):
-        self.is_active = False  # Mining pool spento per ora
-        self.connected_gpus = []
-        self.total_hashrate = 0.0
         self.processing_queue = queue.Queue()
         self.websocket_enabled = False  # Flag per connessione websocket
 
+    @property
+    def is_active(self):
+        return bool(db.session.execute(
+            db.select(ChainState.pool_active).where(ChainState.id == 1)
+        ).scalar())
+
+    def _set_active(self, active):
+        db.session.execute(db.update(ChainState).where(ChainState.id == 1)
+                           .values(pool_active=active, updated_at=datetime.utcnow()))
+        db.session.commit()
+
+    def _alive(self):
+        return PoolGpu.last_seen >= datetime.utcnow() - timedelta(seconds=POOL_GPU_TIMEOUT_SECONDS)
+
+    @property
+    def connected_gpus(self):
+        gpus = PoolGpu.query.filter(self._alive()).order_by(PoolGpu.connected_at).all()
+        return [{
+            'id': gpu.gpu_id,
+            'hashrate': gpu.hashrate,
+            'status': gpu.status,
+            'connected_at': gpu.connected_at,
+            'worker': gpu.worker
+        } for gpu in gpus]
+
+    @property
+    def total_hashrate(self):
+        return self.calculate_total_hashrate()
+
     def connect_gpu(self, gpu_id, hashrate):
-        """Connette una GPU al pool"""
+        """Connette una GPU al pool (o rinnova il suo heartbeat)"""
         if self.is_active:
-            self.connected_gpus.append({
-                'id': gpu_id,
-                'hashrate': hashrate,
-                'status': 'mining',
-                'connected_at': datetime.now()
-            })
-            self.calculate_total_hashrate()
+            now = datetime.utcnow()
+            stmt = sqlite_insert(PoolGpu.__table__).values(
+                gpu_id=str(gpu_id), hashrate=hashrate, status='mining',
+                worker=WORKER_ID, connected_at=now, last_seen=now
+            )
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['gpu_id'],
+                set_={'hashrate': stmt.excluded.hashrate, 'status': 'mining',
+                      'worker': stmt.excluded.worker, 'last_seen': stmt.excluded.last_seen}
+            ))
+            db.session.commit()
+
+    def disconnect_gpu(self, gpu_id):
+        """Rimuove una GPU dal pool"""
+        PoolGpu.query.filter_by(gpu_id=str(gpu_id)).delete()
+        db.session.commit()
 
     def calculate_total_hashrate(self):
-        """Calcola hashrate totale del pool"""
-        self.total_hashrate = sum(gpu['hashrate'] for gpu in self.connected_gpus)
+        """Calcola hashrate totale del pool (GPU vive)"""
+        return db.session.execute(
+            db.select(db.func.coalesce(db.func.sum(PoolGpu.hashrate), 0.0)).where(self._alive())
+        ).scalar()
 
     def start_mining(self):
         """Avvia il mining pool (per ora simulato)"""
-        self.is_active = True
+        self._set_active(True)
         print("RTX3060 Mining Pool: ATTIVATO (modalità simulazione)")
 
     def stop_mining(self):
         """Ferma il mining pool"""
-        self.is_active = False
+        self._set_active(False)
         print("RTX3060 Mining Pool: DISATTIVATO")
 
 
+def bump_blockchain_stats(executor, users=0, transactions=0, supply=0.0, miners=0):
+    """Incrementi atomici della riga BlockchainStats; executor = db.session o la connection di un evento"""
+    stats = BlockchainStats.__table__
+    executor.execute(stats.update().where(stats.c.id == 1).values(
+        total_users=stats.c.total_users + users,
+        total_transactions=stats.c.total_transactions + transactions,
+        total_supply_distributed=stats.c.total_supply_distributed + supply,
+        active_miners=stats.c.active_miners + miners,
+    ))
+
+
+def rebuild_blockchain_stats():
+    """Ricalcola i totali con le query complete (all'avvio se la riga manca, o per riallinearla)"""
+    values = dict(
+        total_users=User.query.count(),
+        total_transactions=Transaction.query.count(),
+        total_supply_distributed=db.session.query(db.func.sum(User.total_earned)).scalar() or 0.0,
+        active_miners=MiningSession.query.filter_by(is_active=True).count(),
+    )
+    row = db.session.get(BlockchainStats, 1)
+    if row is None:
+        db.session.add(BlockchainStats(id=1, **values))
+    else:
+        for key, value in values.items():
+            setattr(row, key, value)
+    db.session.commit()
+    blockchain_stats_cache.clear()
+
+
+# Inserimenti e cancellazioni via ORM: l'evento gira dentro la stessa transazione
+@db.event.listens_for(User, 'after_insert')
+def _stats_user_insert(mapper, connection, target):
+    bump_blockchain_stats(connection, users=1)
+
+
+@db.event.listens_for(User, 'after_delete')
+def _stats_user_delete(mapper, connection, target):
+    bump_blockchain_stats(connection, users=-1)
+
+
+@db.event.listens_for(Transaction, 'after_insert')
+def _stats_transaction_insert(mapper, connection, target):
+    bump_blockchain_stats(connection, transactions=1)
+
+
+def _recount_active_miners(mapper, connection, target):
+    # Il valore precedente di is_active spesso non è caricato (oggetto scaduto dopo il commit):
+    # le sessioni di mining cambiano di rado, quindi si riconta dentro la stessa transazione
+    stats = BlockchainStats.__table__
+    sessions = MiningSession.__table__
+    active = db.select(db.func.count()).select_from(sessions).where(sessions.c.is_active.is_(True)).scalar_subquery()
+    connection.execute(stats.update().where(stats.c.id == 1).values(active_miners=active))
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    db.event.listen(MiningSession, _event, _recount_active_miners)
+
+
+REWARD_WRITE_BEHIND = True  # False = ogni ricompensa scritta subito nella transazione della richiesta
+REWARD_BATCH_SIZE = 200  # Ricompense in coda che fanno partire subito il flush
+REWARD_FLUSH_SECONDS = 2.0  # Flush periodico anche con la coda piccola
+
+
+class RewardLedger:
+    """Coda in memoria delle ricompense ADG, scritta a lotti da un thread in background.
+    Ogni worker ha la sua coda: un flush scrive solo le ricompense di questo processo.
+
+    Ogni flush è una sola transazione: tutte le Transaction in executemany e un
+    UPDATE user SET balance = balance + ? per utente, così i saldi restano giusti
+    anche con più worker che scrivono insieme."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.flushed_total = 0
+
+    def add(self, entry):
+        request_metrics.note_ledger_write()
+        with self.lock:
+            self.pending.append(entry)
+            size = len(self.pending)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='reward-ledger')
+                self.thread.start()
+        if size >= REWARD_BATCH_SIZE:
+            self.wakeup.set()
+
+    def pending_for(self, user_id):
+        """ADG in coda per un utente (non ancora nel balance del DB)"""
+        with self.lock:
+            return sum(e['amount'] for e in self.pending if e['user_id'] == user_id)
+
+    def flush(self):
+        """Scrive tutto quello che è in coda; ritorna il numero di ricompense scritte"""
+        with self.flush_lock:
+            with self.lock:
+                entries, self.pending = self.pending, []
+            if not entries:
+                return 0
+
+            per_user = {}
+            for e in entries:
+                per_user[e['user_id']] = per_user.get(e['user_id'], 0.0) + e['amount']
+
+            users = User.__table__
+            started_at = time.perf_counter()
+            try:
+                db.session.execute(Transaction.__table__.insert(), [
+                    {k: v for k, v in e.items() if k != 'user_id'} for e in entries
+                ])
+                db.session.execute(
+                    users.update().where(users.c.id == db.bindparam('uid')).values(
+                        balance=users.c.balance + db.bindparam('amount'),
+                        total_earned=users.c.total_earned + db.bindparam('amount')
+                    ),
+                    [{'uid': user_id, 'amount': amount} for user_id, amount in per_user.items()]
+                )
+                bump_blockchain_stats(db.session, transactions=len(entries), supply=sum(per_user.values()))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"ADG Ledger: flush fallito ({e}), {len(entries)} ricompense rimesse in coda")
+                with self.lock:
+                    self.pending[:0] = entries
+                return 0
+
+        self.flushed_total += len(entries)
+        request_metrics.ledger_flushed(len(entries), time.perf_counter() - started_at)
+        # L'UPDATE non passa dall'ORM: il contesto chatbot di questi utenti va ricostruito
+        user_context_cache.invalidate(user_ids=per_user)
+        return len(entries)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(REWARD_FLUSH_SECONDS)
+            self.wakeup.clear()
+            with app.app_context():
+                self.flush()
+
+
+reward_ledger = RewardLedger()
+
+
+@atexit.register
+def _flush_rewards_on_exit():
+    if reward_ledger.pending:
+        with app.app_context():
+            written = reward_ledger.flush()
+            print(f"ADG Ledger: {written} ricompense scritte alla chiusura")
+
+
 class BlockchainSystem:
     """Sistema blockchain ADG completo"""
 
     def __init__(self):
-        self.current_block_height = 1337
         self.total_supply = 12450
         self.mining_reward = 50.0  # ADG per blocco minato
         self.refresh_reward = 0.5  # ADG per visita sito
@@ -272,6 +617,14 @@ class BlockchainSystem:
         self.project_creation_reward = 2.0  # ADG per creazione progetto
         self.mining_pool = RTX3060MiningPool()
 
+    @property
+    def current_block_height(self):
+        """Altezza corrente dalla riga condivisa ChainState (uguale in tutti i worker)"""
+        height = db.session.execute(
+            db.select(ChainState.block_height).where(ChainState.id == 1)
+        ).scalar()
+        return GENESIS_BLOCK_HEIGHT if height is None else height
+
     def generate_wallet_address(self, user_id):
         """Genera indirizzo wallet univoco ADG"""
         data = f"ADG{user_id}{int(time.time())}{user_id}"
@@ -280,7 +633,8 @@ class BlockchainSystem:
 
     def create_transaction_hash(self, from_wallet, to_wallet, amount, tx_type):
         """Crea hash transazione"""
-        tx_data = f"{from_wallet}{to_wallet}{amount}{tx_type}{time.time()}"
+        # uuid: due ricompense nello stesso istante (stesso lotto del ledger) non devono collidere
+        tx_data = f"{from_wallet}{to_wallet}{amount}{tx_type}{time.time()}{uuid.uuid4().hex}"
         return hashlib.sha256(tx_data.encode()).hexdigest()
 
     def create_transaction(self, from_wallet, to_wallet, amount, tx_type):
@@ -300,29 +654,49 @@ class BlockchainSystem:
         db.session.add(transaction)
         return transaction
 
-    def reward_user(self, user, amount, source='activity'):
-        """Ricompensa utente con token ADG"""
+    def reward_user(self, user, amount, source='activity', sync=False):
+        """Ricompensa utente con token ADG.
+
+        Di norma la ricompensa va nel RewardLedger e viene scritta dal flush a lotti.
+        Con sync=True (utente appena creato, non ancora committato) balance e
+        transazione entrano nella transazione corrente e il commit lo fa il chiamante."""
         if not user.wallet_address:
             user.wallet_address = self.generate_wallet_address(user.id)
+            if not sync:
+                db.session.commit()
+
+        if sync or not REWARD_WRITE_BEHIND:
+            # Incremento atomico: UPDATE user SET balance = balance + amount
+            user.balance = User.balance + amount
+            user.total_earned = User.total_earned + amount
+            self.create_transaction(
+                from_wallet='SYSTEM_REWARD',
+                to_wallet=user.wallet_address,
+                amount=amount,
+                tx_type=source
+            )
+            bump_blockchain_stats(db.session, supply=amount)  # La transazione la conta l'evento after_insert
+            request_metrics.note_ledger_write()
+            db.session.flush()  # Una seconda ricompensa prima del flush sovrascriverebbe l'espressione
+            if not sync:
+                db.session.commit()
+        else:
+            reward_ledger.add({
+                'user_id': user.id,
+                'tx_hash': self.create_transaction_hash('SYSTEM_REWARD', user.wallet_address, amount, source),
+                'from_wallet': 'SYSTEM_REWARD',
+                'to_wallet': user.wallet_address,
+                'amount': amount,
+                'tx_type': source,
+                'timestamp': datetime.utcnow(),
+                'block_height': self.current_block_height,
+                'confirmed': True,
+            })
 
-        # Aggiorna balance utente
-        user.balance += amount
-        user.total_earned += amount
-
-        # Crea transazione
-        transaction = self.create_transaction(
-            from_wallet='SYSTEM_REWARD',
-            to_wallet=user.wallet_address,
-            amount=amount,
-            tx_type=source
-        )
-
-        db.session.commit()
         print(f"ADG Reward: {user.username} riceve {amount} ADG per {source}")
-        return transaction
 
     def mine_block(self, miner_address):
-        """Mina un nuovo blocco (simulato se pool non attivo)"""
+        """Mina un nuovo blocco (simulato se pool non attivo); ritorna (reward, altezza del blocco)"""
         if self.mining_pool.is_active:
             # Mining reale con pool RTX3060
             reward = self.mining_reward
@@ -332,16 +706,24 @@ class BlockchainSystem:
             reward = self.mining_reward * 0.1  # Reward ridotto per simulazione
             print(f"Blocco simulato: {reward} ADG")
 
-        self.current_block_height += 1
-        return reward
+        # Incremento atomico: due worker che minano insieme ottengono altezze diverse
+        height = db.session.execute(
+            db.update(ChainState).where(ChainState.id == 1)
+            .values(block_height=ChainState.block_height + 1, updated_at=datetime.utcnow())
+            .returning(ChainState.block_height)
+        ).scalar_one()
+        db.session.commit()
+        return reward, height
 
     def get_mining_stats(self):
         """Statistiche mining"""
+        state = db.session.get(ChainState, 1)
+        alive = self.mining_pool._alive()
         return {
-            'pool_active': self.mining_pool.is_active,
-            'connected_gpus': len(self.mining_pool.connected_gpus),
-            'total_hashrate': self.mining_pool.total_hashrate,
-            'current_block': self.current_block_height,
+            'pool_active': bool(state and state.pool_active),
+            'connected_gpus': PoolGpu.query.filter(alive).count(),
+            'total_hashrate': self.mining_pool.calculate_total_hashrate(),
+            'current_block': state.block_height if state else GENESIS_BLOCK_HEIGHT,
             'websocket_enabled': self.mining_pool.websocket_enabled
         }
 
@@ -356,7 +738,157 @@ blockchain = BlockchainSystem()
 # VISIT COUNTER SYSTEM
 # =============================================================================
 
-VISITS_FILE = 'visits.json'
+VISITS_FILE = 'visits.json'  # Vecchio formato: letto solo per importarlo nel DB (o dal benchmark)
+VISITS_BACKEND = 'db'  # 'json' = vecchio comportamento, tenuto per benchmark_visits
+VISITS_BATCH_SIZE = 100  # Visite in coda che fanno partire subito il flush
+VISITS_FLUSH_SECONDS = 1.0
+VISITS_RECENT_COUNT = 10  # Visitatori mostrati in /stats
+VISITS_COUNT_TTL_SECONDS = 5  # Rilettura del contatore: include i flush degli altri worker
+
+
+class Visit(db.Model):
+    """Log append-only delle visite alla home"""
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
+    ip = db.Column(db.String(100))
+    user_agent = db.Column(db.String(500))
+    username = db.Column(db.String(150))
+
+    def to_dict(self):
+        # Stesse chiavi dei visitatori di visits.json (usate da stats.html)
+        return {
+            'timestamp': self.timestamp.isoformat(),
+            'ip': self.ip,
+            'user_agent': self.user_agent,
+            'user': self.username,
+        }
+
+
+class SiteCounter(db.Model):
+    """Contatori globali incrementati con UPDATE value = value + n"""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class VisitLog:
+    """Visite in coda in memoria, scritte a lotti: INSERT executemany nel log + incremento atomico del contatore"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stored_count = None  # Ultimo valore letto dal DB
+        self.stored_at = 0.0
+
+    def record(self, timestamp, ip, user_agent, username):
+        with self.lock:
+            self.pending.append({'timestamp': timestamp, 'ip': ip, 'user_agent': user_agent, 'username': username})
+            size = len(self.pending)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='visit-log')
+                self.thread.start()
+        if size >= VISITS_BATCH_SIZE:
+            self.wakeup.set()
+
+    def _read_count(self):
+        value = db.session.query(SiteCounter.value).filter_by(name='visits').scalar() or 0
+        self.stored_at = time.time()
+        return value
+
+    def count(self):
+        """Visite totali: valore nel DB (riletto dopo ogni flush e ogni VISITS_COUNT_TTL_SECONDS,
+        così un worker fermo vede i flush degli altri) più quelle ancora in coda in questo worker"""
+        if self.stored_count is None or time.time() - self.stored_at >= VISITS_COUNT_TTL_SECONDS:
+            self.stored_count = self._read_count()
+        return self.stored_count + len(self.pending)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                rows, self.pending = self.pending, []
+            if not rows:
+                return 0
+            counter = SiteCounter.__table__
+            try:
+                db.session.execute(Visit.__table__.insert(), rows)
+                db.session.execute(
+                    sqlite_insert(counter).values(name='visits', value=len(rows))
+                    .on_conflict_do_update(index_elements=['name'], set_={'value': counter.c.value + len(rows)})
+                )
+                self.stored_count = self._read_count()
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Visite: flush fallito ({e}), {len(rows)} visite rimesse in coda")
+                with self.lock:
+                    self.pending[:0] = rows
+                return 0
+            return len(rows)
+
+    def recent(self, limit=VISITS_RECENT_COUNT):
+        """Ultimi visitatori in ordine cronologico: ultime righe del log (su id indicizzato) più la coda
+        in memoria. Niente flush qui: un commit nel percorso di lettura scade gli oggetti già caricati"""
+        with self.lock:
+            queued = self.pending[-limit:]
+        visits = Visit.query.order_by(Visit.id.desc()).limit(limit).all()
+        rows = [v.to_dict() for v in reversed(visits)]
+        rows += [{'timestamp': v['timestamp'].isoformat(), 'ip': v['ip'], 'user_agent': v['user_agent'],
+                  'user': v['username']} for v in queued]
+        return rows[-limit:]
+
+    def import_legacy_file(self):
+        """Una sola volta: porta conteggio e visitatori di visits.json nel DB e rinomina il file.
+        Con più worker all'avvio importa solo chi inserisce per primo il contatore (INSERT OR IGNORE);
+        un errore qui viene solo stampato, senza fermare il resto di init_db."""
+        if not os.path.exists(VISITS_FILE) or db.session.get(SiteCounter, 'visits') is not None:
+            return
+        legacy = load_visits()
+        try:
+            inserted = db.session.execute(
+                sqlite_insert(SiteCounter.__table__)
+                .values(name='visits', value=legacy.get('count', 0))
+                .on_conflict_do_nothing(index_elements=['name'])
+            ).rowcount
+            if not inserted:
+                # Un altro worker ha già importato il file
+                db.session.rollback()
+                return
+            for v in legacy.get('visitors', []):
+                try:
+                    timestamp = datetime.fromisoformat(v['timestamp'])
+                except (KeyError, ValueError):
+                    timestamp = datetime.now()
+                db.session.add(Visit(timestamp=timestamp, ip=v.get('ip'), user_agent=v.get('user_agent'),
+                                     username=v.get('user')))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Visite: importazione di {VISITS_FILE} fallita ({e})")
+            return
+        try:
+            os.replace(VISITS_FILE, VISITS_FILE + '.migrated')
+        except OSError as e:
+            print(f"Visite: impossibile rinominare {VISITS_FILE} ({e})")
+        print(f"Visite: importate {legacy.get('count', 0)} visite da {VISITS_FILE}")
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(VISITS_FLUSH_SECONDS)
+            self.wakeup.clear()
+            with app.app_context():
+                self.flush()
+
+
+visit_log = VisitLog()
+
+
+@atexit.register
+def _flush_visits_on_exit():
+    if visit_log.pending:
+        with app.app_context():
+            visit_log.flush()
 
 
 def load_visits():
@@ -376,6 +908,7 @@ def save_visits(visits_data):
 
 @app.route('/api/chat/feedback', methods=['POST'])
 @login_required
+@query_budget(7, max_repeats=2)
 def chat_feedback():
     """Salva feedback su risposta"""
     data = request.get_json()
@@ -438,6 +971,8 @@ def _detect_category(question):
 
 @app.route('/api/chat/preferences', methods=['GET', 'POST'])
 @login_required
+@query_budget(2, max_repeats=1)
+@query_budget(3, max_repeats=1, method='POST')
 def chat_preferences():
     """Gestisci preferenze chat"""
     prefs = UserChatPreferences.query.filter_by(user_id=current_user.id).first()
@@ -494,11 +1029,7 @@ class Project(db.Model):
         """Ottiene ruolo utente nel progetto"""
         if self.owner_id == user_id:
             return 'owner'
-        member = ProjectMember.query.filter_by(
-            project_id=self.id,
-            user_id=user_id
-        ).first()
-        return member.role if member else None
+        return project_access(user_id).role_for(self.id)
 
     def user_can_edit(self, user_id):
         """Verifica se user può modificare contenuti"""
@@ -511,12 +1042,7 @@ class Project(db.Model):
 
     def has_access(self, user_id):
         """Verifica se user ha accesso"""
-        if self.owner_id == user_id:
-            return True
-        return ProjectMember.query.filter_by(
-            project_id=self.id,
-            user_id=user_id
-        ).first() is not None
+        return self.get_member_role(user_id) is not None
 
 
 class ProjectMember(db.Model):
@@ -544,25 +1070,106 @@ class ProjectFile(db.Model):
     uploader = db.relationship('User')
 
 
+class ProjectAccess:
+    """Ruoli di un utente in tutti i suoi progetti (owner + membership), letti con una query.
+
+    Una istanza per utente e per richiesta (in g): has_access, get_member_role e
+    user_can_edit non tornano più su ProjectMember. Un commit che tocca Project o
+    ProjectMember la scarta, così dopo add/remove/cambio ruolo si rilegge."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        owned = db.select(Project.id, db.literal('owner')).where(Project.owner_id == user_id)
+        memberships = db.select(ProjectMember.project_id, ProjectMember.role).where(ProjectMember.user_id == user_id)
+        self.roles = {}
+        for project_id, role in db.session.execute(db.union_all(owned, memberships)):
+            if self.roles.get(project_id) != 'owner':
+                self.roles[project_id] = role
+
+    @property
+    def project_ids(self):
+        return list(self.roles)
+
+    def role_for(self, project_id):
+        return self.roles.get(project_id)
+
+    def has_access(self, project_id):
+        return project_id in self.roles
+
+    def can_edit(self, project_id):
+        return self.roles.get(project_id) in ('owner', 'collaborator')
+
+    def can_manage(self, project_id):
+        """Owner o manager del progetto: gestisce i membri"""
+        return self.roles.get(project_id) in ('owner', 'manager')
+
+
+def project_access(user_id):
+    """ProjectAccess dell'utente per la richiesta corrente"""
+    cache = g.setdefault('project_access', {})
+    if user_id not in cache:
+        cache[user_id] = ProjectAccess(user_id)
+    return cache[user_id]
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _collect_project_access_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Project, ProjectMember)):
+            session.info['project_access_changed'] = True
+            return
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _reset_project_access(session):
+    if session.info.pop('project_access_changed', False) and has_app_context():
+        g.pop('project_access', None)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _discard_project_access_changes(session):
+    session.info.pop('project_access_changed', None)
+
+
+def load_project_detail(project_id):
+    """Progetto con owner, membri (+utente), note (+autore) e file (+file e uploader).
+    Numero di query costante: una per il progetto e una selectin per ogni collezione."""
+    project = Project.query.options(
+        db.joinedload(Project.owner),
+        db.selectinload(Project.members).joinedload(ProjectMember.user),
+        db.selectinload(Project.notes).joinedload(UserNote.user),
+        db.selectinload(Project.project_files).joinedload(ProjectFile.file),
+        db.selectinload(Project.project_files).joinedload(ProjectFile.uploader),
+    ).filter(Project.id == project_id).first_or_404()
+    return project
+
+
 # =============================================================================
 # PROJECT ROUTES
 # =============================================================================
 
 @app.route('/projects')
 @login_required
+@query_budget(5, max_repeats=1)
 def projects_list():
     """Lista progetti accessibili"""
-    owned = Project.query.filter_by(owner_id=current_user.id).all()
+    # Le card mostrano solo i conteggi: delle note basta l'id
+    projects = Project.query.options(
+        db.joinedload(Project.owner),
+        db.selectinload(Project.notes).load_only(UserNote.id),
+        db.selectinload(Project.members),
+    ).filter(Project.id.in_(project_access(current_user.id).project_ids)).order_by(Project.id).all()
 
-    member_projects = db.session.query(Project).join(ProjectMember).filter(
-        ProjectMember.user_id == current_user.id
-    ).all()
+    owned = [p for p in projects if p.owner_id == current_user.id]
+    member_projects = [p for p in projects if p.owner_id != current_user.id]
 
     return render_template('project.html', owned=owned, member_projects=member_projects)
 
 
 @app.route('/project/create', methods=['GET', 'POST'])
 @login_required
+@query_budget(1, max_repeats=1)
+@query_budget(5, max_repeats=2, method='POST')
 def create_project():
     """Crea progetto (solo manager)"""
     if not current_user.can_create_projects():
@@ -587,27 +1194,25 @@ def create_project():
 
 @app.route('/project/<int:project_id>')
 @login_required
+@query_budget(8, max_repeats=1)
 def project_detail(project_id):
-    project = Project.query.get_or_404(project_id)
-
-    if not project.has_access(current_user.id):
+    access = project_access(current_user.id)
+    if not access.has_access(project_id):
+        Project.query.get_or_404(project_id)
         flash('Accesso negato')
         return redirect(url_for('projects_list'))
 
-    if project.owner_id == current_user.id:
-        user_role = 'owner'
-    else:
-        member = ProjectMember.query.filter_by(project_id=project_id, user_id=current_user.id).first()
-        user_role = member.role if member else 'viewer'
+    project = load_project_detail(project_id)
+    user_role = access.role_for(project_id)
 
     can_manage_members = user_role in ['owner', 'manager']
 
-    notes = UserNote.query.filter_by(project_id=project_id).order_by(UserNote.created_at.desc()).all()
+    notes = sorted(project.notes, key=lambda n: n.created_at, reverse=True)
     members = project.members
     is_owner = project.owner_id == current_user.id
 
     # ⭐ AGGIUNGI FILE DEL PROGETTO
-    project_files_rel = ProjectFile.query.filter_by(project_id=project_id).order_by(ProjectFile.added_at.desc()).all()
+    project_files_rel = sorted(project.project_files, key=lambda pf: pf.added_at, reverse=True)
 
     # ⭐ FILE DISPONIBILI DA ALLEGARE (del current user, non già nel progetto)
     attached_file_ids = [pf.file_id for pf in project_files_rel]
@@ -635,18 +1240,12 @@ def project_detail(project_id):
 
 
 @app.route('/project/<int:project_id>/add_member', methods=['POST'])
+@query_budget(6, max_repeats=2)
 def add_project_member(project_id):
     project = Project.query.get_or_404(project_id)
 
     # ⭐ Verifica permessi (owner O manager)
-    is_owner = project.owner_id == current_user.id
-    is_project_manager = ProjectMember.query.filter_by(
-        project_id=project_id,
-        user_id=current_user.id,
-        role='manager'
-    ).first() is not None
-
-    if not (is_owner or is_project_manager):
+    if not project_access(current_user.id).can_manage(project.id):
         return jsonify({'success': False, 'message': 'Permessi insufficienti'}), 403
 
     data = request.json
@@ -665,16 +1264,12 @@ def add_project_member(project_id):
 
 
 @app.route('/project/<int:project_id>/change_member_role/<int:user_id>', methods=['POST'])
+@query_budget(5, max_repeats=1)
 def change_member_role(project_id, user_id):
     """Cambia ruolo membro"""
     project = Project.query.get_or_404(project_id)
 
-    is_owner = project.owner_id == current_user.id
-    is_project_manager = ProjectMember.query.filter_by(
-        project_id=project_id, user_id=current_user.id, role='manager'
-    ).first() is not None
-
-    if not (is_owner or is_project_manager):
+    if not project_access(current_user.id).can_manage(project.id):
         return jsonify({'success': False, 'message': 'Permessi insufficienti'}), 403
 
     data = request.json
@@ -692,18 +1287,12 @@ def change_member_role(project_id, user_id):
 
 
 @app.route('/project/<int:project_id>/remove_member/<int:user_id>', methods=['POST'])
+@query_budget(5, max_repeats=1)
 def remove_project_member(project_id, user_id):
     """Rimuovi membro - solo owner o project manager"""
     project = Project.query.get_or_404(project_id)
 
-    is_owner = project.owner_id == current_user.id
-    is_project_manager = ProjectMember.query.filter_by(
-        project_id=project_id,
-        user_id=current_user.id,
-        role='manager'
-    ).first() is not None
-
-    if not (is_owner or is_project_manager):
+    if not project_access(current_user.id).can_manage(project.id):
         return jsonify({'success': False, 'message': 'Permessi insufficienti'}), 403
 
     member = ProjectMember.query.filter_by(project_id=project_id, user_id=user_id).first_or_404()
@@ -715,6 +1304,7 @@ def remove_project_member(project_id, user_id):
 
 @app.route('/project/<int:project_id>/attach_file', methods=['POST'])
 @login_required
+@query_budget(5, max_repeats=1)
 def attach_file_to_project(project_id):
     """Allega file esistente a progetto"""
     project = Project.query.get_or_404(project_id)
@@ -748,6 +1338,7 @@ def attach_file_to_project(project_id):
 
 @app.route('/project/<int:project_id>/remove_file/<int:project_file_id>', methods=['POST'])
 @login_required
+@query_budget(4, max_repeats=1)
 def remove_file_from_project(project_id, project_file_id):
     """Rimuovi file da progetto"""
     project = Project.query.get_or_404(project_id)
@@ -768,6 +1359,7 @@ def remove_file_from_project(project_id, project_file_id):
 
 @app.route('/project/<int:project_id>/upload_file', methods=['POST'])
 @login_required
+@query_budget(6, max_repeats=2)
 def upload_file_to_project(project_id):
     """Upload file diretto a progetto"""
     project = Project.query.get_or_404(project_id)
@@ -921,31 +1513,37 @@ def load_user(user_id):
 # =============================================================================
 
 @app.route('/')
+@query_budget(3, max_repeats=1)
 def index():
-    visits_data = load_visits()
-    visits_data['count'] += 1
-    visitor_info = {
-        'timestamp': datetime.now().isoformat(),
-        'ip': request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'unknown')),
-        'user_agent': request.environ.get('HTTP_USER_AGENT', 'unknown'),
-        'user': current_user.username if current_user.is_authenticated else 'Anonimo'
-    }
-    visits_data['visitors'].append(visitor_info)
-    if len(visits_data['visitors']) > 100:
-        visits_data['visitors'] = visits_data['visitors'][-100:]
-    save_visits(visits_data)
+    ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'unknown'))
+    user_agent = request.environ.get('HTTP_USER_AGENT', 'unknown')
+    username = current_user.username if current_user.is_authenticated else 'Anonimo'
+
+    if VISITS_BACKEND == 'json':
+        visits_data = load_visits()
+        visits_data['count'] += 1
+        visits_data['visitors'].append({
+            'timestamp': datetime.now().isoformat(), 'ip': ip, 'user_agent': user_agent, 'user': username
+        })
+        if len(visits_data['visitors']) > 100:
+            visits_data['visitors'] = visits_data['visitors'][-100:]
+        save_visits(visits_data)
+        visit_count = visits_data['count']
+    else:
+        visit_log.record(datetime.now(), ip, user_agent, username)
+        visit_count = visit_log.count()
 
     # Ricompensa utente loggato per visita con ADG
     if current_user.is_authenticated:
         blockchain.reward_user(current_user, blockchain.refresh_reward, 'refresh')
 
-    return render_template('index.html', visit_count=visits_data['count'], current_user=current_user)
+    return render_template('index.html', visit_count=visit_count, current_user=current_user)
 
 
 @app.route('/stats')
 @login_required
+@query_budget(3, max_repeats=1)
 def stats():
-    visits_data = load_visits()
 
     # ⭐ Lista utenti per manager
     all_users = []
@@ -953,8 +1551,8 @@ def stats():
         all_users = User.query.order_by(User.username).all()
 
     return render_template('stats.html',
-                           visit_count=visits_data['count'],
-                           recent_visitors=visits_data['visitors'][-10:],
+                           visit_count=visit_log.count(),
+                           recent_visitors=visit_log.recent(),
                            all_users=all_users,
                            current_user=current_user)
 
@@ -975,9 +1573,12 @@ RESPONSE_MAX_TOKENS = 480  # Risposte concise
 
 # Tracciamento utilizzo giornaliero
 class ChatUsage(db.Model):
+    # Una sola riga per utente e giorno: serve all'upsert atomico di add_chat_usage
+    __table_args__ = (db.UniqueConstraint('user_id', 'date', name='uq_chat_usage_user_date'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    date = db.Column(db.Date, default=datetime.utcnow().date)
+    date = db.Column(db.Date, default=lambda: datetime.utcnow().date())
     tokens_used = db.Column(db.Integer, default=0)
     messages_count = db.Column(db.Integer, default=0)
 
@@ -997,20 +1598,125 @@ class ChatMessage(db.Model):
     user = db.relationship('User', backref='chat_messages')
 
 
+# Write-behind opzionale: gli incrementi restano in memoria e vengono scritti ogni CHAT_USAGE_FLUSH_SECONDS
+CHAT_USAGE_WRITE_BEHIND = os.environ.get('CHAT_USAGE_WRITE_BEHIND') == '1'
+CHAT_USAGE_FLUSH_SECONDS = 5
+# Token non ancora scritti che TUTTI i worker insieme possono tenere per un utente: ogni worker ne tiene al
+# massimo margine / worker (gli altri worker non li vedono) e sotto LIMIT - margine nel DB si scrive subito.
+# Così, finché il DB è sotto la soglia, l'uso reale resta sotto il limite; sopra, i token ancora in memoria
+# negli altri worker (meno del margine in tutto) arrivano al loro prossimo flush, entro CHAT_USAGE_FLUSH_SECONDS
+CHAT_USAGE_SYNC_MARGIN = 2000
+CHAT_USAGE_WORKERS = max(int(os.environ.get('WEB_CONCURRENCY', '1')), 1)  # Stessa variabile di gunicorn --workers
+
+DailyUsage = namedtuple('DailyUsage', 'tokens_used messages_count')
+
+
+def _usage_upsert():
+    """INSERT ... ON CONFLICT(user_id, date) DO UPDATE con somme fatte da SQLite (nessun read-modify-write)"""
+    stmt = sqlite_insert(ChatUsage.__table__)
+    return stmt.on_conflict_do_update(
+        index_elements=['user_id', 'date'],
+        set_={
+            'tokens_used': ChatUsage.__table__.c.tokens_used + stmt.excluded.tokens_used,
+            'messages_count': ChatUsage.__table__.c.messages_count + stmt.excluded.messages_count,
+        }
+    )
+
+
+class ChatUsageWriteBehind:
+    """Contatori in memoria per (utente, giorno), scritti a lotti da un thread in background"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # (user_id, date) -> [tokens, messages]
+        self.thread = None
+
+    def add(self, user_id, day, tokens, messages):
+        with self.lock:
+            counters = self.pending.setdefault((user_id, day), [0, 0])
+            counters[0] += tokens
+            counters[1] += messages
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='chat-usage-flush')
+                self.thread.start()
+
+    def pending_for(self, user_id, day):
+        with self.lock:
+            return tuple(self.pending.get((user_id, day), (0, 0)))
+
+    def take(self, user_id=None):
+        """Toglie e ritorna i contatori da scrivere (di un utente o di tutti)"""
+        with self.lock:
+            if user_id is None:
+                rows, self.pending = self.pending, {}
+            else:
+                rows = {k: self.pending.pop(k) for k in list(self.pending) if k[0] == user_id}
+        return [{'user_id': u, 'date': d, 'tokens_used': t, 'messages_count': m}
+                for (u, d), (t, m) in rows.items()]
+
+    def flush(self, user_id=None):
+        rows = self.take(user_id)
+        if not rows:
+            return
+        try:
+            db.session.execute(_usage_upsert(), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Errore flush ChatUsage: {e}")
+            # Rimetti in coda: verranno riscritti al prossimo giro
+            for row in rows:
+                self.add(row['user_id'], row['date'], row['tokens_used'], row['messages_count'])
+
+    def _run(self):
+        while True:
+            time.sleep(CHAT_USAGE_FLUSH_SECONDS)
+            with app.app_context():
+                self.flush()
+
+
+chat_usage_buffer = ChatUsageWriteBehind()
+
+
+@atexit.register
+def _flush_chat_usage_on_exit():
+    if chat_usage_buffer.pending:
+        with app.app_context():
+            chat_usage_buffer.flush()
+
+
+def _stored_daily_usage(user_id, day):
+    row = db.session.query(ChatUsage.tokens_used, ChatUsage.messages_count) \
+        .filter(ChatUsage.user_id == user_id, ChatUsage.date == day).first()
+    return (row.tokens_used or 0, row.messages_count or 0) if row else (0, 0)
+
+
 def get_daily_usage(user_id):
-    """Ottieni uso token giornaliero"""
+    """Ottieni uso token giornaliero (sola lettura: la riga nasce al primo add_chat_usage)"""
     today = datetime.utcnow().date()
-    usage = ChatUsage.query.filter_by(
-        user_id=user_id,
-        date=today
-    ).first()
+    tokens, messages = _stored_daily_usage(user_id, today)
+    pending_tokens, pending_messages = chat_usage_buffer.pending_for(user_id, today)
+    return DailyUsage(tokens + pending_tokens, messages + pending_messages)
 
-    if not usage:
-        usage = ChatUsage(user_id=user_id, date=today)
-        db.session.add(usage)
-        db.session.commit()
 
-    return usage
+def add_chat_usage(user_id, tokens, messages=1):
+    """Aggiunge token e messaggi all'uso di oggi. Con il write-behind attivo resta in memoria finché
+    questo worker è sotto la sua quota del margine e il DB è lontano dal limite; altrimenti un solo upsert
+    atomico nella transazione corrente (il commit lo fa il chiamante). Ritorna i token usati oggi."""
+    today = datetime.utcnow().date()
+    if CHAT_USAGE_WRITE_BEHIND:
+        chat_usage_buffer.add(user_id, today, tokens, messages)
+        pending_tokens = chat_usage_buffer.pending_for(user_id, today)[0]
+        stored_tokens = _stored_daily_usage(user_id, today)[0]
+        if (pending_tokens < CHAT_USAGE_SYNC_MARGIN / CHAT_USAGE_WORKERS
+                and stored_tokens + pending_tokens < DAILY_TOKEN_LIMIT - CHAT_USAGE_SYNC_MARGIN):
+            return stored_tokens + pending_tokens
+        rows = chat_usage_buffer.take(user_id)
+    else:
+        rows = [{'user_id': user_id, 'date': today, 'tokens_used': tokens, 'messages_count': messages}]
+
+    db.session.execute(_usage_upsert(), rows)
+    return _stored_daily_usage(user_id, today)[0]
 
 
 def check_token_limit(user_id):
@@ -1019,25 +1725,112 @@ def check_token_limit(user_id):
     return usage.tokens_used < DAILY_TOKEN_LIMIT
 
 
-def get_user_context(user):
-    """Genera contesto personalizzato per Claude"""
-    # Progetti dell'utente
-    owned_projects = Project.query.filter_by(owner_id=user.id).all()
-    member_projects = db.session.query(Project).join(ProjectMember).filter(
-        ProjectMember.user_id == user.id
-    ).all()
-    all_projects = owned_projects + member_projects
+USER_CONTEXT_TTL_SECONDS = 120  # Limite di staleness per modifiche fatte da altri worker
+
+
+class UserContextCache:
+    """Snapshot del contesto utente per Claude, riusato tra i messaggi.
+
+    Ogni snapshot ricorda progetti e wallet che contiene, così una scrittura su
+    note, file, progetti o transazioni invalida solo gli utenti interessati."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # user_id -> dict(context, built_at, project_ids, wallet)
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and time.time() - entry['built_at'] < USER_CONTEXT_TTL_SECONDS:
+                return entry['context']
+        return None
+
+    def put(self, user_id, context, project_ids, wallet):
+        with self.lock:
+            self.entries[user_id] = {
+                'context': context,
+                'built_at': time.time(),
+                'project_ids': set(project_ids),
+                'wallet': wallet,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def invalidate(self, user_ids=(), project_ids=(), wallets=()):
+        user_ids, project_ids, wallets = set(user_ids), set(project_ids), set(wallets)
+        with self.lock:
+            for user_id in list(self.entries):
+                entry = self.entries[user_id]
+                if user_id in user_ids or entry['wallet'] in wallets or entry['project_ids'] & project_ids:
+                    del self.entries[user_id]
+
+
+user_context_cache = UserContextCache()
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _track_user_context_changes(session, flush_context):
+    """Raccoglie utenti, progetti e wallet toccati dal flush"""
+    changes = session.info.setdefault('user_context_changes', (set(), set(), set()))
+    user_ids, project_ids, wallets = changes
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            user_ids.add(obj.id)
+        elif isinstance(obj, (UserNote, UserFile)):
+            user_ids.add(obj.user_id)
+            if getattr(obj, 'project_id', None):
+                project_ids.add(obj.project_id)
+        elif isinstance(obj, Project):
+            user_ids.add(obj.owner_id)
+            project_ids.add(obj.id)
+        elif isinstance(obj, ProjectMember):
+            user_ids.add(obj.user_id)
+            project_ids.add(obj.project_id)
+        elif isinstance(obj, Transaction):
+            wallets.add(obj.to_wallet)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _apply_user_context_changes(session):
+    changes = session.info.pop('user_context_changes', None)
+    if changes:
+        user_context_cache.invalidate(*changes)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _discard_user_context_changes(session):
+    session.info.pop('user_context_changes', None)
+
+
+@query_budget(4, max_repeats=1)
+def _build_user_context(user):
+    """Contesto con query aggregate: i conteggi di note e membri arrivano come subquery, senza caricare le relazioni"""
+    notes_count = db.select(db.func.count(UserNote.id)) \
+        .where(UserNote.project_id == Project.id).correlate(Project).scalar_subquery()
+    members_count = db.select(db.func.count(ProjectMember.id)) \
+        .where(ProjectMember.project_id == Project.id).correlate(Project).scalar_subquery()
+    member_of = db.select(ProjectMember.project_id).where(ProjectMember.user_id == user.id)
+
+    # Progetti dell'utente (prima quelli di cui è owner)
+    all_projects = db.session.query(Project.id, Project.name, notes_count, members_count) \
+        .filter(db.or_(Project.owner_id == user.id, Project.id.in_(member_of))) \
+        .order_by(Project.owner_id != user.id, Project.id).all()
 
     # Note recenti
-    recent_notes = UserNote.query.filter_by(user_id=user.id) \
+    recent_notes = db.session.query(UserNote.note_type, UserNote.title, UserNote.priority) \
+        .filter(UserNote.user_id == user.id) \
         .order_by(UserNote.updated_at.desc()).limit(10).all()
 
     # Files recenti
-    recent_files = UserFile.query.filter_by(user_id=user.id) \
+    recent_files = db.session.query(UserFile.original_filename, UserFile.file_type, UserFile.file_size) \
+        .filter(UserFile.user_id == user.id) \
         .order_by(UserFile.uploaded_at.desc()).limit(10).all()
 
     # Transazioni recenti
-    recent_tx = Transaction.query.filter_by(to_wallet=user.wallet_address) \
+    recent_tx = db.session.query(Transaction.tx_type, Transaction.amount, Transaction.timestamp) \
+        .filter(Transaction.to_wallet == user.wallet_address) \
         .order_by(Transaction.timestamp.desc()).limit(5).all()
 
     context = f"""PROFILO UTENTE:
@@ -1051,7 +1844,7 @@ PROGETTI ({len(all_projects)}):
 """
 
     for p in all_projects[:5]:
-        context += f"- {p.name}: {len(p.notes)} note, {len(p.members)} membri\n"
+        context += f"- {p.name}: {p[2]} note, {p[3]} membri\n"
 
     context += f"\nNOTE RECENTI ({len(recent_notes)}):\n"
     for n in recent_notes[:5]:
@@ -1065,11 +1858,469 @@ PROGETTI ({len(all_projects)}):
     for tx in recent_tx:
         context += f"- {tx.tx_type}: +{tx.amount} ADG ({tx.timestamp.strftime('%d/%m %H:%M')})\n"
 
+    return context, [p.id for p in all_projects]
+
+
+def get_user_context(user):
+    """Genera contesto personalizzato per Claude (dalla cache se ancora valido)"""
+    context = user_context_cache.get(user.id)
+    if context is None:
+        context, project_ids = _build_user_context(user)
+        user_context_cache.put(user.id, context, project_ids, user.wallet_address)
     return context
 
 
+# ===== KNOWLEDGE BASE INDEX =====
+
+KB_MATCH_THRESHOLD = 0.5  # Soglia 50% similarità
+KB_INDEX_REFRESH_SECONDS = 60  # Ogni quanto controllare modifiche fatte da altri worker
+
+
+def _knowledge_signature():
+    """Cambia quando un'entry approvata viene aggiunta, tolta o modificata (anche da un altro processo)"""
+    return tuple(db.session.query(
+        db.func.count(SharedKnowledge.id),
+        db.func.max(SharedKnowledge.updated_at)
+    ).filter(SharedKnowledge.is_approved.is_(True)).one())
+
+
+class KnowledgeIndex:
+    """Indice invertito in memoria sulle domande approvate della Knowledge Base.
+
+    Per ogni entry tiene il set di parole già calcolato e, per ogni parola, gli id
+    delle entry che la contengono: il matching guarda solo le posting list delle
+    parole del messaggio invece di scorrere tutta la tabella."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}  # parola -> set di id SharedKnowledge
+        self.entry_words = {}  # id -> frozenset di parole della domanda
+        self.loaded = False
+        self.signature = None
+        self.checked_at = 0.0
+
+    def build(self):
+        """Ricostruisce l'indice da zero (solo id e domanda delle entry approvate)"""
+        rows = db.session.query(SharedKnowledge.id, SharedKnowledge.question) \
+            .filter(SharedKnowledge.is_approved.is_(True)).all()
+        signature = _knowledge_signature()
+        with self.lock:
+            self.postings = {}
+            self.entry_words = {}
+            for entry_id, question in rows:
+                self._add(entry_id, question)
+            self.loaded = True
+            self.signature = signature
+            self.checked_at = time.time()
+        print(f"Knowledge Base: indice costruito ({len(rows)} entry approvate, {len(self.postings)} parole)")
+
+    def _add(self, entry_id, question):
+        words = frozenset(SharedKnowledge.tokenize(question))
+        if not words:
+            return
+        self.entry_words[entry_id] = words
+        for word in words:
+            self.postings.setdefault(word, set()).add(entry_id)
+
+    def _remove(self, entry_id):
+        for word in self.entry_words.pop(entry_id, ()):
+            ids = self.postings.get(word)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self.postings[word]
+
+    def apply_changes(self, changes):
+        """Aggiorna solo le entry modificate: changes = [(id, domanda, approvata)]"""
+        with self.lock:
+            if not self.loaded:
+                return
+            for entry_id, question, approved in changes:
+                self._remove(entry_id)
+                if approved and question:
+                    self._add(entry_id, question)
+
+    def _ensure_fresh(self):
+        if not self.loaded:
+            self.build()
+            return
+        if time.time() - self.checked_at < KB_INDEX_REFRESH_SECONDS:
+            return
+        signature = _knowledge_signature()
+        if signature != self.signature:
+            self.build()
+        else:
+            self.checked_at = time.time()
+
+    def best_match(self, query, threshold=KB_MATCH_THRESHOLD):
+        """Ritorna (id, score) dell'entry più simile sopra soglia, oppure (None, 0)"""
+        self._ensure_fresh()
+        q_words = SharedKnowledge.tokenize(query)
+        if not q_words:
+            return None, 0
+
+        with self.lock:
+            # Parole in comune con ogni entry candidata
+            overlap = {}
+            for word in q_words:
+                for entry_id in self.postings.get(word, ()):
+                    overlap[entry_id] = overlap.get(entry_id, 0) + 1
+
+            best_id, best_score = None, 0
+            for entry_id, common in overlap.items():
+                score = common / (len(q_words) + len(self.entry_words[entry_id]) - common)
+                # A parità di punteggio vince l'id più basso, come nella scansione della tabella
+                if score > threshold and (score > best_score or (score == best_score and entry_id < best_id)):
+                    best_id, best_score = entry_id, score
+        return best_id, best_score
+
+
+knowledge_index = KnowledgeIndex()
+
+
+def _knowledge_match_changed(obj):
+    # usage_count e feedback cambiano spesso ma non toccano il matching
+    state = db.inspect(obj)
+    return state.attrs.question.history.has_changes() or state.attrs.is_approved.history.has_changes()
+
+
+@db.event.listens_for(SharedKnowledge, 'before_update')
+def _touch_knowledge(mapper, connection, target):
+    """updated_at cambia solo con domanda/approvazione: è la firma che gli altri worker controllano"""
+    if _knowledge_match_changed(target):
+        target.updated_at = datetime.utcnow()
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _track_knowledge_changes(session, flush_context):
+    """Raccoglie le entry KB toccate dal flush (valori letti adesso, prima del commit)"""
+    changes = session.info.setdefault('kb_changes', [])
+    for obj in session.new:
+        if isinstance(obj, SharedKnowledge):
+            changes.append((obj.id, obj.question, bool(obj.is_approved)))
+    for obj in session.dirty:
+        if isinstance(obj, SharedKnowledge) and _knowledge_match_changed(obj):
+            changes.append((obj.id, obj.question, bool(obj.is_approved)))
+    for obj in session.deleted:
+        if isinstance(obj, SharedKnowledge):
+            changes.append((obj.id, None, False))
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _apply_knowledge_changes(session):
+    changes = session.info.pop('kb_changes', None)
+    if changes:
+        knowledge_index.apply_changes(changes)
+        semantic_index.apply_changes(changes)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _discard_knowledge_changes(session):
+    session.info.pop('kb_changes', None)
+
+
+# ===== SEMANTIC KNOWLEDGE BASE CACHE =====
+
+# Dipendenze opzionali: senza sentence-transformers resta solo il matching per parole
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    SEMANTIC_KB_AVAILABLE = True
+except ImportError:
+    SEMANTIC_KB_AVAILABLE = False
+
+SEMANTIC_KB_MODEL = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'  # Gira su CPU, capisce l'italiano
+SEMANTIC_KB_INDEX_PATH = 'kb_semantic_index.npz'
+SEMANTIC_KB_THRESHOLD = 0.85  # Similarità coseno minima per usare la risposta salvata
+SEMANTIC_KB_THRESHOLDS = {  # Soglie per categoria (sovrascrivono quella generale)
+    'fintech': 0.88,  # Saldi e token: meglio non rispondere a una domanda simile ma diversa
+    'defense': 0.88,
+}
+SEMANTIC_KB_EXACT_BELOW = 2000  # Sotto questo numero di entry il confronto esatto costa meno dell'ANN
+SEMANTIC_KB_LSH_TABLES = 16  # Tabelle hash (più tabelle = recall più alto)
+SEMANTIC_KB_LSH_BITS = 8  # Iperpiani per tabella (più bit = bucket più piccoli)
+SEMANTIC_KB_LSH_SEED = 42  # Fisso: gli iperpiani devono essere uguali in tutti i worker
+SEMANTIC_KB_APPLY_DELAY_SECONDS = 2.0  # Modifiche raccolte prima di calcolare embedding e riscrivere il file
+
+
+class SemanticKnowledgeIndex:
+    """Embedding delle domande approvate della Knowledge Base, salvati su disco.
+
+    La ricerca usa LSH con iperpiani casuali (coseno): vengono confrontati solo
+    i vettori che cadono negli stessi bucket del messaggio. Con poche entry si fa
+    il prodotto scalare su tutte, che è già più veloce."""
+
+    def __init__(self, path=SEMANTIC_KB_INDEX_PATH, model_name=SEMANTIC_KB_MODEL):
+        self.path = path
+        self.model_name = model_name
+        self.model = None
+        self.model_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.entries = {}  # id -> (hash domanda, vettore normalizzato)
+        self.loaded = False
+        self.signature = None
+        self.checked_at = 0.0
+        # Matrice e bucket ricostruiti al primo uso dopo una modifica
+        self.ids = None
+        self.matrix = None
+        self.buckets = None
+        self.planes = None
+        # Modifiche dai commit, applicate dal thread in background (fuori dalla richiesta)
+        self.pending = []
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return SEMANTIC_KB_AVAILABLE
+
+    def _get_model(self):
+        with self.model_lock:
+            if self.model is None:
+                print(f"Knowledge Base semantica: carico {self.model_name} su CPU...")
+                self.model = SentenceTransformer(self.model_name, device='cpu')
+            return self.model
+
+    def embed(self, texts):
+        return self._get_model().encode(
+            list(texts), normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+
+    @staticmethod
+    def _fingerprint(question):
+        return hashlib.sha1(question.encode('utf-8')).hexdigest()
+
+    def _load_from_disk(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            data = np.load(self.path, allow_pickle=False)
+            if str(data['model']) != self.model_name:
+                return {}  # Embedding di un altro modello: da rifare
+            return {int(i): (str(f), v) for i, f, v in zip(data['ids'], data['fingerprints'], data['vectors'])}
+        except Exception as e:
+            print(f"Knowledge Base semantica: indice su disco illeggibile ({e}), lo ricostruisco")
+            return {}
+
+    def _save_to_disk(self):
+        ids = list(self.entries)
+        vectors = np.stack([self.entries[i][1] for i in ids]) if ids else np.zeros((0, 0), np.float32)
+        # Nome unico per processo e thread: più worker gunicorn possono salvare insieme
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, model=np.array(self.model_name), ids=np.array(ids, dtype=np.int64),
+                 fingerprints=np.array([self.entries[i][0] for i in ids]), vectors=vectors)
+        os.replace(tmp_path, self.path)
+
+    def sync(self):
+        """Allinea l'indice alle entry approvate: calcola solo gli embedding nuovi o di domande cambiate"""
+        rows = db.session.query(SharedKnowledge.id, SharedKnowledge.question) \
+            .filter(SharedKnowledge.is_approved.is_(True)).all()
+        signature = _knowledge_signature()
+        with self.lock:
+            entries = self.entries if self.loaded else self._load_from_disk()
+
+        current = {entry_id: self._fingerprint(question) for entry_id, question in rows}
+        to_embed = [(entry_id, question) for entry_id, question in rows
+                    if entry_id not in entries or entries[entry_id][0] != current[entry_id]]
+        vectors = self.embed(q for _, q in to_embed) if to_embed else []
+
+        with self.lock:
+            self.entries = {i: entries[i] for i in current if i in entries and entries[i][0] == current[i]}
+            for (entry_id, _), vector in zip(to_embed, vectors):
+                self.entries[entry_id] = (current[entry_id], vector)
+            self.matrix = None
+            self.loaded = True
+            self.signature = signature
+            self.checked_at = time.time()
+            if to_embed or len(self.entries) != len(entries):
+                self._save_to_disk()
+        print(f"Knowledge Base semantica: {len(self.entries)} entry ({len(to_embed)} embedding calcolati)")
+
+    def apply_changes(self, changes):
+        """Mette in coda le entry modificate nel processo corrente: changes = [(id, domanda, approvata)].
+        Embedding e salvataggio li fa il thread in background, a lotti (chiamata da after_commit)."""
+        if not self.enabled or not self.loaded:
+            return
+        with self.lock:
+            self.pending.extend(changes)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='kb-semantic')
+                self.thread.start()
+        self.wakeup.set()
+
+    def apply_pending(self):
+        """Applica le modifiche in coda: un embedding per domanda e un solo salvataggio"""
+        with self.lock:
+            changes, self.pending = self.pending, []
+        if not changes:
+            return
+        latest = {}
+        for entry_id, question, approved in changes:
+            latest[entry_id] = (question, approved)  # Vale l'ultima modifica
+        to_embed = [(entry_id, question) for entry_id, (question, approved) in latest.items() if approved and question]
+        try:
+            vectors = self.embed(q for _, q in to_embed) if to_embed else []
+        except Exception as e:
+            print(f"Knowledge Base semantica: embedding fallito ({e}), aggiorno alla prossima sync")
+            return
+        with self.lock:
+            for entry_id in latest:
+                self.entries.pop(entry_id, None)
+            for (entry_id, question), vector in zip(to_embed, vectors):
+                self.entries[entry_id] = (self._fingerprint(question), vector)
+            self.matrix = None
+            self._save_to_disk()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(SEMANTIC_KB_APPLY_DELAY_SECONDS)  # Raccoglie i commit ravvicinati
+            self.wakeup.clear()
+            self.apply_pending()
+
+    def _ensure_fresh(self):
+        if not self.loaded:
+            self.sync()
+            return
+        if time.time() - self.checked_at < KB_INDEX_REFRESH_SECONDS:
+            return
+        if _knowledge_signature() != self.signature:
+            self.sync()
+        else:
+            self.checked_at = time.time()
+
+    def _build_matrix(self):
+        # Chiamata con self.lock preso
+        self.ids = np.array(list(self.entries), dtype=np.int64)
+        if not len(self.ids):
+            self.matrix = np.zeros((0, 0), np.float32)
+            self.buckets = None
+            return
+        self.matrix = np.stack([self.entries[i][1] for i in self.ids])
+        self.buckets = None
+        if len(self.ids) >= SEMANTIC_KB_EXACT_BELOW:
+            rng = np.random.default_rng(SEMANTIC_KB_LSH_SEED)
+            self.planes = rng.standard_normal(
+                (SEMANTIC_KB_LSH_TABLES, SEMANTIC_KB_LSH_BITS, self.matrix.shape[1])).astype(np.float32)
+            codes = self._hash(self.matrix)  # (tabelle, n)
+            self.buckets = []
+            for table_codes in codes:
+                table = {}
+                for row, code in enumerate(table_codes):
+                    table.setdefault(int(code), []).append(row)
+                self.buckets.append(table)
+
+    def _hash(self, vectors):
+        # Un bit per iperpiano: da che lato sta il vettore
+        bits = np.einsum('tbd,nd->tnb', self.planes, vectors) > 0
+        return bits @ (1 << np.arange(SEMANTIC_KB_LSH_BITS))
+
+    def best_match(self, query):
+        """Ritorna (id, similarità coseno) dell'entry più vicina, oppure (None, 0)"""
+        if not self.enabled:
+            return None, 0
+        self._ensure_fresh()
+        with self.lock:
+            if not self.entries:
+                return None, 0
+        vector = self.embed([query])[0]
+
+        with self.lock:
+            if self.matrix is None:
+                self._build_matrix()
+            if self.buckets is None:
+                candidates = np.arange(len(self.ids))
+            else:
+                codes = self._hash(vector[None, :])[:, 0]
+                rows = set()
+                for table, code in zip(self.buckets, codes):
+                    rows.update(table.get(int(code), ()))
+                if not rows:
+                    return None, 0
+                candidates = np.fromiter(rows, dtype=np.int64)
+            scores = self.matrix[candidates] @ vector
+            best = int(np.argmax(scores))
+            return int(self.ids[candidates[best]]), float(scores[best])
+
+
+semantic_index = SemanticKnowledgeIndex()
+
+
+class KnowledgeBaseMetrics:
+    """Contatori del processo: hit per parole, hit semantici e miss per categoria della domanda"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_category = {}
+
+    def record(self, category, outcome, lookup_ms):
+        with self.lock:
+            stats = self.by_category.setdefault(category, {
+                'lookups': 0, 'lexical_hits': 0, 'semantic_hits': 0, 'misses': 0, 'lookup_ms_total': 0.0
+            })
+            stats['lookups'] += 1
+            stats[outcome] += 1
+            stats['lookup_ms_total'] += lookup_ms
+
+    def snapshot(self, avg_claude_tokens=0):
+        with self.lock:
+            result = {}
+            for category, stats in self.by_category.items():
+                hits = stats['lexical_hits'] + stats['semantic_hits']
+                result[category] = dict(
+                    stats,
+                    hit_rate=round(hits / stats['lookups'], 3),
+                    avg_lookup_ms=round(stats['lookup_ms_total'] / stats['lookups'], 2),
+                    tokens_saved_estimate=hits * avg_claude_tokens,
+                )
+                del result[category]['lookup_ms_total']
+            return result
+
+
+kb_metrics = KnowledgeBaseMetrics()
+
+
+def _average_claude_tokens():
+    # Stima dei token risparmiati da un hit: media delle ultime risposte di Claude
+    avg = db.session.query(db.func.avg(ChatMessage.tokens_used)) \
+        .filter(ChatMessage.tokens_used > 0).scalar()
+    return int(avg or 0)
+
+
+def find_knowledge_answer(user_message):
+    """Cerca una risposta già approvata: prima per parole, poi per significato.
+    Ritorna (SharedKnowledge, tipo match, score) oppure (None, None, 0)"""
+    start = time.perf_counter()
+    category = _detect_category(user_message)
+    entry, kind, score = None, None, 0
+
+    best_id, score = knowledge_index.best_match(user_message)
+    if best_id is not None:
+        entry, kind = db.session.get(SharedKnowledge, best_id), 'lexical'
+
+    if entry is None and semantic_index.enabled:
+        try:
+            best_id, score = semantic_index.best_match(user_message)
+        except Exception as e:
+            print(f"Knowledge Base semantica non disponibile: {e}")
+            best_id, score = None, 0
+        if best_id is not None:
+            candidate = db.session.get(SharedKnowledge, best_id)
+            threshold = SEMANTIC_KB_THRESHOLDS.get(candidate.category if candidate else None, SEMANTIC_KB_THRESHOLD)
+            if candidate is not None and candidate.is_approved and score >= threshold:
+                entry, kind = candidate, 'semantic'
+
+    lookup_ms = (time.perf_counter() - start) * 1000
+    if entry is not None:
+        kb_metrics.record(category, f'{kind}_hits', lookup_ms)
+        return entry, kind, score
+    kb_metrics.record(category, 'misses', lookup_ms)
+    return None, None, 0
+
+
 @app.route('/chatbot')
 @login_required
+@query_budget(3, max_repeats=1)
 def chatbot():
     """Pagina chatbot Claude con storico"""
     usage = get_daily_usage(current_user.id)
@@ -1090,62 +2341,368 @@ def chatbot():
                            history=history)
 
 
-@app.route('/api/chat', methods=['POST'])
-@login_required
-def chat_api():
-    """Chat con Knowledge Base integrato"""
+# ===== CLAUDE CLIENT =====
 
-    if not check_token_limit(current_user.id):
-        return jsonify({'success': False, 'message': 'Limite giornaliero raggiunto', 'limit_reached': True})
+# Con CLAUDE_USE_STUB=1 il chatbot risponde con uno stub locale: niente rete né token spesi (sviluppo/test offline)
+CLAUDE_USE_STUB = os.environ.get('CLAUDE_USE_STUB') == '1'
 
-    import anthropic
 
-    data = request.get_json()
-    user_message = data.get('message', '').strip()
+class _StubUsage:
+    def __init__(self, input_tokens, output_tokens):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
 
-    if not user_message:
-        return jsonify({'success': False, 'message': 'Messaggio vuoto'})
 
-    # 1. CERCA IN KNOWLEDGE BASE
-    kb_matches = SharedKnowledge.query.filter_by(is_approved=True).all()
-    best_match = None
-    best_score = 0
+class _StubTextBlock:
+    def __init__(self, text):
+        self.type = 'text'
+        self.text = text
 
-    for kb in kb_matches:
-        score = kb.similarity_score(user_message)
-        if score > best_score and score > 0.5:  # Soglia 50% similarità
-            best_score = score
-            best_match = kb
 
-    # Se match trovato, usa risposta cached
-    if best_match:
-        best_match.usage_count += 1
-        db.session.commit()
+class _StubMessage:
+    def __init__(self, text, input_tokens):
+        self.content = [_StubTextBlock(text)]
+        self.usage = _StubUsage(input_tokens, len(text.split()))
 
-        # Salva nel log
-        chat_message = ChatMessage(
-            user_id=current_user.id,
-            message=user_message,
-            response=best_match.answer,
-            tokens_used=0,  # Gratis da cache
-            model='knowledge-base'
-        )
-        db.session.add(chat_message)
-        db.session.commit()
 
-        return jsonify({
-            'success': True,
-            'response': best_match.answer,
-            'from_kb': True,
-            'tokens_used': 0,
-            'message_id': chat_message.id
-        })
+class _StubStream:
+    """Stessa interfaccia di client.messages.stream(): text_stream e get_final_message()"""
 
-    # 2. ALTRIMENTI CHIAMA CLAUDE CON PREFERENZE
-    client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
+    def __init__(self, message, delay):
+        self.message = message
+        self.delay = delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        for i, word in enumerate(self.message.content[0].text.split(' ')):
+            time.sleep(self.delay)
+            yield word if i == 0 else ' ' + word
+
+    def get_final_message(self):
+        return self.message
+
+
+class _StubMessages:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def _reply(self, system='', messages=(), **kwargs):
+        question = messages[-1]['content'] if messages else ''
+        text = f"[stub] Risposta di prova a: {question}"
+        return _StubMessage(text, len(system.split()) + len(question.split()))
+
+    def create(self, **kwargs):
+        return self._reply(**kwargs)
+
+    def stream(self, **kwargs):
+        return _StubStream(self._reply(**kwargs), self.delay)
+
+
+class StubAnthropicClient:
+    """Sostituto locale di anthropic.Anthropic per messages.create / messages.stream"""
+
+    def __init__(self, delay=0.02):
+        self.messages = _StubMessages(delay)
+
+
+CLAUDE_TIMEOUT_SECONDS = 60  # Timeout della singola richiesta HTTP
+CLAUDE_MAX_CONCURRENCY = 8  # Richieste contemporanee verso Claude per processo (= connessioni nel pool)
+CLAUDE_QUEUE_TIMEOUT_SECONDS = 10  # Attesa massima di uno slot libero
+CLAUDE_MAX_RETRIES = 3  # Tentativi extra su errori temporanei (rete, 429, 5xx, 529 overloaded)
+CLAUDE_BACKOFF_BASE_SECONDS = 0.5
+CLAUDE_BACKOFF_MAX_SECONDS = 8.0
+CLAUDE_SLOW_CALL_SECONDS = 20  # Sopra questa latenza la chiamata conta come fallita per il circuit breaker
+CLAUDE_BREAKER_FAILURES = 5  # Fallimenti consecutivi che aprono il circuito
+CLAUDE_BREAKER_COOLDOWN_SECONDS = 30  # Dopo questo tempo passa una richiesta di prova
+CLAUDE_LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60)  # Secondi, per gli istogrammi di latenza
+CLAUDE_RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class ClaudeUnavailable(Exception):
+    """Claude non raggiungibile ora: circuito aperto, nessuno slot libero o tentativi esauriti"""
+
+
+class CircuitBreaker:
+    """closed -> open dopo N fallimenti consecutivi -> half_open dopo il cooldown (una richiesta di prova)"""
+
+    def __init__(self, failure_threshold, cooldown_seconds):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= self.cooldown_seconds:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.trial_running = False
+
+    def release_trial(self):
+        """La chiamata di prova è finita senza dire nulla sulla salute del servizio (es. 400/401):
+        il breaker resta half_open e la prossima chiamata fa un'altra prova"""
+        with self.lock:
+            if self.state == 'half_open':
+                self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"Claude circuit breaker APERTO ({self.failures} fallimenti)")
+                self.state = 'open'
+                self.opened_at = time.time()
+
+
+class LatencyHistogram:
+    """Istogramma cumulativo (stile Prometheus) per tipo di chiamata ed esito"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, kind, outcome, seconds):
+        with self.lock:
+            serie = self.series.setdefault((kind, outcome), {
+                'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'sum': 0.0
+            })
+            for i, limit in enumerate(self.buckets):
+                if seconds <= limit:
+                    serie['buckets'][i] += 1
+            serie['buckets'][-1] += 1  # +Inf
+            serie['count'] += 1
+            serie['sum'] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return [{
+                'kind': kind,
+                'outcome': outcome,
+                'count': serie['count'],
+                'sum_seconds': round(serie['sum'], 3),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], serie['buckets'])),
+            } for (kind, outcome), serie in self.series.items()]
+
+    def prometheus(self, name, kind_labels, outcome_label, extra_labels=()):
+        """Righe *_bucket/_sum/_count in formato testo Prometheus; kind può essere una tupla di label"""
+        with self.lock:
+            series = [(kind, outcome, list(serie['buckets']), serie['sum'], serie['count'])
+                      for (kind, outcome), serie in self.series.items()]
+        lines = []
+        for kind, outcome, buckets, total, count in sorted(series, key=lambda x: (str(x[0]), str(x[1]))):
+            labels = list(zip(kind_labels, kind if isinstance(kind, tuple) else (kind,))) + \
+                [(outcome_label, outcome)] + list(extra_labels)
+            for le, value in zip([str(b) for b in self.buckets] + ['+Inf'], buckets):
+                lines.append(f'{name}_bucket{_prom_labels(labels + [("le", le)])} {value}')
+            lines.append(f'{name}_sum{_prom_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{_prom_labels(labels)} {count}')
+        return lines
+
+
+def _is_retryable(exc):
+    # Senza importare anthropic: gli errori HTTP hanno status_code, quelli di rete hanno questi nomi
+    if getattr(exc, 'status_code', None) in CLAUDE_RETRY_STATUS:
+        return True
+    return type(exc).__name__ in ('APIConnectionError', 'APITimeoutError') or \
+        isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def _retry_after(exc):
+    response = getattr(exc, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class ManagedStream:
+    """Stream aperto da ClaudeClientManager: tiene lo slot fino a close()"""
+
+    def __init__(self, manager, stream_manager, stream, started_at):
+        self.manager = manager
+        self.stream_manager = stream_manager
+        self.stream = stream
+        self.started_at = started_at
+        self.closed = False
 
+    @property
+    def text_stream(self):
+        return self.stream.text_stream
+
+    @property
+    def current_message_snapshot(self):
+        return getattr(self.stream, 'current_message_snapshot', None)
+
+    def get_final_message(self):
+        return self.stream.get_final_message()
+
+    def close(self, failed=False):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.stream_manager.__exit__(None, None, None)
+        finally:
+            elapsed = time.perf_counter() - self.started_at
+            self.manager.histogram.observe('stream', 'error' if failed else 'ok', elapsed)
+            request_metrics.note_claude(elapsed)
+            if failed:
+                self.manager.breaker.record_failure()
+            self.manager.slots.release()
+
+
+class ClaudeClientManager:
+    """Un solo client Anthropic per processo: pool HTTP keep-alive, concorrenza limitata,
+    retry con backoff esponenziale, istogrammi di latenza e circuit breaker."""
+
+    def __init__(self):
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(CLAUDE_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker(CLAUDE_BREAKER_FAILURES, CLAUDE_BREAKER_COOLDOWN_SECONDS)
+        self.histogram = LatencyHistogram(CLAUDE_LATENCY_BUCKETS)
+        self.counters_lock = threading.Lock()
+        self.retries = 0
+        self.rejected = 0
+
+    def _count(self, name):
+        with self.counters_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _get_client(self):
+        # Creato al primo uso: con gunicorn ogni worker ha il suo pool, aperto dopo il fork
+        with self.client_lock:
+            if self.client is None:
+                if CLAUDE_USE_STUB:
+                    self.client = StubAnthropicClient()
+                else:
+                    import anthropic
+                    import httpx
+                    self.client = anthropic.Anthropic(
+                        api_key=CLAUDE_API_KEY,
+                        max_retries=0,  # I retry li gestisce il manager
+                        timeout=httpx.Timeout(CLAUDE_TIMEOUT_SECONDS, connect=5.0),
+                        http_client=anthropic.DefaultHttpxClient(limits=httpx.Limits(
+                            max_connections=CLAUDE_MAX_CONCURRENCY,
+                            max_keepalive_connections=CLAUDE_MAX_CONCURRENCY,
+                            keepalive_expiry=60
+                        ))
+                    )
+            return self.client
+
+    def _acquire(self):
+        if not self.breaker.allow():
+            self._count('rejected')
+            raise ClaudeUnavailable('circuit breaker aperto')
+        if not self.slots.acquire(timeout=CLAUDE_QUEUE_TIMEOUT_SECONDS):
+            # Saturazione locale (stream lunghi, picchi), non un guasto di Claude: il breaker non conta.
+            # Se allow() aveva concesso la prova half_open va liberata
+            self._count('rejected')
+            self.breaker.release_trial()
+            raise ClaudeUnavailable('nessuno slot libero')
+
+    def _with_retries(self, kind, call):
+        """Esegue call() con backoff esponenziale sugli errori temporanei"""
+        for attempt in range(CLAUDE_MAX_RETRIES + 1):
+            started_at = time.perf_counter()
+            try:
+                result = call()
+            except Exception as e:
+                self.histogram.observe(kind, 'error', time.perf_counter() - started_at)
+                if not _is_retryable(e):
+                    # Errore della richiesta, non del servizio: non conta come fallimento,
+                    # ma se era la prova half_open va liberata o il breaker resta bloccato
+                    self.breaker.release_trial()
+                    raise
+                if attempt == CLAUDE_MAX_RETRIES:
+                    self.breaker.record_failure()
+                    raise ClaudeUnavailable(f'{type(e).__name__} dopo {attempt + 1} tentativi') from e
+                self._count('retries')
+                delay = _retry_after(e) or min(CLAUDE_BACKOFF_MAX_SECONDS, CLAUDE_BACKOFF_BASE_SECONDS * 2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay / 2))
+                continue
+
+            elapsed = time.perf_counter() - started_at
+            self.histogram.observe(kind, 'ok', elapsed)
+            if elapsed > CLAUDE_SLOW_CALL_SECONDS:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return result
+
+    def create(self, **params):
+        """Come client.messages.create"""
+        self._acquire()
+        started_at = time.perf_counter()
+        try:
+            client = self._get_client()
+            return self._with_retries('create', lambda: client.messages.create(**params))
+        except Exception:
+            self.breaker.release_trial()  # Già no-op se l'esito è stato registrato
+            raise
+        finally:
+            self.slots.release()
+            request_metrics.note_claude(time.perf_counter() - started_at)  # Retry e backoff compresi
+
+    def open_stream(self, **params):
+        """Come client.messages.stream, ma già connesso (i retry valgono fino all'apertura).
+        Chi lo usa deve chiamare close() alla fine (in una view: Response.call_on_close)."""
+        self._acquire()
+        try:
+            client = self._get_client()
+
+            def open_call():
+                stream_manager = client.messages.stream(**params)
+                return stream_manager, stream_manager.__enter__()
+
+            started_at = time.perf_counter()
+            stream_manager, stream = self._with_retries('stream_open', open_call)
+        except Exception:
+            self.breaker.release_trial()  # Già no-op se l'esito è stato registrato
+            self.slots.release()
+            raise
+        return ManagedStream(self, stream_manager, stream, started_at)
+
+    def stats(self):
+        return {
+            'stub': CLAUDE_USE_STUB,
+            'breaker_state': self.breaker.state,
+            'breaker_failures': self.breaker.failures,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'latency': self.histogram.snapshot(),
+        }
+
+
+claude = ClaudeClientManager()
+
+
+def build_system_prompt(user):
+    """System prompt con preferenze e contesto dell'utente"""
     # Carica preferenze
-    prefs = UserChatPreferences.query.filter_by(user_id=current_user.id).first()
+    prefs = UserChatPreferences.query.filter_by(user_id=user.id).first()
 
     # System prompt personalizzato
     tone_map = {
@@ -1164,9 +2721,9 @@ def chat_api():
     length = length_map.get(prefs.response_length if prefs else 'concise', 'concise')
     custom = prefs.custom_instructions if prefs and prefs.custom_instructions else ''
 
-    user_context = get_user_context(current_user)
+    user_context = get_user_context(user)
 
-    system_prompt = f"""Sei l'assistente AI di Adelchi Group.
+    return f"""Sei l'assistente AI di Adelchi Group.
 
 {user_context}
 
@@ -1183,8 +2740,10 @@ REGOLE:
 
 SERVIZI ADELCHI: Biotech, IT, Difesa, Fintech"""
 
-    # Chiamata Claude
-    message = client.messages.create(
+
+def claude_request(system_prompt, user_message):
+    """Parametri comuni a messages.create e messages.stream"""
+    return dict(
         model=CLAUDE_MODEL,
         max_tokens=RESPONSE_MAX_TOKENS,
         system=system_prompt,
@@ -1192,20 +2751,48 @@ SERVIZI ADELCHI: Biotech, IT, Difesa, Fintech"""
         tools=[{"type": "web_search_20250305", "name": "web_search"}]
     )
 
-    # Estrai risposta
-    response_text = ""
-    for block in message.content:
-        if hasattr(block, 'text'):
-            response_text += block.text
 
-    if not response_text:
-        response_text = "Mi dispiace, non ho trovato informazioni rilevanti."
+KB_FALLBACK_THRESHOLD = 0.25  # Con Claude non disponibile basta una somiglianza più bassa
+SEMANTIC_KB_FALLBACK_THRESHOLD = 0.7
+CLAUDE_UNAVAILABLE_MESSAGE = "L'assistente AI è momentaneamente non disponibile, riprova tra poco."
+
+
+def fallback_knowledge_answer(user_message):
+    """Risposta della Knowledge Base con soglie ridotte, usata quando Claude non risponde"""
+    best_id, score = knowledge_index.best_match(user_message, threshold=KB_FALLBACK_THRESHOLD)
+    if best_id is None and semantic_index.enabled:
+        try:
+            best_id, score = semantic_index.best_match(user_message)
+        except Exception:
+            best_id = None
+        if score < SEMANTIC_KB_FALLBACK_THRESHOLD:
+            best_id = None
+    entry = db.session.get(SharedKnowledge, best_id) if best_id is not None else None
+    if entry is None or not entry.is_approved:
+        return None, 0
+    return entry, score
 
-    # Salva
-    total_tokens = message.usage.input_tokens + message.usage.output_tokens
+
+def save_kb_answer(user_id, user_message, entry, match_kind):
+    """Usa la risposta della Knowledge Base e la salva nel log"""
+    entry.usage_count += 1
 
     chat_message = ChatMessage(
-        user_id=current_user.id,
+        user_id=user_id,
+        message=user_message,
+        response=entry.answer,
+        tokens_used=0,  # Gratis da cache
+        model={'lexical': 'knowledge-base', 'semantic': 'knowledge-base-semantic'}.get(match_kind, 'knowledge-base-fallback')
+    )
+    db.session.add(chat_message)
+    db.session.commit()
+    return chat_message
+
+
+def save_claude_answer(user_id, user_message, response_text, total_tokens):
+    """Salva il messaggio e aggiorna l'uso giornaliero in un solo commit; ritorna (ChatMessage, token usati oggi)"""
+    chat_message = ChatMessage(
+        user_id=user_id,
         message=user_message,
         response=response_text,
         tokens_used=total_tokens,
@@ -1213,23 +2800,190 @@ SERVIZI ADELCHI: Biotech, IT, Difesa, Fintech"""
     )
     db.session.add(chat_message)
 
-    usage = get_daily_usage(current_user.id)
-    usage.tokens_used += total_tokens
-    usage.messages_count += 1
+    tokens_today = add_chat_usage(user_id, total_tokens)
     db.session.commit()
+    return chat_message, tokens_today
+
+
+@app.route('/api/chat', methods=['POST'])
+@login_required
+@query_budget(11, max_repeats=2)
+def chat_api():
+    """Chat con Knowledge Base integrato"""
+
+    if not check_token_limit(current_user.id):
+        return jsonify({'success': False, 'message': 'Limite giornaliero raggiunto', 'limit_reached': True})
+
+    data = request.get_json()
+    user_message = data.get('message', '').strip()
+
+    if not user_message:
+        return jsonify({'success': False, 'message': 'Messaggio vuoto'})
+
+    # 1. CERCA IN KNOWLEDGE BASE (per parole, poi semantica)
+    best_match, match_kind, match_score = find_knowledge_answer(user_message)
+
+    # Se match trovato, usa risposta cached
+    if best_match:
+        chat_message = save_kb_answer(current_user.id, user_message, best_match, match_kind)
+
+        return jsonify({
+            'success': True,
+            'response': best_match.answer,
+            'from_kb': True,
+            'kb_match': match_kind,
+            'kb_score': round(match_score, 3),
+            'tokens_used': 0,
+            'message_id': chat_message.id
+        })
+
+    # 2. ALTRIMENTI CHIAMA CLAUDE CON PREFERENZE
+    system_prompt = build_system_prompt(current_user)
+
+    # Chiamata Claude (client condiviso); se non disponibile si ripiega sulla Knowledge Base
+    try:
+        message = claude.create(**claude_request(system_prompt, user_message))
+    except ClaudeUnavailable as e:
+        print(f"Claude non disponibile ({e}): uso la Knowledge Base")
+        entry, score = fallback_knowledge_answer(user_message)
+        if entry is None:
+            return jsonify({'success': False, 'message': CLAUDE_UNAVAILABLE_MESSAGE, 'unavailable': True})
+        chat_message = save_kb_answer(current_user.id, user_message, entry, 'fallback')
+        return jsonify({
+            'success': True,
+            'response': entry.answer,
+            'from_kb': True,
+            'kb_match': 'fallback',
+            'kb_score': round(score, 3),
+            'tokens_used': 0,
+            'message_id': chat_message.id
+        })
+
+    # Estrai risposta
+    response_text = ""
+    for block in message.content:
+        if hasattr(block, 'text'):
+            response_text += block.text
+
+    if not response_text:
+        response_text = "Mi dispiace, non ho trovato informazioni rilevanti."
+
+    # Salva
+    total_tokens = message.usage.input_tokens + message.usage.output_tokens
+    chat_message, tokens_today = save_claude_answer(current_user.id, user_message, response_text, total_tokens)
 
     return jsonify({
         'success': True,
         'response': response_text,
         'from_kb': False,
         'tokens_used': total_tokens,
-        'remaining_tokens': DAILY_TOKEN_LIMIT - usage.tokens_used,
+        'remaining_tokens': DAILY_TOKEN_LIMIT - tokens_today,
         'message_id': chat_message.id
     })
 
 
+def _sse(event, payload):
+    """Un evento Server-Sent Events con payload JSON"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+@query_budget(11, max_repeats=2)
+def chat_stream_api():
+    """Come /api/chat ma la risposta arriva a pezzi (SSE): eventi token, done, error"""
+    if not check_token_limit(current_user.id):
+        return jsonify({'success': False, 'message': 'Limite giornaliero raggiunto', 'limit_reached': True})
+
+    data = request.get_json()
+    user_message = data.get('message', '').strip()
+
+    if not user_message:
+        return jsonify({'success': False, 'message': 'Messaggio vuoto'})
+
+    user_id = current_user.id
+    best_match, match_kind, match_score = find_knowledge_answer(user_message)
+
+    stream = None
+    if not best_match:
+        try:
+            stream = claude.open_stream(**claude_request(build_system_prompt(current_user), user_message))
+        except ClaudeUnavailable as e:
+            print(f"Claude non disponibile ({e}): uso la Knowledge Base")
+            best_match, match_score = fallback_knowledge_answer(user_message)
+            match_kind = 'fallback'
+            if best_match is None:
+                return jsonify({'success': False, 'message': CLAUDE_UNAVAILABLE_MESSAGE, 'unavailable': True})
+
+    if best_match:
+        chat_message = save_kb_answer(user_id, user_message, best_match, match_kind)
+        # Letti qui: il generatore gira dopo la fine della richiesta, con la sessione già chiusa
+        answer, message_id = best_match.answer, chat_message.id
+
+        def kb_events():
+            yield _sse('token', {'text': answer})
+            yield _sse('done', {
+                'success': True,
+                'from_kb': True,
+                'kb_match': match_kind,
+                'kb_score': round(match_score, 3),
+                'tokens_used': 0,
+                'message_id': message_id
+            })
+
+        return Response(kb_events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    def claude_events():
+        parts = []
+        final_message = None
+        upstream_error = False
+        try:
+            for text in stream.text_stream:
+                parts.append(text)
+                yield _sse('token', {'text': text})
+            final_message = stream.get_final_message()
+        except Exception as e:
+            upstream_error = True
+            print(f"Errore streaming Claude: {e}")
+            yield _sse('error', {'success': False, 'message': 'Errore durante la generazione'})
+        finally:
+            stream.close(failed=upstream_error)
+            # Connessione chiusa dal browser o errore a metà: si salva quello che è già arrivato
+            if final_message is None and parts:
+                snapshot = stream.current_message_snapshot
+                partial_tokens = snapshot.usage.input_tokens + snapshot.usage.output_tokens if snapshot else 0
+                save_claude_answer(user_id, user_message, ''.join(parts), partial_tokens)
+
+        if final_message is None:
+            return
+
+        response_text = ''.join(parts)
+        if not response_text:
+            response_text = "Mi dispiace, non ho trovato informazioni rilevanti."
+            yield _sse('token', {'text': response_text})
+
+        total_tokens = final_message.usage.input_tokens + final_message.usage.output_tokens
+        chat_message, tokens_today = save_claude_answer(user_id, user_message, response_text, total_tokens)
+        yield _sse('done', {
+            'success': True,
+            'from_kb': False,
+            'tokens_used': total_tokens,
+            'remaining_tokens': DAILY_TOKEN_LIMIT - tokens_today,
+            'message_id': chat_message.id
+        })
+
+    response = Response(stream_with_context(claude_events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Se il browser chiude prima che il generatore parta il suo finally non gira:
+    # slot e stream vanno rilasciati qui (close() è idempotente)
+    response.call_on_close(stream.close)
+    return response
+
+
 @app.route('/api/chat/usage')
 @login_required
+@query_budget(2, max_repeats=1)
 def chat_usage():
     """Statistiche uso chatbot"""
     usage = get_daily_usage(current_user.id)
@@ -1242,6 +2996,28 @@ def chat_usage():
         'messages_today': usage.messages_count,
         'percentage_used': round((usage.tokens_used / DAILY_TOKEN_LIMIT) * 100, 1)
     })
+
+
+@app.route('/api/chat/claude-stats')
+@login_required
+@query_budget(1, max_repeats=1)
+def chat_claude_stats():
+    """Stato del client Claude del worker: circuit breaker, retry e latenze"""
+    return jsonify(claude.stats())
+
+
+@app.route('/api/chat/kb-stats')
+@login_required
+@query_budget(2, max_repeats=1)
+def chat_kb_stats():
+    """Hit rate della Knowledge Base per categoria (contatori del worker corrente)"""
+    return jsonify({
+        'semantic_enabled': semantic_index.enabled,
+        'semantic_threshold': SEMANTIC_KB_THRESHOLD,
+        'semantic_thresholds_by_category': SEMANTIC_KB_THRESHOLDS,
+        'indexed_entries': len(semantic_index.entries) if semantic_index.loaded else None,
+        'categories': kb_metrics.snapshot(_average_claude_tokens())
+    })
 # =============================================================================
 # AUTHENTICATION ROUTES
 # =============================================================================
@@ -1249,6 +3025,8 @@ def chat_usage():
 import urllib.parse
 
 @app.route('/register', methods=['GET', 'POST'])
+@query_budget(1, max_repeats=1)
+@query_budget(9, max_repeats=3, method='POST')
 def register():
     # Recupera dati ADG dalla query string
     adg_data_param = request.args.get('adg_data')
@@ -1282,7 +3060,7 @@ def register():
 
         # Bonus registrazione base: 10 ADG
         total_bonus = blockchain.registration_reward
-        blockchain.reward_user(new_user, total_bonus, 'registration')
+        blockchain.reward_user(new_user, total_bonus, 'registration', sync=True)
 
         # ⭐ BONUS ESPLORAZIONE SITO
         if adg_exploration_data:
@@ -1290,7 +3068,7 @@ def register():
 
             if exploration_bonus > 0:
                 # Aggiungi bonus esplorazione
-                blockchain.reward_user(new_user, exploration_bonus, 'site_exploration')
+                blockchain.reward_user(new_user, exploration_bonus, 'site_exploration', sync=True)
                 total_bonus += exploration_bonus
 
                 # Crea nota riepilogo esplorazione
@@ -1330,6 +3108,8 @@ def register():
                            adg_preview=adg_exploration_data.get('total', 0) if adg_exploration_data else 0)
 
 @app.route('/login', methods=['GET', 'POST'])
+@query_budget(1, max_repeats=1)
+@query_budget(2, max_repeats=1, method='POST')
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -1350,6 +3130,7 @@ def login():
 
 @app.route('/logout')
 @login_required
+@query_budget(1, max_repeats=1)
 def logout():
     logout_user()
     return redirect(url_for('index'))
@@ -1361,19 +3142,95 @@ def logout():
 # BLOCKCHAIN ROUTES
 # =============================================================================
 
+WALLET_HISTORY_PAGE_SIZE = 20
+WALLET_HISTORY_MAX_PAGE_SIZE = 100
+
+
+def _encode_history_cursor(timestamp, tx_id, balance):
+    raw = json.dumps([timestamp.isoformat(), tx_id, balance])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_history_cursor(cursor):
+    timestamp, tx_id, balance = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(timestamp), int(tx_id), float(balance)
+
+
+def wallet_history(wallet_address, current_balance, limit=WALLET_HISTORY_PAGE_SIZE, cursor=None):
+    """Una pagina di storico, dalla più recente, con il saldo dopo ogni transazione.
+
+    Keyset su (timestamp, id): entrate e uscite sono due range scan sugli indici
+    composti, uniti in Python. Il saldo parte da quello attuale e scende pagina per
+    pagina; il cursore si porta dietro il saldo raggiunto, quindi ogni pagina costa
+    O(limit) anche con centinaia di migliaia di transazioni."""
+    balance = current_balance
+    after = None
+    if cursor:
+        after_timestamp, after_id, balance = _decode_history_cursor(cursor)
+        after = (after_timestamp, after_id)
+
+    rows = []
+    for column in (Transaction.to_wallet, Transaction.from_wallet):
+        query = Transaction.query.filter(column == wallet_address)
+        if after:
+            query = query.filter(db.tuple_(Transaction.timestamp, Transaction.id) < after)
+        rows.extend(query.order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(limit + 1).all())
+
+    rows = sorted({tx.id: tx for tx in rows}.values(), key=lambda tx: (tx.timestamp, tx.id), reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    page = []
+    for tx in rows:
+        incoming = tx.to_wallet == wallet_address
+        page.append({
+            'id': tx.id,
+            'tx_hash': tx.tx_hash,
+            'tx_type': tx.tx_type,
+            'amount': tx.amount,
+            'direction': 'in' if incoming else 'out',
+            'from_wallet': tx.from_wallet,
+            'to_wallet': tx.to_wallet,
+            'timestamp': tx.timestamp,
+            'block_height': tx.block_height,
+            'balance_after': round(balance, 4),
+        })
+        # Saldo prima di questa transazione = saldo dopo la precedente (più vecchia)
+        balance -= tx.amount if incoming else -tx.amount
+
+    next_cursor = _encode_history_cursor(rows[-1].timestamp, rows[-1].id, balance) if has_more else None
+    return page, next_cursor
+
+
+def _history_request_args():
+    limit = min(max(request.args.get('limit', WALLET_HISTORY_PAGE_SIZE, type=int), 1), WALLET_HISTORY_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor') or None
+    if cursor:
+        try:
+            _decode_history_cursor(cursor)
+        except (ValueError, TypeError):
+            cursor = None
+    return limit, cursor
+
+
 @app.route('/wallet')
 @login_required
+@query_budget(3, max_repeats=1)
 def wallet():
     """Dashboard wallet personale ADG"""
+    # Scrive le ricompense in coda in QUESTO worker. Quelle in coda negli altri worker
+    # (code solo in memoria) non sono ancora nel saldo: arrivano entro REWARD_FLUSH_SECONDS,
+    # o subito con REWARD_WRITE_BEHIND = False
+    reward_ledger.flush()
+
     # Assicura che l'utente abbia un wallet
     if not current_user.wallet_address:
         current_user.wallet_address = blockchain.generate_wallet_address(current_user.id)
         db.session.commit()
 
-    # Ottieni transazioni dell'utente
-    transactions = Transaction.query.filter_by(to_wallet=current_user.wallet_address) \
-        .order_by(Transaction.timestamp.desc()) \
-        .limit(20).all()
+    # Ottieni transazioni dell'utente (una pagina, ?cursor= per le precedenti)
+    limit, cursor = _history_request_args()
+    transactions, next_cursor = wallet_history(current_user.wallet_address, current_user.balance, limit, cursor)
 
     # Dati wallet
     wallet_data = {
@@ -1385,11 +3242,35 @@ def wallet():
     return render_template('wallet.html',
                            wallet=wallet_data,
                            transactions=transactions,
+                           next_cursor=next_cursor,
                            current_user=current_user)
 
 
+@app.route('/api/wallet/history')
+@login_required
+@query_budget(3, max_repeats=1)
+def wallet_history_api():
+    """Storico transazioni paginato: ?limit=&cursor= (next_cursor nella risposta).
+    Come /wallet: può mancare chi è ancora in coda negli altri worker (al massimo REWARD_FLUSH_SECONDS)"""
+    reward_ledger.flush()
+    if not current_user.wallet_address:
+        return jsonify({'transactions': [], 'next_cursor': None})
+
+    limit, cursor = _history_request_args()
+    transactions, next_cursor = wallet_history(current_user.wallet_address, current_user.balance, limit, cursor)
+    for tx in transactions:
+        tx['timestamp'] = tx['timestamp'].isoformat()
+    return jsonify({
+        'wallet_address': current_user.wallet_address,
+        'balance': current_user.balance,
+        'transactions': transactions,
+        'next_cursor': next_cursor
+    })
+
+
 @app.route('/mining')
 @login_required
+@query_budget(5, max_repeats=1)
 def mining():
     """Dashboard mining ADG"""
     # Ottieni miners dell'utente
@@ -1406,6 +3287,7 @@ def mining():
 
 @app.route('/mining/register', methods=['POST'])
 @login_required
+@query_budget(5, max_repeats=2)
 def register_miner():
     """Registra un nuovo miner RTX3060"""
     try:
@@ -1449,6 +3331,7 @@ def register_miner():
 
 @app.route('/files')
 @login_required
+@query_budget(2, max_repeats=1)
 def files_dashboard():
     files = UserFile.query.filter_by(user_id=current_user.id).order_by(UserFile.uploaded_at.desc()).all()
 
@@ -1469,6 +3352,7 @@ def files_dashboard():
 
 @app.route('/upload_file', methods=['POST'])
 @login_required
+@query_budget(5, max_repeats=2)
 def upload_file():
     """Upload singolo file con ricompensa ADG"""
     try:
@@ -1531,6 +3415,7 @@ def upload_file():
 
 @app.route('/download_file/<int:file_id>')
 @login_required
+@query_budget(2, max_repeats=1)
 def download_file(file_id):
     """Download file"""
     file_record = UserFile.query.filter_by(id=file_id, user_id=current_user.id).first()
@@ -1553,6 +3438,7 @@ def download_file(file_id):
 
 @app.route('/delete_file/<int:file_id>', methods=['POST'])
 @login_required
+@query_budget(5, max_repeats=1)
 def delete_file(file_id):
     """Elimina file"""
     file_record = UserFile.query.filter_by(id=file_id, user_id=current_user.id).first()
@@ -1579,8 +3465,157 @@ def delete_file(file_id):
 # NOTES MANAGEMENT ROUTES
 # =============================================================================
 
+# ===== RICERCA FULL-TEXT NOTE (SQLite FTS5) =====
+# Indice esterno su user_note: i trigger lo tengono allineato a ogni INSERT/UPDATE/DELETE,
+# anche quelli fatti fuori dall'ORM. Se SQLite non ha FTS5 si torna al LIKE.
+NOTES_FTS_AVAILABLE = False
+NOTES_SEARCH_PAGE_SIZE = 20
+NOTES_SEARCH_MAX_PAGE_SIZE = 100
+NOTES_FTS_WEIGHTS = (10.0, 1.0, 5.0)  # bm25: titolo, contenuto, tag
+
+NOTES_FTS_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS user_note_fts USING fts5(
+        title, content, tags,
+        content='user_note', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS user_note_fts_ai AFTER INSERT ON user_note BEGIN
+        INSERT INTO user_note_fts(rowid, title, content, tags) VALUES (new.id, new.title, new.content, new.tags);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_note_fts_ad AFTER DELETE ON user_note BEGIN
+        INSERT INTO user_note_fts(user_note_fts, rowid, title, content, tags)
+        VALUES ('delete', old.id, old.title, old.content, old.tags);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_note_fts_au AFTER UPDATE OF title, content, tags ON user_note BEGIN
+        INSERT INTO user_note_fts(user_note_fts, rowid, title, content, tags)
+        VALUES ('delete', old.id, old.title, old.content, old.tags);
+        INSERT INTO user_note_fts(rowid, title, content, tags) VALUES (new.id, new.title, new.content, new.tags);
+    END""",
+)
+
+_SNIPPET_START, _SNIPPET_END = '\x02', '\x03'
+
+
+def _migrate_notes_fts():
+    """Crea indice FTS5 e trigger; al primo avvio indicizza le note esistenti"""
+    global NOTES_FTS_AVAILABLE
+    try:
+        existed = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_note_fts'"
+        )).first() is not None
+        for statement in NOTES_FTS_DDL:
+            db.session.execute(db.text(statement))
+        if not existed:
+            db.session.execute(db.text("INSERT INTO user_note_fts(user_note_fts) VALUES ('rebuild')"))
+        # Colonna nascosta rank = bm25 pesato, così ORDER BY rank usa i pesi
+        db.session.execute(db.text(
+            "INSERT INTO user_note_fts(user_note_fts, rank) VALUES ('rank', :rank)"
+        ), {'rank': 'bm25(%s, %s, %s)' % NOTES_FTS_WEIGHTS})
+        db.session.commit()
+        NOTES_FTS_AVAILABLE = True
+        if not existed:
+            print(f"Note FTS5: indicizzate {UserNote.query.count()} note")
+    except Exception as e:
+        db.session.rollback()
+        NOTES_FTS_AVAILABLE = False
+        print(f"Note FTS5 non disponibile, ricerca con LIKE: {e}")
+
+
+def notes_fts_query(text):
+    """Testo libero -> query FTS5: ogni parola tra virgolette (niente sintassi FTS dall'utente)
+    e con * per la ricerca per prefisso; le parole vanno tutte trovate"""
+    words = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def notes_fts_matches(fts_query):
+    """Subquery (note_id, rank) delle note che corrispondono, da unire a UserNote"""
+    return db.select(
+        db.literal_column('user_note_fts.rowid').label('note_id'),
+        db.literal_column('user_note_fts.rank').label('rank'),
+    ).select_from(db.text('user_note_fts')) \
+        .where(db.text('user_note_fts MATCH :fts_query').bindparams(fts_query=fts_query)) \
+        .subquery()
+
+
+def _highlight(fragment):
+    """Escape HTML del testo della nota, poi i marcatori di FTS5 diventano <mark>"""
+    return str(escape(fragment or '')).replace(_SNIPPET_START, '<mark>').replace(_SNIPPET_END, '</mark>')
+
+
+def search_notes(user_id, text, page=1, per_page=NOTES_SEARCH_PAGE_SIZE):
+    """Note dell'utente ordinate per pertinenza, con titolo evidenziato e snippet del contenuto.
+    Ritorna (risultati, totale)."""
+    fts_query = notes_fts_query(text)
+    if not fts_query:
+        return [], 0
+
+    if not NOTES_FTS_AVAILABLE:
+        query = UserNote.query.filter(UserNote.user_id == user_id,
+                                      UserNote.title.contains(text) | UserNote.content.contains(text))
+        total = query.count()
+        notes = query.order_by(UserNote.updated_at.desc()).offset((page - 1) * per_page).limit(per_page).all()
+        return [{
+            'id': note.id, 'title': note.title, 'title_highlight': _highlight(note.title),
+            'snippet': _highlight(note.content[:200]), 'note_type': note.note_type,
+            'priority': note.priority, 'tags': note.tags, 'score': None,
+            'updated_at': note.updated_at.isoformat() if note.updated_at else None
+        } for note in notes], total
+
+    params = {'q': fts_query, 'user_id': user_id, 'start': _SNIPPET_START, 'end': _SNIPPET_END}
+    total = db.session.execute(db.text(
+        "SELECT COUNT(*) FROM user_note_fts JOIN user_note n ON n.id = user_note_fts.rowid "
+        "WHERE user_note_fts MATCH :q AND n.user_id = :user_id"
+    ), params).scalar()
+    rows = db.session.execute(db.text(
+        "SELECT n.id, n.note_type, n.priority, n.tags, n.updated_at, user_note_fts.rank, "
+        "highlight(user_note_fts, 0, :start, :end), "
+        "snippet(user_note_fts, 1, :start, :end, '…', 24) "
+        "FROM user_note_fts JOIN user_note n ON n.id = user_note_fts.rowid "
+        "WHERE user_note_fts MATCH :q AND n.user_id = :user_id "
+        "ORDER BY user_note_fts.rank LIMIT :limit OFFSET :offset"
+    ), dict(params, limit=per_page, offset=(page - 1) * per_page)).fetchall()
+
+    results = []
+    for note_id, note_type, priority, tags, updated_at, rank, title, snippet in rows:
+        results.append({
+            'id': note_id,
+            'title': title.replace(_SNIPPET_START, '').replace(_SNIPPET_END, ''),
+            'title_highlight': _highlight(title),
+            'snippet': _highlight(snippet),
+            'note_type': note_type,
+            'priority': priority,
+            'tags': tags,
+            'score': round(-rank, 4),  # bm25: più negativo = più pertinente
+            'updated_at': str(updated_at) if updated_at else None
+        })
+    return results, total
+
+
+@app.route('/api/notes/search')
+@login_required
+@query_budget(3, max_repeats=1)
+def notes_search_api():
+    """Ricerca full-text nelle note: ?q=&page=&per_page="""
+    text = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', NOTES_SEARCH_PAGE_SIZE, type=int), 1),
+                   NOTES_SEARCH_MAX_PAGE_SIZE)
+
+    results, total = search_notes(current_user.id, text, page, per_page)
+    return jsonify({
+        'query': text,
+        'results': results,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'has_more': page * per_page < total
+    })
+
+
 @app.route('/notes')
 @login_required
+@query_budget(6, max_repeats=1)
 def notes_dashboard():
     """Dashboard unificata Note + Files"""
     # Filtri note
@@ -1594,11 +3629,18 @@ def notes_dashboard():
         query = query.filter_by(note_type=note_type)
     if priority:
         query = query.filter_by(priority=priority)
-    if search:
-        query = query.filter(UserNote.title.contains(search) |
-                             UserNote.content.contains(search))
+    fts_query = notes_fts_query(search) if search and NOTES_FTS_AVAILABLE else ''
+    if fts_query:
+        matches = notes_fts_matches(fts_query)
+        query = query.join(matches, matches.c.note_id == UserNote.id) \
+            .order_by(matches.c.rank, UserNote.updated_at.desc())
+    else:
+        if search:
+            query = query.filter(UserNote.title.contains(search) |
+                                 UserNote.content.contains(search))
+        query = query.order_by(UserNote.updated_at.desc())
 
-    notes = query.order_by(UserNote.updated_at.desc()).all()
+    notes = query.all()
 
     # Statistiche note
     total_notes = UserNote.query.filter_by(user_id=current_user.id).count()
@@ -1624,6 +3666,8 @@ def notes_dashboard():
 
 @app.route('/create_note', methods=['GET', 'POST'])
 @login_required
+@query_budget(3, max_repeats=1)
+@query_budget(5, max_repeats=2, method='POST')
 def create_note():
     """Crea nuova nota"""
     # ⭐ Leggi project_id dalla query string
@@ -1683,6 +3727,8 @@ def create_note():
 
 @app.route('/edit_note/<int:note_id>', methods=['GET', 'POST'])
 @login_required
+@query_budget(5, max_repeats=1)
+@query_budget(3, max_repeats=1, method='POST')
 def edit_note(note_id):
     """Modifica nota esistente"""
     note = UserNote.query.filter_by(id=note_id, user_id=current_user.id).first()
@@ -1759,6 +3805,7 @@ def edit_note(note_id):
 
 @app.route('/delete_note/<int:note_id>', methods=['POST'])
 @login_required
+@query_budget(5, max_repeats=1)
 def delete_note(note_id):
     """Elimina nota"""
     note = UserNote.query.filter_by(id=note_id, user_id=current_user.id).first()
@@ -1784,6 +3831,7 @@ def delete_note(note_id):
 #############UPLOAD IMMAGINI
 @app.route('/uploads/<filename>')
 @login_required
+@query_budget(2, max_repeats=1)
 def serve_upload(filename):
     """Serve file caricati"""
     file_record = UserFile.query.filter_by(filename=filename, user_id=current_user.id).first()
@@ -1805,12 +3853,237 @@ def attach_image_to_note(note_id):
     return jsonify({'success': True, 'image_url': url})
 
 
+# =============================================================================
+# METRICHE E PROFILING RICHIESTE
+# =============================================================================
+
+METRICS_ENABLED = os.environ.get('ADG_METRICS', '1') == '1'
+METRICS_TOKEN = os.environ.get('ADG_METRICS_TOKEN')  # Bearer token per lo scraper Prometheus
+REQUEST_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LEDGER_FLUSH_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+SLOW_REQUEST_SECONDS = 1.0  # Oltre questa durata la richiesta finisce nel log con il suo SQL
+SLOW_REQUEST_MAX_SQL = 50  # Query conservate per richiesta (le altre contano solo nei totali)
+SLOW_REQUEST_LOG_SIZE = 50  # Richieste lente tenute in memoria per /admin/slow-requests
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class RequestMetrics:
+    """Metriche per route di questo processo (con gunicorn ognuno ha le sue, label worker).
+
+    Durante la richiesta i contatori stanno in un threading.local, senza lock;
+    il lock serve solo a fine richiesta per sommarli ai totali della route."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latency = LatencyHistogram(REQUEST_LATENCY_BUCKETS)
+        self.ledger_flush_latency = LatencyHistogram(LEDGER_FLUSH_BUCKETS)
+        self.routes = {}  # route -> [sql_queries, sql_seconds, ledger_writes, claude_seconds]
+        self.ledger_flushed_total = 0
+        self.slow_requests = deque(maxlen=SLOW_REQUEST_LOG_SIZE)
+
+    def _current(self):
+        return getattr(self.local, 'profile', None)
+
+    def _add_background(self, index, amount):
+        # Lavoro fuori da una richiesta (thread del ledger, init_db, CLI)
+        with self.lock:
+            self.routes.setdefault('-', [0, 0.0, 0, 0.0])[index] += amount
+
+    def start(self):
+        self.local.profile = {
+            'started_at': time.perf_counter(), 'status': 500,
+            'sql_queries': 0, 'sql_seconds': 0.0, 'sql': [],
+            'ledger_writes': 0, 'claude_seconds': 0.0,
+        }
+
+    def note_sql(self, statement, seconds):
+        profile = self._current()
+        if profile is None:
+            self._add_background(0, 1)
+            self._add_background(1, seconds)
+            return
+        profile['sql_queries'] += 1
+        profile['sql_seconds'] += seconds
+        if len(profile['sql']) < SLOW_REQUEST_MAX_SQL:
+            profile['sql'].append((statement, seconds))
+
+    def note_ledger_write(self):
+        profile = self._current()
+        if profile is None:
+            self._add_background(2, 1)
+        else:
+            profile['ledger_writes'] += 1
+
+    def note_claude(self, seconds):
+        profile = self._current()
+        if profile is None:
+            self._add_background(3, seconds)
+        else:
+            profile['claude_seconds'] += seconds
+
+    def ledger_flushed(self, entries, seconds):
+        self.ledger_flush_latency.observe('flush', 'ok', seconds)
+        with self.lock:
+            self.ledger_flushed_total += entries
+
+    def finish(self, route, method):
+        profile = self._current()
+        if profile is None:
+            return
+        self.local.profile = None
+        elapsed = time.perf_counter() - profile['started_at']
+        self.latency.observe((route, method), str(profile['status']), elapsed)
+        with self.lock:
+            totals = self.routes.setdefault(route, [0, 0.0, 0, 0.0])
+            totals[0] += profile['sql_queries']
+            totals[1] += profile['sql_seconds']
+            totals[2] += profile['ledger_writes']
+            totals[3] += profile['claude_seconds']
+
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            entry = {
+                'at': datetime.utcnow().isoformat(),
+                'route': route,
+                'method': method,
+                'status': profile['status'],
+                'seconds': round(elapsed, 3),
+                'sql_queries': profile['sql_queries'],
+                'sql_seconds': round(profile['sql_seconds'], 3),
+                'claude_seconds': round(profile['claude_seconds'], 3),
+                'sql': [{'statement': statement, 'ms': round(seconds * 1000, 2)}
+                        for statement, seconds in profile['sql']],
+            }
+            self.slow_requests.append(entry)
+            print(f"Richiesta lenta: {method} {route} {elapsed:.2f}s, "
+                  f"{profile['sql_queries']} query SQL ({profile['sql_seconds']:.3f}s), "
+                  f"Claude {profile['claude_seconds']:.2f}s")
+            for statement, seconds in profile['sql']:
+                print(f"  {seconds * 1000:8.2f} ms  {' '.join(statement.split())[:300]}")
+
+    def prometheus(self):
+        worker = [('worker', WORKER_ID)]
+        with self.lock:
+            routes = sorted(self.routes.items())
+            flushed = self.ledger_flushed_total
+        lines = [
+            '# HELP adg_http_request_duration_seconds Durata delle richieste HTTP per route',
+            '# TYPE adg_http_request_duration_seconds histogram',
+        ]
+        lines += self.latency.prometheus('adg_http_request_duration_seconds', ('route', 'method'), 'status', worker)
+        for index, (name, kind, help_text) in enumerate((
+            ('adg_sql_queries_total', 'counter', 'Query SQL eseguite per route ("-" = fuori richiesta)'),
+            ('adg_sql_seconds_total', 'counter', 'Tempo passato in query SQL per route'),
+            ('adg_reward_ledger_writes_total', 'counter', 'Ricompense ADG registrate per route'),
+            ('adg_claude_seconds_total', 'counter', 'Tempo di attesa verso Claude per route'),
+        )):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            lines += [f'{name}{_prom_labels([("route", route)] + worker)} {totals[index]}' for route, totals in routes]
+        lines += [
+            '# HELP adg_reward_ledger_flushed_total Ricompense scritte dal flush del ledger',
+            '# TYPE adg_reward_ledger_flushed_total counter',
+            f'adg_reward_ledger_flushed_total{_prom_labels(worker)} {flushed}',
+            '# HELP adg_reward_ledger_pending Ricompense in coda non ancora scritte',
+            '# TYPE adg_reward_ledger_pending gauge',
+            f'adg_reward_ledger_pending{_prom_labels(worker)} {len(reward_ledger.pending)}',
+            '# HELP adg_reward_ledger_flush_duration_seconds Durata dei flush del ledger',
+            '# TYPE adg_reward_ledger_flush_duration_seconds histogram',
+        ]
+        lines += self.ledger_flush_latency.prometheus('adg_reward_ledger_flush_duration_seconds', ('op',), 'outcome', worker)
+        lines += [
+            '# HELP adg_claude_request_duration_seconds Latenza delle chiamate a Claude (per tentativo)',
+            '# TYPE adg_claude_request_duration_seconds histogram',
+        ]
+        lines += claude.histogram.prometheus('adg_claude_request_duration_seconds', ('kind',), 'outcome', worker)
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+if METRICS_ENABLED:
+    @db.event.listens_for(Engine, 'before_cursor_execute')
+    def _sql_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    @db.event.listens_for(Engine, 'after_cursor_execute')
+    def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started_at'].pop()
+        request_metrics.note_sql(statement, time.perf_counter() - started)
+
+    @db.event.listens_for(Engine, 'handle_error')
+    def _sql_failed(context):
+        # Query fallita: after_cursor_execute non arriva, si toglie il suo inizio dalla pila
+        started = context.connection.info.get('query_started_at') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    @app.before_request
+    def _profile_start():
+        request_metrics.start()
+
+    @app.after_request
+    def _profile_status(response):
+        profile = request_metrics._current()
+        if profile is not None:
+            profile['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def _profile_finish(exc):
+        # Con stream_with_context il teardown arriva a stream finito: la durata include lo streaming
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_metrics.finish(route, request.method)
+
+
+def admin_required(f):
+    """Admin = utente con ruolo manager, oppure Authorization: Bearer ADG_METRICS_TOKEN (per lo scraper)"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.headers.get('Authorization', '')
+        if METRICS_TOKEN and auth == f'Bearer {METRICS_TOKEN}':
+            return f(*args, **kwargs)
+        if current_user.is_authenticated and current_user.role == 'manager':
+            return f(*args, **kwargs)
+        return jsonify({'error': 'Accesso riservato agli admin'}), 403
+    return decorated
+
+
+@app.route('/admin/metrics')
+@admin_required
+@query_budget(1, max_repeats=1)
+def admin_metrics():
+    """Metriche in formato testo Prometheus"""
+    return Response(request_metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/slow-requests')
+@admin_required
+@query_budget(1, max_repeats=1)
+def admin_slow_requests():
+    """Ultime richieste lente con l'SQL catturato"""
+    return jsonify({
+        'threshold_seconds': SLOW_REQUEST_SECONDS,
+        'requests': list(reversed(request_metrics.slow_requests))
+    })
+
+
 # =============================================================================
 # ADMIN/API ROUTES
 # =============================================================================
 
 @app.route('/admin/toggle-mining', methods=['POST'])
 @login_required
+@query_budget(5, max_repeats=3)
 def toggle_mining():
     """Toggle sistema mining RTX3060 (admin only)"""
     # Per ora tutti possono attivare per test
@@ -1818,6 +4091,7 @@ def toggle_mining():
         blockchain.mining_pool.stop_mining()
     else:
         blockchain.mining_pool.start_mining()
+    blockchain_stats_cache.clear()
 
     return jsonify({
         'success': True,
@@ -1827,6 +4101,7 @@ def toggle_mining():
 
 
 @app.route('/api/balance/<username>')
+@query_budget(1, max_repeats=1)
 def get_user_balance(username):
     """API bilancio utente"""
     user = User.query.filter_by(username=username).first()
@@ -1839,37 +4114,75 @@ def get_user_balance(username):
     return jsonify({'error': 'User not found'}), 404
 
 
+BLOCKCHAIN_STATS_TTL_SECONDS = 5  # Endpoint pubblico interrogato dalle dashboard
+
+
+class BlockchainStatsCache:
+    """Ultima risposta di /api/stats/blockchain con il suo ETag, valida per BLOCKCHAIN_STATS_TTL_SECONDS"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.body = None
+        self.etag = None
+        self.built_at = 0.0
+
+    def clear(self):
+        with self.lock:
+            self.built_at = 0.0
+
+    def get(self):
+        with self.lock:
+            if self.body is not None and time.time() - self.built_at < BLOCKCHAIN_STATS_TTL_SECONDS:
+                return self.body, self.etag
+
+        # Letture per chiave primaria, indipendenti dal numero di transazioni
+        row = db.session.get(BlockchainStats, 1)
+        state = db.session.get(ChainState, 1)
+        body = json.dumps({
+            'total_users': row.total_users if row else 0,
+            'total_transactions': row.total_transactions if row else 0,
+            'total_supply_distributed': round(row.total_supply_distributed, 2) if row else 0,
+            'current_block_height': state.block_height if state else GENESIS_BLOCK_HEIGHT,
+            'mining_pool_active': bool(state and state.pool_active),
+            'active_miners': row.active_miners if row else 0,
+            'total_hashrate': blockchain.mining_pool.total_hashrate
+        }, sort_keys=True)
+        etag = hashlib.sha1(body.encode()).hexdigest()
+        with self.lock:
+            self.body, self.etag, self.built_at = body, etag, time.time()
+        return body, etag
+
+
+blockchain_stats_cache = BlockchainStatsCache()
+
+
 @app.route('/api/stats/blockchain')
+@query_budget(3, max_repeats=1)
 def blockchain_stats():
-    """Statistiche blockchain ADG"""
-    total_users = User.query.count()
-    total_transactions = Transaction.query.count()
-    total_supply_distributed = db.session.query(db.func.sum(User.total_earned)).scalar() or 0
-    active_miners = MiningSession.query.filter_by(is_active=True).count()
-
-    return jsonify({
-        'total_users': total_users,
-        'total_transactions': total_transactions,
-        'total_supply_distributed': round(total_supply_distributed, 2),
-        'current_block_height': blockchain.current_block_height,
-        'mining_pool_active': blockchain.mining_pool.is_active,
-        'active_miners': active_miners,
-        'total_hashrate': blockchain.mining_pool.total_hashrate
-    })
+    """Statistiche blockchain ADG (riga materializzata + cache con ETag)"""
+    body, etag = blockchain_stats_cache.get()
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': f'public, max-age={BLOCKCHAIN_STATS_TTL_SECONDS}'
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
 
 
 @app.route('/api/mining/simulate-block')
 @login_required
+@query_budget(5)  # mine_block fa commit: current_user viene ricaricato
 def simulate_mining():
     """Simula mining di un blocco (per testing)"""
     if current_user.wallet_address:
-        reward = blockchain.mine_block(current_user.wallet_address)
+        reward, block_height = blockchain.mine_block(current_user.wallet_address)
         blockchain.reward_user(current_user, reward, 'mining')
         return jsonify({
             'success': True,
             'reward': reward,
-            'new_balance': current_user.balance,
-            'block_height': blockchain.current_block_height
+            'new_balance': current_user.balance + reward_ledger.pending_for(current_user.id),
+            'block_height': block_height
         })
     return jsonify({'success': False, 'message': 'Wallet non trovato'})
 
@@ -1879,31 +4192,37 @@ def simulate_mining():
 # =============================================================================
 
 @app.route('/life-science')
+@query_budget(1, max_repeats=1)
 def life_science():
     return render_template('life_science.html', current_user=current_user)
 
 
 @app.route('/servizi-informatici')
+@query_budget(1, max_repeats=1)
 def servizi_informatici():
     return render_template('servizi_informatici.html', current_user=current_user)
 
 
 @app.route('/difesa')
+@query_budget(1, max_repeats=1)
 def difesa():
     return render_template('difesa.html', current_user=current_user)
 
 
 @app.route('/finanza')
+@query_budget(1, max_repeats=1)
 def finanza():
     return render_template('finanza.html', current_user=current_user)
 
 
 @app.route('/chi-siamo')
+@query_budget(1, max_repeats=1)
 def chi_siamo():
     return render_template('chi_siamo.html', current_user=current_user)
 
 
 @app.route('/contatti')
+@query_budget(1, max_repeats=1)
 def contatti():
     return render_template('contatti.html', current_user=current_user)
 
@@ -1912,10 +4231,48 @@ def contatti():
 # INITIALIZATION
 # =============================================================================
 
+def _migrate_chat_usage():
+    """DB creati prima del vincolo unico: unisce le righe doppie (user_id, date) e crea l'indice"""
+    duplicates = db.session.execute(db.text(
+        "SELECT user_id, date FROM chat_usage GROUP BY user_id, date HAVING COUNT(*) > 1"
+    )).fetchall()
+    for user_id, day in duplicates:
+        params = {'u': user_id, 'd': day}
+        db.session.execute(db.text(
+            "UPDATE chat_usage SET "
+            "tokens_used = (SELECT SUM(tokens_used) FROM chat_usage WHERE user_id = :u AND date = :d), "
+            "messages_count = (SELECT SUM(messages_count) FROM chat_usage WHERE user_id = :u AND date = :d) "
+            "WHERE id = (SELECT MIN(id) FROM chat_usage WHERE user_id = :u AND date = :d)"
+        ), params)
+        db.session.execute(db.text(
+            "DELETE FROM chat_usage WHERE user_id = :u AND date = :d "
+            "AND id > (SELECT MIN(id) FROM chat_usage WHERE user_id = :u AND date = :d)"
+        ), params)
+    db.session.execute(db.text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_chat_usage_user_date ON chat_usage (user_id, date)"
+    ))
+    # create_all() non aggiunge indici a tabelle già esistenti
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_transaction_to_wallet_timestamp ON "transaction" (to_wallet, timestamp, id)'
+    ))
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_transaction_from_wallet_timestamp ON "transaction" (from_wallet, timestamp, id)'
+    ))
+    db.session.commit()
+    if duplicates:
+        print(f"ChatUsage: unite {len(duplicates)} coppie utente/giorno duplicate")
+
+
 def init_db():
     """Inizializza database se necessario"""
     try:
         db.create_all()
+        ensure_chain_state()
+        _migrate_chat_usage()
+        _migrate_notes_fts()
+        visit_log.import_legacy_file()
+        if db.session.get(BlockchainStats, 1) is None:
+            rebuild_blockchain_stats()
         print("ADG Blockchain System: Database inizializzato")
         print(f"Mining Pool RTX3060: {'ATTIVO' if blockchain.mining_pool.is_active else 'DISATTIVO'}")
         return True
@@ -1935,18 +4292,318 @@ with app.app_context():
 # Per Gunicorn, l'oggetto application è l'app Flask
 application = app
 
+# =============================================================================
+# BENCHMARK VISITE
+# =============================================================================
+
+def benchmark_visits(requests_count=300):
+    """Richieste/s su / con il vecchio visits.json e con il log a lotti (python app2.py benchmark_visits [n]).
+    Le visite della prova db finiscono nel DB configurato: lanciarlo su una copia."""
+    global VISITS_FILE, VISITS_BACKEND
+    original_file, original_backend = VISITS_FILE, VISITS_BACKEND
+    client = app.test_client()
+    results = {}
+    try:
+        VISITS_FILE = 'visits_benchmark.json'
+        for backend in ('json', 'db'):
+            VISITS_BACKEND = backend
+            client.get('/')  # Warm-up (template, connessioni)
+            start = time.perf_counter()
+            for _ in range(requests_count):
+                client.get('/')
+            elapsed = time.perf_counter() - start
+            results[backend] = requests_count / elapsed
+            print(f"{backend:>4}: {requests_count} richieste in {elapsed:.2f}s -> {results[backend]:.0f} req/s")
+    finally:
+        if os.path.exists(VISITS_FILE):
+            os.remove(VISITS_FILE)
+        VISITS_FILE, VISITS_BACKEND = original_file, original_backend
+    print(f"Speedup: {results['db'] / results['json']:.1f}x")
+    return results
+
+
+# =============================================================================
+# VERIFICA QUERY BUDGET
+# =============================================================================
+
+QUERY_BUDGET_PROJECTS = 3  # Righe dei dati di prova: con un N+1 le query crescono con questi numeri
+QUERY_BUDGET_MEMBERS = 5
+QUERY_BUDGET_NOTES = 10
+QUERY_BUDGET_FILES = 4
+QUERY_BUDGET_KB_QUESTION = 'Come funziona il mining dei token ADG'
+
+# Route che il controllo non può chiamare, ciascuna con il motivo; tutte le altre devono avere un budget
+QUERY_BUDGET_EXEMPT = {
+    'static': 'view interna di Flask: legge da static/ senza toccare il DB',
+    'attach_image_to_note': "incompleta: con un'immagine valida risponde 500 (url non definita)",
+}
+
+
+def _flush_write_behind():
+    """Scrive le code in memoria (ricompense, visite, uso chat) nel DB dell'app in questo momento"""
+    reward_ledger.flush()
+    visit_log.flush()
+    chat_usage_buffer.flush()
+
+
+def _reset_process_caches():
+    """Dimentica quello che le cache di processo hanno letto dal DB (quando il DB sotto l'app cambia)"""
+    visit_log.stored_count = None
+    user_context_cache.clear()
+    blockchain_stats_cache.clear()
+    knowledge_index.loaded = False
+    semantic_index.loaded = False
+
+
+@contextmanager
+def _query_budget_database():
+    """Per la durata del blocco l'app usa un DB SQLite, una cartella uploads e un visits.json temporanei
+    e Claude risponde con lo stub: i dati di prova non arrivano mai al DB configurato.
+    All'uscita le code vengono scritte ancora nel DB temporaneo, poi tutto torna com'era e la cartella sparisce."""
+    global VISITS_FILE
+    workdir = tempfile.mkdtemp(prefix='query-budget-')
+    uri = f"sqlite:///{os.path.join(workdir, 'query_budget.db')}"
+    engine = create_engine(uri)
+    with app.app_context():
+        _flush_write_behind()  # Quello che è in coda appartiene al DB configurato
+        db.session.remove()
+        engines = db.engines
+    original = (engines[None], app.config['SQLALCHEMY_DATABASE_URI'], app.config['UPLOAD_FOLDER'],
+                VISITS_FILE, claude.client)
+    engines[None] = engine
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['UPLOAD_FOLDER'] = workdir
+    VISITS_FILE = os.path.join(workdir, 'visits.json')
+    claude.client = StubAnthropicClient(delay=0)
+    _reset_process_caches()
+    try:
+        with app.app_context():
+            if not init_db():
+                raise RuntimeError('DB temporaneo non inizializzato')
+        yield
+    finally:
+        with app.app_context():
+            _flush_write_behind()
+            db.session.remove()
+        (engines[None], app.config['SQLALCHEMY_DATABASE_URI'], app.config['UPLOAD_FOLDER'],
+         VISITS_FILE, claude.client) = original
+        _reset_process_caches()
+        engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _seed_query_budget_fixtures(password):
+    """Manager con progetti, membri, note, file e un messaggio chat, più le righe usate dai POST che
+    cancellano; ritorna i valori di prova (id e nomi)"""
+    def add_user(username, role):
+        user = User(username=username, password=password, role=role)
+        db.session.add(user)
+        db.session.flush()
+        user.wallet_address = blockchain.generate_wallet_address(user.id)
+        return user
+
+    def add_file(owner, name):
+        stored = f'{uuid.uuid4().hex}.txt'
+        path = os.path.join(app.config['UPLOAD_FOLDER'], stored)
+        with open(path, 'w') as f:
+            f.write('Contenuto di prova')
+        user_file = UserFile(user_id=owner.id, filename=stored, original_filename=name, file_type='document',
+                             file_size=os.path.getsize(path), file_path=path, mime_type='text/plain')
+        db.session.add(user_file)
+        db.session.flush()
+        return user_file
+
+    owner = add_user('budget_owner', 'manager')
+    members = [add_user(f'budget_member_{i}', 'employee') for i in range(QUERY_BUDGET_MEMBERS)]
+    outsider = add_user('budget_outsider', 'employee')
+    projects = []
+    for p in range(QUERY_BUDGET_PROJECTS):
+        project = Project(name=f'Query budget {p}', description='Dati di prova per check_query_budgets',
+                          owner_id=owner.id)
+        db.session.add(project)
+        db.session.flush()
+        for member in members:
+            db.session.add(ProjectMember(project_id=project.id, user_id=member.id, role='collaborator'))
+        for i in range(QUERY_BUDGET_NOTES):
+            db.session.add(UserNote(user_id=owner.id, project_id=project.id, title=f'Nota budget {p}.{i}',
+                                    content='Contenuto di prova', tags='budget,prova'))
+        projects.append(project)
+    project = projects[0]
+
+    files = [add_file(owner, f'budget_{i}.txt') for i in range(QUERY_BUDGET_FILES)]
+    project_files = [ProjectFile(project_id=project.id, file_id=f.id, uploaded_by=owner.id) for f in files[:2]]
+    db.session.add_all(project_files)
+    deleted_note = UserNote(user_id=owner.id, title='Nota da eliminare', content='Contenuto di prova')
+    message = ChatMessage(user_id=owner.id, message='Cosa sono i token ADG', response='Ricompense interne',
+                          tokens_used=10)
+    db.session.add_all([deleted_note, message, SharedKnowledge(
+        question=QUERY_BUDGET_KB_QUESTION, answer='Ogni blocco minato vale 50 ADG', category='fintech',
+        is_approved=True)])
+    db.session.commit()
+
+    note = UserNote.query.filter_by(project_id=project.id).first()
+    return {
+        'urls': {'project_id': project.id, 'note_id': note.id, 'username': owner.username,
+                 'user_id': members[0].id, 'file_id': files[0].id, 'filename': files[0].filename},
+        'removed_member_id': members[-1].id,
+        'outsider_id': outsider.id,
+        'project_file_id': project_files[-1].id,
+        'free_file_id': files[2].id,
+        'deleted_file_id': files[3].id,
+        'deleted_note_id': deleted_note.id,
+        'message_id': message.id,
+    }
+
+
+def _query_budget_requests(fixtures, password):
+    """Richieste di prova oltre alla GET senza parametri: (endpoint, metodo, valori URL, argomenti di client.open).
+    Le query string seguono i rami che leggono request.args; i POST distruttivi usano righe create apposta."""
+    project_id = fixtures['urls']['project_id']
+
+    def upload(name):
+        return {'data': {'file': (BytesIO(b'Contenuto di prova'), name)}, 'content_type': 'multipart/form-data'}
+
+    note_form = {'title': 'Nota di prova', 'content': 'Contenuto di prova', 'note_type': 'task',
+                 'priority': 'high', 'tags': 'budget', 'project_id': project_id}
+    return [
+        ('notes_search_api', 'GET', {}, {'query_string': {'q': 'budget prova', 'page': 2, 'per_page': 5}}),
+        ('notes_dashboard', 'GET', {}, {'query_string': {'search': 'budget', 'type': 'text', 'priority': 'normal'}}),
+        ('wallet', 'GET', {}, {'query_string': {'limit': 5}}),
+        ('wallet_history_api', 'GET', {}, {'query_string': {'limit': 5}}),
+        ('create_note', 'GET', {}, {'query_string': {'project_id': project_id}}),
+        ('login', 'POST', {}, {'data': {'username': 'budget_owner', 'password': password}}),
+        ('register', 'POST', {}, {'data': {'username': 'budget_new', 'password': password}}),
+        ('create_project', 'POST', {}, {'data': {'name': 'Query budget nuovo', 'description': 'Progetto di prova'}}),
+        ('create_note', 'POST', {}, {'data': note_form}),
+        ('edit_note', 'POST', {}, {'data': note_form}),
+        ('chat_preferences', 'POST', {}, {'json': {'tone': 'technical', 'response_length': 'detailed'}}),
+        ('chat_api', 'POST', {}, {'json': {'message': QUERY_BUDGET_KB_QUESTION}}),
+        ('chat_api', 'POST', {}, {'json': {'message': 'Domanda che la Knowledge Base non conosce'}}),
+        ('chat_stream_api', 'POST', {}, {'json': {'message': QUERY_BUDGET_KB_QUESTION}}),
+        ('chat_stream_api', 'POST', {}, {'json': {'message': 'Altra domanda che la Knowledge Base non conosce'}}),
+        ('chat_feedback', 'POST', {}, {'json': {'message_id': fixtures['message_id'], 'rating': 'positive'}}),
+        ('register_miner', 'POST', {}, {'json': {'miner_name': 'Rig di prova', 'gpu_model': 'RTX 3060'}}),
+        ('toggle_mining', 'POST', {}, {}),
+        ('upload_file', 'POST', {}, upload('budget_upload.txt')),
+        ('upload_file_to_project', 'POST', {}, upload('budget_progetto.txt')),
+        ('attach_file_to_project', 'POST', {}, {'json': {'file_id': fixtures['free_file_id']}}),
+        ('remove_file_from_project', 'POST', {'project_file_id': fixtures['project_file_id']}, {}),
+        ('delete_file', 'POST', {'file_id': fixtures['deleted_file_id']}, {}),
+        ('delete_note', 'POST', {'note_id': fixtures['deleted_note_id']}, {}),
+        ('add_project_member', 'POST', {}, {'json': {'user_id': fixtures['outsider_id'], 'role': 'viewer'}}),
+        ('change_member_role', 'POST', {}, {'json': {'role': 'manager'}}),
+        ('remove_project_member', 'POST', {'user_id': fixtures['removed_member_id']}, {}),
+    ]
+
+
+def _request_failed(response):
+    """Motivo per cui una richiesta di prova non ha fatto il suo lavoro (il conteggio non varrebbe), o None"""
+    if response.status_code >= 400:
+        return f'HTTP {response.status_code}'
+    if response.status_code in (301, 302) and 'next=' in (response.location or ''):
+        return 'rimandata al login'
+    if response.is_json and isinstance(response.json, dict) and response.json.get('success') is False:
+        return f"success=false ({response.json.get('message')})"
+    return None
+
+
+def check_query_budgets():
+    """Chiama ogni route con richieste di prova (query string e POST con payload validi) e confronta le query
+    con il budget del metodo; ogni route deve avere un budget o stare in QUERY_BUDGET_EXEMPT
+    (python app2.py query_budgets). Gira su un DB temporaneo: il DB configurato non viene toccato."""
+    password = secrets.token_urlsafe(16)
+    with _query_budget_database():
+        with app.app_context():
+            fixtures = _seed_query_budget_fixtures(password)
+        client = app.test_client()
+        client.post('/login', data={'username': 'budget_owner', 'password': password})
+
+        extra = {}
+        for endpoint, method, url_args, options in _query_budget_requests(fixtures, password):
+            extra.setdefault(endpoint, []).append((method, url_args, options))
+
+        checks = []
+        problems = 0
+        for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+            if rule.endpoint in QUERY_BUDGET_EXEMPT:
+                continue
+            view = app.view_functions[rule.endpoint]
+            calls = ([('GET', {}, {})] if 'GET' in rule.methods else []) + extra.get(rule.endpoint, [])
+            for method in sorted(rule.methods - {'HEAD', 'OPTIONS'} - {m for m, _, _ in calls}):
+                problems += 1
+                print(f"  MANCA    {method} {rule.rule}: nessuna richiesta di prova in _query_budget_requests")
+            for method, url_args, options in calls:
+                budget = _budget_for(view, method)
+                values = {**fixtures['urls'], **url_args}
+                if budget is None or not set(rule.arguments) <= set(values):
+                    problems += 1
+                    print(f"  MANCA    {method} {rule.rule}: né @query_budget né QUERY_BUDGET_EXEMPT")
+                    continue
+                with app.test_request_context():
+                    url = url_for(rule.endpoint, **{name: values[name] for name in rule.arguments})
+                label = f'{method} {rule.rule}'
+                if options.get('query_string'):
+                    label += '?' + urllib.parse.urlencode(options['query_string'])
+                checks.append((label, budget, lambda url=url, method=method, options=options:
+                               client.open(url, method=method, **options)))
+        # Prima le letture, poi le scritture; logout per ultimo perché chiude la sessione del client
+        checks.sort(key=lambda check: (check[0].startswith('GET /logout'), not check[0].startswith('GET ')))
+
+        def run(label, budget, call):
+            counter = QueryCounter(label, *budget)
+            response = None
+            try:
+                with counter:
+                    result = call()
+                    if isinstance(result, Response):
+                        response = result
+                        response.get_data()  # Le risposte in streaming fanno query mentre generano
+                        response.close()
+            except QueryBudgetExceeded as e:
+                print(f"  SFORATO  {e}")
+                return False
+            failed = _request_failed(response) if response is not None else None
+            if failed:
+                print(f"  FALLITA  {label}: {failed}")
+                return False
+            print(f"  OK       {counter.report()}")
+            return True
+
+        passed = 0
+        for label, budget, call in checks:
+            with app.app_context():
+                _flush_write_behind()  # I flush in background non devono finire nel conteggio
+            passed += run(label, budget, call)
+
+        with app.app_context():
+            owner = User.query.filter_by(username='budget_owner').one()  # Caricato fuori dal conteggio
+            passed += run('_build_user_context', _budget_for(_build_user_context, None),
+                          lambda: _build_user_context(owner))
+
+    total = len(checks) + 1
+    print(f"Query budget: {passed}/{total} entro il budget, {problems} route senza budget verificabile")
+    return total - passed + problems
+
+
 # =============================================================================
 # MAIN (per sviluppo locale)
 # =============================================================================
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark_visits':
+        benchmark_visits(int(sys.argv[2]) if len(sys.argv) > 2 else 300)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'query_budgets':
+        sys.exit(1 if check_query_budgets() else 0)
+
     print("=" * 60)
     print("ADELCHI BLOCKCHAIN SYSTEM - DEVELOPMENT MODE")
     print("=" * 60)
     print(f"Database: {app.config['SQLALCHEMY_DATABASE_URI']}")
-    print(f"Mining Pool RTX3060: {'ATTIVO' if blockchain.mining_pool.is_active else 'DISATTIVATO'}")
-    print(f"Websocket Ready: {blockchain.mining_pool.websocket_enabled}")
-    print(f"Current Block Height: {blockchain.current_block_height}")
+    with app.app_context():
+        print(f"Mining Pool RTX3060: {'ATTIVO' if blockchain.mining_pool.is_active else 'DISATTIVATO'}")
+        print(f"Websocket Ready: {blockchain.mining_pool.websocket_enabled}")
+        print(f"Current Block Height: {blockchain.current_block_height}")
     print(f"Upload Folder: {UPLOAD_FOLDER}")
     print("Funzionalità integrate:")
     print("  - Sistema File Upload completo con ricompense ADG")